@@ -16,6 +16,9 @@ CREATE TABLE p2p_message (
     "in_consumer_id" TEXT,
     "format" TEXT DEFAULT "xml"
 );
+CREATE INDEX IF NOT EXISTS p2p_message_message_id_idx ON p2p_message (message_id, is_ingoing);
+CREATE INDEX IF NOT EXISTS p2p_message_unhandled_idx ON p2p_message (is_ingoing, in_is_handled);
+CREATE INDEX IF NOT EXISTS p2p_message_undelivered_idx ON p2p_message (is_ingoing, out_is_delivered, out_sender);
 
 DROP TABLE IF EXISTS storage;
 CREATE TABLE storage (
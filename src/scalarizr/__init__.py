@@ -239,6 +239,12 @@ def prepare_snmp():
 
 DB_NAME = 'db.sqlite'
 DB_SCRIPT = 'db.sql'
+# Keep in sync with share/db.sql. Created on startup for databases made by older versions
+DB_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS p2p_message_message_id_idx ON p2p_message (message_id, is_ingoing)',
+    'CREATE INDEX IF NOT EXISTS p2p_message_unhandled_idx ON p2p_message (is_ingoing, in_is_handled)',
+    'CREATE INDEX IF NOT EXISTS p2p_message_undelivered_idx ON p2p_message (is_ingoing, out_is_delivered, out_sender)'
+)
 
 def _db_connect(file=None):
     logger = logging.getLogger(__name__)
@@ -270,16 +276,25 @@ def _init_db(file=None):
     if not any(filter(lambda row: row[1] == 'format', cur.fetchall())):
         cur.execute("alter table p2p_message add column format TEXT default 'xml'")
         conn.commit()
+    for sql in DB_INDEXES:
+        cur.execute(sql)
+    conn.commit()
     cur.close()
     conn.close()
 
         
     # Configure database connection pool
-    t = sqlite_server.SQLiteServerThread(_db_connect)
-    t.setDaemon(True)
-    t.start()
-    sqlite_server.wait_for_server_thread(t)
-    bus.db = t.connection
+    ini = cnf.rawini
+    if ini.has_option(config.SECT_GENERAL, 'sqlite_server') and \
+            int(ini.get(config.SECT_GENERAL, 'sqlite_server')):
+        # Fallback to a single connection served by a dedicated thread
+        t = sqlite_server.SQLiteServerThread(_db_connect)
+        t.setDaemon(True)
+        t.start()
+        sqlite_server.wait_for_server_thread(t)
+        bus.db = t.connection
+    else:
+        bus.db = sqlite_server.ConnectionPool(_db_connect)
     
 
     
@@ -334,6 +349,9 @@ def _init_platform():
     logger.debug("Initialize platform")
     if platform_name:
         bus.platform = PlatformFactory().new_platform(platform_name)
+        if hasattr(bus.platform, 'prefetch_metadata'):
+            logger.debug('Prefetch instance metadata')
+            bus.platform.prefetch_metadata()
     else:
         raise ScalarizrError("Platform not defined")
 
@@ -905,6 +923,9 @@ class Service(object):
         msg_thread.start()
         self._msg_thread = msg_thread
 
+        # Start background delivery of outgoing messages
+        msg_service.get_producer().start()
+
         # Start API server
         api_server = bus.api_server
         self._logger.info('Starting API server on http://0.0.0.0:8010')
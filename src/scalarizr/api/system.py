@@ -29,7 +29,7 @@ from scalarizr.util import system2, dns, disttool
 from scalarizr.linux import mount
 from scalarizr.util import kill_childs
 from scalarizr.queryenv import ScalingMetric
-from scalarizr.handlers.script_executor import logs_dir
+from scalarizr.handlers import script_executor
 
 LOG = logging.getLogger(__name__)
 
@@ -493,26 +493,44 @@ class SystemAPI(object):
 
 
     @rpc.service_method
-    def get_script_logs(self, exec_script_id, maxsize=max_log_size):
+    def get_script_logs(self, exec_script_id, maxsize=max_log_size, offset=None):
         '''
-        :return: out and err logs
-        :rtype: dict(stdout: base64encoded, stderr: base64encoded)
+        :param offset: Read logs incrementally starting from offset.
+                Either int or dict(stdout: int, stderr: int)
+        :return: out and err logs. With offset at most maxsize bytes of each log,
+                next offsets and whether script is still running are also returned
+        :rtype: dict(stdout: base64encoded, stderr: base64encoded
+                [, stdout_offset: int, stderr_offset: int, running: bool])
         '''
-        stdout_match = glob.glob(os.path.join(logs_dir, '*%s-out.log' % exec_script_id))
-        stderr_match = glob.glob(os.path.join(logs_dir, '*%s-err.log' % exec_script_id))
+        if offset is None:
+            stdout_path = script_executor.find_log(exec_script_id, 'stdout')
+            stderr_path = script_executor.find_log(exec_script_id, 'stderr')
 
-        if not stdout_match:
-            stdout = binascii.b2a_base64(u'log file not found')
-        else:
-            stdout_path = stdout_match[0]
-            stdout = binascii.b2a_base64(_get_log(stdout_path))
-        if not stderr_match:
-            stderr = binascii.b2a_base64(u'errlog file not found')
-        else:
-            stderr_path = stderr_match[0]
-            stderr = binascii.b2a_base64(_get_log(stderr_path))
-
-        return dict(stdout=stdout, stderr=stderr)
+            if not stdout_path:
+                stdout = binascii.b2a_base64(u'log file not found')
+            else:
+                stdout = binascii.b2a_base64(_get_log(stdout_path))
+            if not stderr_path:
+                stderr = binascii.b2a_base64(u'errlog file not found')
+            else:
+                stderr = binascii.b2a_base64(_get_log(stderr_path))
+
+            return dict(stdout=stdout, stderr=stderr)
+
+        if not isinstance(offset, dict):
+            offset = dict(stdout=offset, stderr=offset)
+        ret = dict(running=script_executor.is_running(exec_script_id))
+        for stream, not_found in (('stdout', u'log file not found'),
+                                ('stderr', u'errlog file not found')):
+            stream_offset = int(offset.get(stream) or 0)
+            log = script_executor.read_log(exec_script_id, stream, stream_offset, maxsize)
+            if log is None:
+                ret[stream] = binascii.b2a_base64(not_found)
+                ret[stream + '_offset'] = stream_offset
+            else:
+                ret[stream] = binascii.b2a_base64(log[0])
+                ret[stream + '_offset'] = log[1]
+        return ret
 
 
 def _get_log(logfile, maxsize=max_log_size):
@@ -12,6 +12,9 @@ from scalarizr.util import validators
 from ConfigParser import ConfigParser, RawConfigParser, NoOptionError, NoSectionError
 from getpass import getpass
 import os, sys, logging
+import bisect
+import copy
+import threading
 try:
     import json
 except ImportError:
@@ -977,44 +980,130 @@ class ScalarizrCnf(Observable):
 
 
 class State(dict):
+    '''
+    Key-value storage in 'state' table with JSON encoded values.
+    The whole table is read into memory on first access, reads are served
+    from the cache and writes go through to the database.
+    Use invalidate() when the table was modified by another process.
+    '''
+
+    def __init__(self, *args, **kwds):
+        dict.__init__(self, *args, **kwds)
+        self._lock = threading.RLock()
+        self._cache = None  # {name: value}
+        self._names = []  # sorted names for prefix lookups
+        self._stale = set()
+
 
     def _conn(self):
         return bus.db
 
 
-    def __getitem__(self, name):
-        conn = self._conn()
-        cur = conn.cursor()
+    def _decode(self, value):
         try:
-            cur.execute("SELECT value FROM state WHERE name = ?", [name])
-            ret = cur.fetchone()
+            return json.loads(value)
+        except (TypeError, ValueError):
+            return value
+
+
+    def _load(self):
+        if self._cache is None:
+            cache = {}
+            cur = self._conn().cursor()
             try:
-                return json.loads(ret['value'])
-            except (TypeError, KeyError, ValueError):
-                return ret
-        finally:
-            cur.close()
+                cur.execute("SELECT name, value FROM state")
+                for row in cur.fetchall():
+                    cache[row[0]] = self._decode(row[1])
+            finally:
+                cur.close()
+            self._cache = cache
+            self._names = sorted(cache)
+            self._stale.clear()
+        elif self._stale:
+            cur = self._conn().cursor()
+            try:
+                for name in self._stale:
+                    cur.execute("SELECT value FROM state WHERE name = ?", [name])
+                    row = cur.fetchone()
+                    if row:
+                        self._cached(name, self._decode(row[0]))
+                    else:
+                        self._uncached(name)
+            finally:
+                cur.close()
+            self._stale.clear()
+        return self._cache
+
+
+    def _cached(self, name, value):
+        if name not in self._cache:
+            bisect.insort(self._names, name)
+        self._cache[name] = value
+
+
+    def _uncached(self, name):
+        if name in self._cache:
+            del self._cache[name]
+            self._names.remove(name)
+
+
+    def _copy(self, value):
+        # Callers shouldn't be able to change cached containers
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+        return value
+
+
+    def __getitem__(self, name):
+        # Missing keys are None
+        with self._lock:
+            return self._copy(self._load().get(name))
+
 
     def __setitem__(self, name, value):
-        conn = self._conn()
-        cur = conn.cursor()
-        try:
-            cur.execute("INSERT INTO state VALUES (?, ?)", [name, json.dumps(value) ])
-        finally:
-            cur.close()
-        conn.commit()
+        self.update({name: value})
+
+
+    def update(self, values):
+        '''
+        Write several keys in one transaction
+        '''
+        values = dict((name, json.dumps(value)) for name, value in dict(values).items())
+        with self._lock:
+            self._load()
+            conn = self._conn()
+            conn.executemany("INSERT INTO state VALUES (?, ?)", values.items())
+            conn.commit()
+            # Cache what a read from the database would return:
+            # tuples become lists, dict keys become strings
+            for name, value in values.items():
+                self._cached(name, json.loads(value))
+
 
     def get_all(self, name):
-        conn = self._conn()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT * FROM state WHERE name LIKE '%s%%'" % name)
+        '''
+        Returns all keys starting with name prefix
+        '''
+        with self._lock:
+            cache = self._load()
             ret = {}
-            for row in cur.fetchall():
-                ret[row['name']] = row['value']
+            for i in xrange(bisect.bisect_left(self._names, name), len(self._names)):
+                key = self._names[i]
+                if not key.startswith(name):
+                    break
+                ret[key] = self._copy(cache[key])
             return ret
-        finally:
-            cur.close()
+
+
+    def invalidate(self, name=None):
+        '''
+        Re-read key (or all keys when name is None) from database on next access
+        '''
+        with self._lock:
+            if name is None:
+                self._cache = None
+            elif self._cache is not None:
+                self._stale.add(name)
 
 
 STATE = State()
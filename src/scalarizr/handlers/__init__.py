@@ -15,7 +15,9 @@ import logging
 import threading
 import pprint
 import sys
+import time
 import traceback
+import Queue
 import uuid
 import distutils.version
 
@@ -228,6 +230,17 @@ class Handler(object):
         return False
 
 
+    def ordering_key(self, message, queue):
+        '''
+        Key for parallel message dispatch (see MessageListener).
+        Calls with equal keys are handled one by one in arrival order,
+        calls with different keys may run concurrently.
+        None keeps handler in the message handler thread.
+        Handlers that send messages with wait_subhandler=True must return None.
+        '''
+        return None
+
+
     def __call__(self, message):
         fn = "on_" + message.name
         if hasattr(self, fn) and callable(getattr(self, fn)):
@@ -283,10 +296,106 @@ class Handler(object):
 class HandlerError(BaseException):
     pass
 
+class _DispatchPool(object):
+    '''
+    Fixed set of worker threads. Every ordering key is pinned to a single worker,
+    so tasks with the same key are executed in submit order.
+    '''
+
+    def __init__(self, size, name='MessageDispatch'):
+        self._queues = []
+        self._threads = []
+        for i in range(size):
+            q = Queue.Queue()
+            t = threading.Thread(name='%s-%d' % (name, i), target=self._worker, args=(q, ))
+            t.setDaemon(True)
+            t.start()
+            self._queues.append(q)
+            self._threads.append(t)
+
+    def submit(self, key, fn, *args):
+        self._queues[hash(key) % len(self._queues)].put((fn, args))
+
+    def join(self):
+        for q in self._queues:
+            q.join()
+
+    def shutdown(self, timeout=None):
+        '''
+        Stop workers when already submitted tasks are done.
+        Waits for them at most timeout seconds
+        '''
+        for q in self._queues:
+            q.put(None)
+        deadline = time.time() + timeout if timeout is not None else None
+        for t in self._threads:
+            if deadline is None:
+                t.join()
+            else:
+                t.join(max(deadline - time.time(), 0))
+
+    def _worker(self, q):
+        while True:
+            task = q.get()
+            try:
+                if task is None:
+                    return
+                fn, args = task
+                fn(*args)
+            except (BaseException, Exception), e:
+                LOG.exception(e)
+            finally:
+                q.task_done()
+
+
+class PendingCalls(object):
+    '''
+    Handler calls of one message that are still queued or running in the
+    dispatch pool. Callbacks passed to then() are called when all of them finished
+    '''
+
+    def __init__(self, count):
+        self._count = count
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        with self._lock:
+            self._count -= 1
+            callbacks = self._callbacks if not self._count else []
+        for fn in callbacks:
+            fn()
+
+    def then(self, fn):
+        with self._lock:
+            if self._count:
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def wait(self):
+        done = threading.Event()
+        self.then(done.set)
+        done.wait()
+
+
 class MessageListener:
+    '''
+    Passes messages to the accepted handlers.
+
+    By default handlers are called one by one in the message handler thread.
+    When [messaging] dispatch_workers > 0, handlers that return an ordering key
+    (Handler.ordering_key) are called in a pool of worker threads:
+    calls with the same key keep their order, others run concurrently.
+    Handlers without a key are still called inline, and keyed handlers of
+    a message are dispatched only after its inline handlers returned.
+    In that case __call__ returns :class:`PendingCalls`, and the message
+    should be marked as handled once they are done.
+    '''
     _accept_kwargs = {}
+    slow_handler_threshold = 30
 
-    def __init__(self):
+    def __init__(self, dispatch_workers=None):
         self._logger = logging.getLogger(__name__)
         self._handlers_chain = None
         cnf = bus.cnf
@@ -302,6 +411,18 @@ class MessageListener:
         )
         LOG.debug("Keywords for each Handler::accept\n%s", pprint.pformat(self._accept_kwargs))
 
+        if dispatch_workers is None:
+            ini = cnf.rawini
+            dispatch_workers = 0
+            if ini.has_option(config.SECT_MESSAGING, 'dispatch_workers'):
+                dispatch_workers = int(ini.get(config.SECT_MESSAGING, 'dispatch_workers'))
+        self._pool = None
+        if dispatch_workers > 0:
+            LOG.debug('Starting %d message dispatch workers', dispatch_workers)
+            self._pool = _DispatchPool(dispatch_workers)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
         self.get_handlers_chain()
 
 
@@ -370,22 +491,35 @@ class MessageListener:
                     bus.scalr_version = ver
 
             accepted = False
+            dispatched = []
             for handler in self.get_handlers_chain():
                 hnd_name = handler.__class__.__name__
                 try:
                     if handler.accept(message, queue, **self._accept_kwargs):
                         accepted = True
-                        LOG.debug("Call handler %s" % hnd_name)
-                        try:
-                            handler(message)
-                        except (BaseException, Exception), e:
-                            LOG.exception(e)
+                        key = None
+                        if self._pool and hasattr(handler, 'ordering_key'):
+                            key = handler.ordering_key(message, queue)
+                        if key is None:
+                            LOG.debug("Call handler %s" % hnd_name)
+                            self._call_handler(handler, message)
+                        else:
+                            dispatched.append((key, handler))
                 except (BaseException, Exception), e:
                     LOG.error("%s accept() method failed with exception", hnd_name)
                     LOG.exception(e)
 
             if not accepted:
                 LOG.warning("No one could handle '%s'", message.name)
+
+            if dispatched:
+                # Keyed handlers don't run concurrently with the rest of the chain
+                pending = PendingCalls(len(dispatched))
+                for key, handler in dispatched:
+                    LOG.debug("Dispatch handler %s (key: %s)", handler.__class__.__name__, key)
+                    self._pool.submit(key, self._call_handler, handler, message,
+                                    time.time(), pending)
+                return pending
         finally:
             #if platform_access_data_on_me:
             #       pl.clear_access_data()
@@ -393,6 +527,70 @@ class MessageListener:
             # without credentials. We need a better secret data passing mechanism
             pass
 
+    def _call_handler(self, handler, message, submitted=None, pending=None):
+        hnd_name = handler.__class__.__name__
+        start = time.time()
+        failed = False
+        try:
+            handler(message)
+        except (BaseException, Exception), e:
+            failed = True
+            LOG.exception(e)
+        if pending:
+            try:
+                pending.done()
+            except (BaseException, Exception), e:
+                LOG.exception(e)
+        elapsed = time.time() - start
+        wait = start - submitted if submitted else 0.0
+        self._record(hnd_name, elapsed, wait, failed)
+        if elapsed > self.slow_handler_threshold:
+            LOG.warning('%s handled %s in %.1f seconds', hnd_name, message.name, elapsed)
+        else:
+            LOG.debug('%s handled %s in %.3f seconds', hnd_name, message.name, elapsed)
+
+    def _record(self, hnd_name, elapsed, wait, failed):
+        with self._stats_lock:
+            st = self._stats.get(hnd_name)
+            if not st:
+                st = self._stats[hnd_name] = dict(calls=0, errors=0,
+                                time_total=0.0, time_max=0.0, wait_total=0.0, wait_max=0.0)
+            st['calls'] += 1
+            st['errors'] += int(failed)
+            st['time_total'] += elapsed
+            st['time_max'] = max(st['time_max'], elapsed)
+            st['wait_total'] += wait
+            st['wait_max'] = max(st['wait_max'], wait)
+
+    def get_stats(self):
+        '''
+        Per-handler latency: calls, errors, time_total/time_max/time_avg (handler run time)
+        and wait_total/wait_max (time spent in dispatch queue), seconds.
+        '''
+        with self._stats_lock:
+            ret = {}
+            for hnd_name, st in self._stats.items():
+                st = dict(st)
+                st['time_avg'] = st['time_total'] / st['calls']
+                ret[hnd_name] = st
+            return ret
+
+    def join(self):
+        '''
+        Wait for all dispatched handler calls to complete
+        '''
+        if self._pool:
+            self._pool.join()
+
+    def shutdown(self, timeout=None):
+        '''
+        Complete dispatched handler calls (waits at most timeout seconds)
+        and stop the pool
+        '''
+        if self._pool:
+            self._pool.shutdown(timeout)
+            self._pool = None
+
 def async(fn):
     def decorated(*args, **kwargs):
         t = threading.Thread(target=fn, args=args, kwargs=kwargs)
@@ -401,6 +599,119 @@ def async(fn):
     return decorated
 
 
+class LogShippingHandler(logging.Handler):
+    '''
+    Ships log records to Scalr in a background thread.
+
+    Records are coalesced into one message (lines joined with newline) when
+    batch_size bytes were collected or flush_interval seconds passed.
+    At most capacity records are buffered, others are dropped and counted.
+    Subclasses define message_name and message_body()
+    '''
+    message_name = None
+    flush_interval = 1
+    flush_timeout = 60
+    batch_size = 64 * 1024
+    capacity = 10000
+
+    def __init__(self, level=logging.INFO):
+        logging.Handler.__init__(self, level)
+        self._msg_service = bus.messaging_service
+        self._buffer = []
+        self._buffer_size = 0
+        self._in_flight = 0
+        self._flushing = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.sent = 0
+        self.dropped = 0
+
+    def message_body(self):
+        '''
+        Message body without log text. Called on the logging thread
+        '''
+        return {}
+
+    def emit(self, record):
+        try:
+            text = str(record.msg) % record.args if record.args else str(record.msg)
+        except:
+            self.handleError(record)
+            return
+        with self._cond:
+            if len(self._buffer) >= self.capacity:
+                self.dropped += 1
+                return
+            self._buffer.append((self.message_body(), text))
+            self._buffer_size += len(text)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._ship, name='LogShipping')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            elif self._buffer_size >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        '''
+        Ships buffered records without waiting for flush_interval.
+        Without timeout returns at once: logging.shutdown() flushes all handlers
+        at exit and mustn't hang when Scalr is unreachable. With timeout waits
+        at most that many seconds until records are sent.
+        Returns True when nothing is left to send
+        '''
+        if not timeout:
+            with self._cond:
+                self._cond.notify_all()
+                return not (self._buffer or self._in_flight)
+        deadline = time.time() + timeout
+        with self._cond:
+            self._flushing += 1
+            try:
+                self._cond.notify_all()
+                while (self._buffer or self._in_flight) and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                return not (self._buffer or self._in_flight)
+            finally:
+                self._flushing -= 1
+
+    def _ship(self):
+        while True:
+            with self._cond:
+                while not self._buffer:
+                    self._cond.wait()
+                if self._buffer_size < self.batch_size and not self._flushing:
+                    # Let more records come in
+                    self._cond.wait(self.flush_interval)
+                records = self._buffer
+                self._buffer = []
+                self._buffer_size = 0
+                self._in_flight = len(records)
+            try:
+                for body in self._batches(records):
+                    msg = self._msg_service.new_message(self.message_name, body=body)
+                    self._msg_service.get_producer().send(Queues.LOG, msg)
+                    self.sent += 1
+            except:
+                LOG.warning('Failed to ship %s records: %s', self.message_name, sys.exc_info()[1])
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+
+    def _batches(self, records):
+        body = lines = None
+        size = 0
+        for rec_body, text in records:
+            if rec_body != body or (lines and size + len(text) > self.batch_size):
+                if lines:
+                    yield dict(body, message='\n'.join(lines))
+                body, lines, size = rec_body, [], 0
+            lines.append(text)
+            size += len(text) + 1
+        if lines:
+            yield dict(body, message='\n'.join(lines))
+
+
 class ServiceCtlHandler(Handler):
     _logger = None
     _cnf_ctl = None
@@ -804,7 +1115,8 @@ class FarmSecurityMixin(object):
         for port in self._ports:
             rules += self.__accept_host(message.local_ip, message.remote_ip, port)
 
-        self._iptables.FIREWALL.ensure(rules)
+        with self._iptables.RuleSet() as rule_set:
+            rule_set.ensure(self._iptables.FIREWALL, rules)
 
 
     def on_HostDown(self, message):
@@ -817,16 +1129,10 @@ class FarmSecurityMixin(object):
         rules = []
         for port in self._ports:
             rules += self.__accept_host(message.local_ip, message.remote_ip, port)
-        for rule in rules:
-            try:
-                self._iptables.FIREWALL.remove(rule)
-                #self._iptables.delete_rule(rule)
-            except: #?
-                if 'does a matching rule exist in that chain' in str(sys.exc_info()[1]):
-                    # When HostDown comes from a server that didn't send HostInit
-                    pass
-                else:
-                    raise
+        # Rules that don't exist (when HostDown comes from a server
+        # that didn't send HostInit) are skipped by RuleSet
+        with self._iptables.RuleSet() as rule_set:
+            rule_set.remove(self._iptables.FIREWALL, rules)
 
 
     def __create_rule(self, source, dport, jump):
@@ -877,8 +1183,9 @@ class FarmSecurityMixin(object):
         for port in self._ports:
             drop_rules.append(self.__create_drop_rule(port))
 
-        self._iptables.FIREWALL.ensure(rules)
-        self._iptables.FIREWALL.ensure(drop_rules, append=True)
+        with self._iptables.RuleSet() as rule_set:
+            rule_set.ensure(self._iptables.FIREWALL, rules)
+            rule_set.ensure(self._iptables.FIREWALL, drop_rules, append=True)
 
 
 def build_tags(purpose=None, state=None, set_owner=True, **kwargs):
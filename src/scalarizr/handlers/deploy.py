@@ -18,7 +18,7 @@ from urlparse import urlparse
 
 from scalarizr.bus import bus
 from scalarizr.messaging import Messages, Queues
-from scalarizr.handlers import Handler, script_executor, operation
+from scalarizr.handlers import Handler, LogShippingHandler, script_executor, operation
 from scalarizr.util import system2, dicts
 from scalarizr import linux
 from scalarizr.linux import pkgmgr
@@ -125,6 +125,7 @@ class DeploymentHandler(Handler):
                     with op.step(self._step_execute_post_deploy_script):
                         self._exec_script(name='PostDeploy', **msg_body['post_deploy_routines'])
     
+                self._log_hdlr.flush(self._log_hdlr.flush_timeout)
                 self.send_message(
                     Messages.DEPLOY_RESULT, 
                     dict(
@@ -138,6 +139,7 @@ class DeploymentHandler(Handler):
             
         except (Exception, BaseException), e:
             self._logger.exception(e)
+            self._log_hdlr.flush(self._log_hdlr.flush_timeout)
             self.send_message(
                 Messages.DEPLOY_RESULT, 
                 dict(
@@ -374,15 +376,12 @@ class HttpSource(Source):
                 shutil.rmtree(tmpdir)
                             
             
-class DeployLogHandler(logging.Handler):
+class DeployLogHandler(LogShippingHandler):
+    message_name = Messages.DEPLOY_LOG
+
     def __init__(self, deploy_task_id=None):
-        logging.Handler.__init__(self, logging.INFO)
+        LogShippingHandler.__init__(self, logging.INFO)
         self.deploy_task_id = deploy_task_id
-        self._msg_service = bus.messaging_service
-        
-    def emit(self, record):
-        msg = self._msg_service.new_message(Messages.DEPLOY_LOG, body=dict(
-            deploy_task_id = self.deploy_task_id,
-            message = str(record.msg) % record.args if record.args else str(record.msg)
-        ))
-        self._msg_service.get_producer().send(Queues.LOG, msg)
+
+    def message_body(self):
+        return dict(deploy_task_id=self.deploy_task_id)
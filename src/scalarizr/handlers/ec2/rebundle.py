@@ -24,12 +24,16 @@ from scalarizr.storage2.cloudfs import FileTransfer
 from scalarizr.storage2 import volume, filesystem
 from scalarizr.libs.metaconf import Configuration
 
-from M2Crypto import X509, EVP, Rand, RSA
+from M2Crypto import X509, Rand, RSA
 from binascii import hexlify
 from xml.dom.minidom import Document
 from datetime import datetime
-import time, os, re, shutil, glob
+import time, os, re, shutil, glob, sys
 import string
+import hashlib
+import tempfile
+import threading
+import subprocess
 
 from boto.exception import BotoServerError
 from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping
@@ -309,8 +313,11 @@ class RebundleStratery:
 
 class RebundleInstanceStoreStrategy(RebundleStratery):
     _IMAGE_CHUNK_SIZE = 10 * 1024 * 1024 # 10 MB in bytes.
+    _IMAGE_IO_SIZE = 1024 * 1024
     _NUM_UPLOAD_THREADS = 4
     _MAX_UPLOAD_ATTEMPTS = 5
+    # Parts written but not yet uploaded. Bundling pauses when reached
+    _MAX_PARTS_ON_DISK = _NUM_UPLOAD_THREADS * 2
 
     _destination = None
     _image_name = None
@@ -325,6 +332,7 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
         self._image_size = image_size
         self._s3_bucket_name = s3_bucket_name
         self._platform = bus.platform
+        self._uploaded_parts = set()
 
     def _get_arch(self):
         arch = disttool.uname()[4]
@@ -351,7 +359,6 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
             # Load and generate necessary keys.
             name = os.path.basename(image_file)
             manifest_file = os.path.join(destination, name + '.manifest.xml')
-            bundled_file_path = os.path.join(destination, name + '.tar.gz.enc')
             try:
                 user_public_key = X509.load_cert_string(user_cert_string).get_pubkey()
             except:
@@ -380,22 +387,14 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
             # To minimize disk I/O the file is read from disk once and
             # piped via several processes. The tee is used to allow a
             # digest of the file to be calculated without having to re-read
-            # it from disk.
-            openssl = "/usr/sfw/bin/openssl" if disttool.is_sun() else "openssl"
-            tar = Tar()
-            tar.create().dereference().sparse()
-            tar.add(os.path.basename(image_file), os.path.dirname(image_file))
+            # it from disk. Encrypted stream is cut into parts right away,
+            # and each part is uploaded as soon as it's written.
             digest_file = os.path.join('/tmp', 'ec2-bundle-image-digest.sha1')
 
             LOG.info("Encrypting image")
-            system2(" | ".join([
-                    "%(openssl)s %(digest_algo)s -out %(digest_file)s < %(digest_pipe)s & %(tar)s",
-                    "tee %(digest_pipe)s",
-                    "gzip",
-                    "%(openssl)s enc -e -%(crypto_algo)s -K %(key)s -iv %(iv)s > %(bundled_file_path)s"]) % dict(
-                            openssl=openssl, digest_algo=DIGEST_ALGO, digest_file=digest_file, digest_pipe=digest_pipe,
-                            tar=str(tar), crypto_algo=CRYPTO_ALGO, key=key, iv=iv, bundled_file_path=bundled_file_path
-            ), shell=True)
+            cmd = self._bundle_cmd(image_file, digest_file, digest_pipe, key, iv)
+            parts = self._stream_parts(cmd, name, destination)
+            LOG.debug("Image splitted into %s chunks", len(parts))
 
             try:
                 # openssl produce different outputs:
@@ -412,21 +411,8 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
             finally:
                 os.remove(digest_file)
 
-            #digest = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
-
-            # Split the bundled AMI.
-            # Splitting is not done as part of the compress, encrypt digest
-            # stream, so that the filenames of the parts can be easily
-            # tracked. The alternative is to create a dedicated output
-            # directory, but this leaves the user less choice.
-            LOG.info("Splitting image into chunks")
-            part_names = coreutils.split(bundled_file_path, name, self._IMAGE_CHUNK_SIZE, destination)
-            LOG.debug("Image splitted into %s chunks", len(part_names))
-
-            # Sum the parts file sizes to get the encrypted file size.
-            bundled_size = 0
-            for part_name in part_names:
-                bundled_size += os.path.getsize(os.path.join(destination, part_name))
+            # Sum the parts sizes to get the encrypted file size.
+            bundled_size = sum(size for _, _, size in parts)
             LOG.debug('Image size: %d bytes', bundled_size)
 
 
@@ -439,9 +425,6 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
             ec2_encrypted_iv = hexlify(ec2_public_key.get_rsa().public_encrypt(iv, padding))
             LOG.debug("Keys encrypted")
 
-            # Digest parts.
-            parts = self._digest_parts(part_names, destination)
-
             # Create bundle manifest
             bdm = list((name, device) for name, device in self._platform.block_devs_mapping()
                             if not name.startswith('ephemeral'))
@@ -451,7 +434,7 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
                     name=name,
                     user=user,
                     arch=self._get_arch(),
-                    parts=parts,
+                    parts=[(part_name, part_digest) for part_name, part_digest, _ in parts],
                     image_size=os.path.getsize(image_file),
                     bundled_size=bundled_size,
                     user_encrypted_key=user_encrypted_key,
@@ -474,23 +457,102 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
             raise
 
 
-    def _digest_parts(self, part_names, destination):
-        LOG.info("Generating digests for each chunk")
-        part_digests = []
-        for part_name in part_names:
-            part_filename = os.path.join(destination, part_name)
-            f = None
+    def _bundle_cmd(self, image_file, digest_file, digest_pipe, key, iv):
+        '''
+        Shell command that writes encrypted image to stdout and image digest to digest_file.
+        Exits with the status of the encryption pipeline after the digest is written
+        '''
+        openssl = "/usr/sfw/bin/openssl" if disttool.is_sun() else "openssl"
+        tar = Tar()
+        tar.create().dereference().sparse()
+        tar.add(os.path.basename(image_file), os.path.dirname(image_file))
+        gzip = linux.which('pigz') or 'gzip'
+        return " | ".join([
+                "%(openssl)s %(digest_algo)s -out %(digest_file)s < %(digest_pipe)s & %(tar)s",
+                "tee %(digest_pipe)s",
+                "%(gzip)s",
+                "%(openssl)s enc -e -%(crypto_algo)s -K %(key)s -iv %(iv)s; rc=$?; wait; exit $rc"]) % dict(
+                        openssl=openssl, digest_algo=DIGEST_ALGO, digest_file=digest_file, digest_pipe=digest_pipe,
+                        tar=str(tar), gzip=gzip, crypto_algo=CRYPTO_ALGO, key=key, iv=iv)
+
+
+    def _stream_parts(self, cmd, name, destination):
+        '''
+        Runs bundle command, splits it's stdout into parts and uploads
+        them to scalr images storage in parallel with bundling.
+        At most _MAX_PARTS_ON_DISK parts exist on disk at a time:
+        uploaded parts are removed and bundling waits for free slots.
+        Returns list of (part_name, sha1_hexdigest, size)
+        '''
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=stderr, close_fds=True)
+        slots = threading.Semaphore(self._MAX_PARTS_ON_DISK)
+        parts = []
+        errors = []
+
+        def part_uploaded(src, dst, retry, chunk_num):
+            self._uploaded_parts.add(os.path.basename(src))
+            os.remove(src)
+            slots.release()
+
+        def part_failed(src, dst, retry, chunk_num, exc_info):
+            errors.append(exc_info)
+            slots.release()
+
+        def src():
             try:
-                f = open(part_filename)
-                digest = EVP.MessageDigest(DIGEST_ALGO)
-                part_digests.append((part_name, hexlify(cryptotool.digest_file(digest, f))))
-            except (Exception, BaseException):
-                LOG.error("Cannot generate digest for chunk '%s'", part_name)
-                raise
-            finally:
-                if f is not None:
-                    f.close()
-        return part_digests
+                for part in self._split_stream(proc.stdout, name, destination, slots):
+                    parts.append(part)
+                    yield os.path.join(destination, part[0])
+                    if errors:
+                        break
+            except:
+                errors.append(sys.exc_info())
+
+        trn = FileTransfer(src=src, dst=self._platform.scalrfs.images(),
+                        num_workers=self._NUM_UPLOAD_THREADS,
+                        retries=self._MAX_UPLOAD_ATTEMPTS)
+        trn.on(transfer_complete=part_uploaded, transfer_error=part_failed)
+        try:
+            trn.run()
+        finally:
+            if proc.poll() is None and errors:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        if proc.returncode:
+            stderr.seek(0)
+            raise HandlerError("Bundle command exited with code %d. %s" % (
+                            proc.returncode, stderr.read().strip()))
+        return parts
+
+
+    def _split_stream(self, stream, name, destination, slots=None):
+        '''
+        Writes stream into _IMAGE_CHUNK_SIZE parts named like coreutils.split does,
+        digesting them on the way. Yields (part_name, sha1_hexdigest, size)
+        '''
+        num = 0
+        while True:
+            data = stream.read(min(self._IMAGE_IO_SIZE, self._IMAGE_CHUNK_SIZE))
+            if not data:
+                break
+            if slots:
+                slots.acquire()
+            part_name = name + coreutils.PART_SUFFIX + str(num).rjust(2, "0")
+            digest = hashlib.sha1()
+            size = 0
+            with open(os.path.join(destination, part_name), 'wb') as fp:
+                while data:
+                    fp.write(data)
+                    digest.update(data)
+                    size += len(data)
+                    data = stream.read(min(self._IMAGE_IO_SIZE, self._IMAGE_CHUNK_SIZE - size))
+            yield part_name, digest.hexdigest(), size
+            num += 1
 
 
     def _upload_image(self, bucket_name, manifest_path, manifest, region=None, acl="aws-exec-read"):
@@ -502,7 +564,9 @@ class RebundleInstanceStoreStrategy(RebundleStratery):
             manifest_dir = os.path.dirname(manifest_path)
             upload_files = [manifest_path]
             for part in manifest.parts:
-                upload_files.append(os.path.join(manifest_dir, part[0]))
+                # Parts streamed during bundling are already there
+                if part[0] not in self._uploaded_parts:
+                    upload_files.append(os.path.join(manifest_dir, part[0]))
 
             trn = FileTransfer(src=upload_files, dst=self._platform.scalrfs.images())
             trn.run()
@@ -110,8 +110,9 @@ class NimbulaSnapshotRebundleHandler(Handler):
             ))
 
         finally:
-            self._log_hdlr.bundle_task_id = None
             self._logger.removeHandler(self._log_hdlr)
+            self._log_hdlr.flush(self._log_hdlr.flush_timeout)
+            self._log_hdlr.bundle_task_id = None
 
 
 root_uuid = "97e128e3-a209-4a34-81f7-c35fb9053e25"
@@ -345,8 +346,9 @@ class NimbulaRebundleHandler(Handler):
 
         finally:
             """ Perform cleanup """
-            self._log_hdlr.bundle_task_id = None
             self._logger.removeHandler(self._log_hdlr)
+            self._log_hdlr.flush(self._log_hdlr.flush_timeout)
+            self._log_hdlr.bundle_task_id = None
             if self.loop:
                 system2('kpartx -d %s' % image_path, shell=True)
                 self.loop = None
@@ -10,7 +10,7 @@ import shutil
 
 from scalarizr.bus import bus
 from scalarizr.config import ScalarizrState
-from scalarizr.handlers import Handler, HandlerError
+from scalarizr.handlers import Handler, HandlerError, LogShippingHandler
 from scalarizr.messaging import Messages, Queues
 from scalarizr.storage2 import filesystem
 from scalarizr.storage2.util import loop
@@ -39,18 +39,15 @@ class StopRebundle(BaseException):
 
 
 
-class RebundleLogHandler(logging.Handler):
+class RebundleLogHandler(LogShippingHandler):
+    message_name = Messages.REBUNDLE_LOG
+
     def __init__(self, bundle_task_id=None):
-        logging.Handler.__init__(self, logging.INFO)
+        LogShippingHandler.__init__(self, logging.INFO)
         self.bundle_task_id = bundle_task_id
-        self._msg_service = bus.messaging_service
 
-    def emit(self, record):
-        msg = self._msg_service.new_message(Messages.REBUNDLE_LOG, body=dict(
-                bundle_task_id = self.bundle_task_id,
-                message = str(record.msg) % record.args if record.args else str(record.msg)
-        ))
-        self._msg_service.get_producer().send(Queues.LOG, msg)
+    def message_body(self):
+        return dict(bundle_task_id=self.bundle_task_id)
 
 
 def plug_rebundle_log(on_rebundle):
@@ -67,6 +64,7 @@ def plug_rebundle_log(on_rebundle):
             on_rebundle(self, message)
         finally:
             LOG.removeHandler(on_rebundle._log_hdlr)
+            on_rebundle._log_hdlr.flush(on_rebundle._log_hdlr.flush_timeout)
     return wrapper
 
 
@@ -26,6 +26,14 @@ import signal
 import logging
 import Queue
 import binascii
+import sys
+import glob
+import errno
+import heapq
+import select
+import itertools
+if not linux.os.windows_family:
+    import fcntl
 
 
 def get_handlers():
@@ -44,6 +52,53 @@ def get_truncated_log(logfile, maxsize=None):
         f.close()
 
 
+def find_log(exec_script_id, stream):
+    '''
+    @param stream: 'stdout' or 'stderr'
+    @return: Log file path or None
+    '''
+    paths = _log_index.get(exec_script_id)
+    if not paths:
+        paths = {}
+        for name, suffix in (('stdout', 'out'), ('stderr', 'err')):
+            match = glob.glob(os.path.join(logs_dir, '*%s-%s.log' % (exec_script_id, suffix)))
+            paths[name] = match and match[0] or None
+        if any(paths.values()):
+            _log_index[exec_script_id] = paths
+    path = paths.get(stream)
+    if path and os.path.exists(path):
+        return path
+
+
+def read_log(exec_script_id, stream, offset=0, size=None):
+    '''
+    Reads script output starting from offset.
+    Output of running scripts is read from memory when possible
+
+    @return: (data, next_offset) or None when log not found
+    '''
+    size = size or logs_truncate_over
+    outputs = _running_outputs.get(exec_script_id)
+    if outputs:
+        data = outputs[stream].read(offset, size)
+    else:
+        path = find_log(exec_script_id, stream)
+        if not path:
+            return None
+        data = _read_file(path, offset, size)
+    return data, offset + len(data)
+
+
+def is_running(exec_script_id):
+    return exec_script_id in _running_outputs
+
+
+def _read_file(path, offset, size):
+    with open(path) as fp:
+        fp.seek(offset)
+        return fp.read(size)
+
+
 LOG = logging.getLogger(__name__)
 
 skip_events = set()
@@ -53,6 +108,12 @@ skip_events = set()
     
 
 logs_truncate_over = 20 * 1000
+# Last bytes of each running script stream kept in memory
+logs_buffer_size = 64 * 1024
+# execution id -> dict(stdout: path, stderr: path)
+_log_index = {}
+# execution id -> dict(stdout: ScriptOutput, stderr: ScriptOutput)
+_running_outputs = {}
 if linux.os.windows_family:
     exec_dir_prefix = r'%Temp%\scalr-scripting.'
     logs_dir = r'%ProgramFiles%\Scalarizr\var\log\scripting'
@@ -64,10 +125,17 @@ else:
 class ScriptExecutor(Handler):
     name = 'script_executor'
     _data = None
+    # Max number of async scripts executed at the same time
+    async_workers = 16
+    log_rotate_interval = 3600
 
     def __init__(self):
         self.queue = Queue.Queue()
         self.in_progress = []
+        self._async_queue = Queue.Queue()
+        self._async_threads = []
+        self._async_idle = 0
+        self._async_lock = threading.Lock()
         self.global_variables = None
         bus.on(
                 init=self.on_init,
@@ -91,6 +159,7 @@ class ScriptExecutor(Handler):
             host_init_response=self.on_host_init_response,
             before_host_up=self.on_before_host_up
         )
+        supervisor.install_wakeup_fd()
 
         # Configuration
         cnf = bus.cnf
@@ -122,14 +191,16 @@ class ScriptExecutor(Handler):
         except ConfigParser.Error:
             pass
 
+        try:
+            self.async_workers = int(ini.get(self.name, 'async_workers'))
+        except ConfigParser.Error:
+            pass
+
         self.log_rotate_runnable = LogRotateRunnable()
-        self.log_rotate_thread = threading.Thread(name='ScriptingLogRotate',
-                                                                target=self.log_rotate_runnable)
-        self.log_rotate_thread.setDaemon(True)
 
     def on_start(self):
         # Start log rotation
-        self.log_rotate_thread.start()
+        supervisor.call_later(0, self._rotate_logs)
 
         #if linux.os.windows_family:
         #    system2(['C:\\Windows\\sysnative\\WindowsPowerShell\\v1.0\\powershell.exe', 
@@ -160,19 +231,50 @@ class ScriptExecutor(Handler):
         hostup.base['keep_scripting_logs_time'] = self.log_rotate_runnable.keep_scripting_logs_time
 
 
+    def _rotate_logs(self):
+        try:
+            self.log_rotate_runnable()
+        finally:
+            supervisor.call_later(self.log_rotate_interval, self._rotate_logs)
+
     def _execute_one_script(self, script):
         if script.asynchronous:
-            threading.Thread(target=self._execute_one_script0,
-                                            args=(script, )).start()
+            script.queued_time = time.time()
+            self._async_queue.put(script)
+            with self._async_lock:
+                if not self._async_idle and len(self._async_threads) < self.async_workers:
+                    t = threading.Thread(target=self._async_worker,
+                                    name='AsyncScript-%d' % len(self._async_threads))
+                    t.setDaemon(True)
+                    self._async_threads.append(t)
+                    t.start()
         else:
             self._execute_one_script0(script)
 
+    def _async_worker(self):
+        while True:
+            with self._async_lock:
+                self._async_idle += 1
+            script = self._async_queue.get()
+            with self._async_lock:
+                self._async_idle -= 1
+            try:
+                self._execute_one_script0(script)
+            except:
+                # Already logged
+                pass
+
     def _execute_one_script0(self, script):
         try:
             self.in_progress.append(script)
             if not script.start_time:
                 script.start()
-            self.send_message(Messages.EXEC_SCRIPT_RESULT, script.wait(), queue=Queues.LOG)
+            result = script.wait()
+            if script.queued_time and result:
+                LOG.debug("Script '%s' timing: queued %.3fs, executed %.3fs",
+                                script.name, script.start_time - script.queued_time,
+                                result['time_elapsed'])
+            self.send_message(Messages.EXEC_SCRIPT_RESULT, result, queue=Queues.LOG)
         except:
             if script.asynchronous:
                 LOG.exception('Caught exception')
@@ -219,6 +321,10 @@ class ScriptExecutor(Handler):
     def accept(self, message, queue, behaviour=None, platform=None, os=None, dist=None):
         return not message.name in skip_events
 
+    def ordering_key(self, message, queue):
+        # Scripts are executed in event order, but don't hold up other handlers
+        return self.name
+
     def __call__(self, message):
         event_name = message.event_name if message.name == Messages.EXEC_SCRIPT else message.name
         role_name = message.body.get('role_name', 'unknown_role')
@@ -289,6 +395,8 @@ class Script(object):
     stdout_path = None
     stderr_path = None
     execution_id = None
+    queued_time = None
+    outputs = None
 
     def __init__(self, **kwds):
         '''
@@ -353,6 +461,11 @@ class Script(object):
             args = (self.name, self.event_name, self.role_name, self.id)
             self.stdout_path = os.path.join(logs_dir, '%s.%s.%s.%s-out.log' % args)
             self.stderr_path = os.path.join(logs_dir, '%s.%s.%s.%s-err.log' % args)
+        _log_index[self.log_key] = dict(stdout=self.stdout_path, stderr=self.stderr_path)
+
+    @property
+    def log_key(self):
+        return self.execution_id or self.id
 
     def start(self):
         # Check interpreter here, and not in __init__
@@ -399,19 +512,24 @@ class Script(object):
                         env=self.environ)
         self.pid = self.proc.pid
         self.start_time = time.time()
+        self._track_output()
+
+    def _track_output(self):
+        self.outputs = dict(stdout=ScriptOutput(self.stdout_path),
+                        stderr=ScriptOutput(self.stderr_path))
+        _running_outputs[self.log_key] = self.outputs
 
     def wait(self):
         try:
+            if not self.outputs:
+                # Restored script
+                self._track_output()
             # Communicate with process
             self.logger.debug('Communicating with %s (pid: %s)', self.interpreter, self.pid)
-            while time.time() - self.start_time < self.exec_timeout:
-                if self._proc_poll() is None:
-                    time.sleep(0.5)
-                else:
-                    # Process terminated
-                    self.logger.debug('Process terminated')
-                    self.return_code = self._proc_complete()
-                    break
+            if supervisor.wait(self):
+                # Process terminated
+                self.logger.debug('Process terminated')
+                self.return_code = self._proc_complete()
             else:
                 # Process timeouted
                 self.logger.debug('Timeouted: %s seconds. Killing process %s (pid: %s)',
@@ -460,6 +578,9 @@ class Script(object):
                 raise
 
         finally:
+            _running_outputs.pop(self.log_key, None)
+            for output in (self.outputs or {}).values():
+                output.close()
             if not self.path:
                 f = os.path.dirname(self.exec_path)
                 if os.path.exists(f):
@@ -524,16 +645,217 @@ class Script(object):
                 pass
 
 
+class ScriptOutput(object):
+    '''
+    Follows script stdout or stderr log file and keeps the last
+    logs_buffer_size bytes in memory, so repeated incremental reads
+    of running script output don't hit the disk.
+    Script writes to the file itself, so it's output survives scalarizr restart
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._buf = ''
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def read(self, offset, size):
+        with self._lock:
+            self._follow()
+            start = self.size - len(self._buf)
+            if offset >= start:
+                return self._buf[offset - start:offset - start + size]
+        # Already dropped from memory
+        return _read_file(self.path, offset, size)
+
+    def close(self):
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._fp = None
+
+    def _follow(self):
+        if not self._fp:
+            if not os.path.exists(self.path):
+                return
+            self._fp = open(self.path)
+            self._fp.seek(self.size)
+        data = self._fp.read()
+        if data:
+            self._buf = (self._buf + data)[-logs_buffer_size:]
+            self.size += len(data)
+
+
 class LogRotateRunnable(object):
     keep_scripting_logs_time = 86400  # 1 day
 
     def __call__(self):
+        LOG.debug('Starting log_rotate routine')
+        now = time.time()
+        for name in os.listdir(logs_dir):
+            filename = os.path.join(logs_dir, name)
+            if os.stat(filename).st_ctime + self.keep_scripting_logs_time < now:
+                LOG.debug('Delete %s', filename)
+                os.remove(filename)
+        for key, paths in _log_index.items():
+            if not any(path and os.path.exists(path) for path in paths.values()):
+                _log_index.pop(key, None)
+
+
+class ScriptSupervisor(object):
+    '''
+    Waits for all running scripts in one thread.
+
+    The thread sleeps until SIGCHLD (signal wakeup fd) or the nearest timer
+    in the heap (script timeouts, log rotation). Scripts that aren't our
+    children (restored after restart) are polled every poll_interval seconds,
+    all scripts are polled so when wakeup fd isn't installed.
+    '''
+    poll_interval = 0.5
+    # In case SIGCHLD was missed
+    max_sleep = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._timers = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._wakeup_fds = None
+        self._wakeup_event = threading.Event()
+        self._sigchld = False
+        self.stats = dict(running=0, finished=0, timeouted=0, time_total=0.0)
+
+    def wait(self, script):
+        '''
+        Blocks until script terminates or it's exec_timeout passes
+        @return: True when script terminated, False when timeouted
+        '''
+        waiter = _ScriptWaiter()
+        with self._lock:
+            self._waiters[script] = waiter
+            self.stats['running'] += 1
+        self.call_later(script.start_time + script.exec_timeout - time.time(),
+                        self._finish, script, False)
+        waiter.event.wait()
+        return waiter.terminated
+
+    def call_later(self, delay, fn, *args):
+        '''
+        Calls fn in supervisor thread after delay seconds
+        '''
+        with self._lock:
+            heapq.heappush(self._timers, (time.time() + delay, self._seq.next(), fn, args))
+            if not self._thread:
+                self._start()
+        self._wakeup()
+
+    def install_wakeup_fd(self):
+        '''
+        Wake up on signals (SIGCHLD) delivered to the process.
+        Should be called from the main thread, SIGCHLD should have a python handler
+        '''
+        if linux.os.windows_family:
+            return
+        with self._lock:
+            self._open_pipe()
+        try:
+            signal.set_wakeup_fd(self._wakeup_fds[1])
+            self._sigchld = True
+        except ValueError:
+            LOG.debug('Signal wakeup fd can be set only from the main thread, '
+                            'scripts will be polled every %s seconds', self.poll_interval)
+
+    def _open_pipe(self):
+        if not self._wakeup_fds and not linux.os.windows_family:
+            self._wakeup_fds = os.pipe()
+            for fd in self._wakeup_fds:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def _start(self):
+        self._open_pipe()
+        self._thread = threading.Thread(target=self._run, name='ScriptSupervisor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _wakeup(self):
+        if self._wakeup_fds:
+            try:
+                os.write(self._wakeup_fds[1], '.')
+            except OSError:
+                # Pipe is full, thread will wake up anyway
+                pass
+        else:
+            self._wakeup_event.set()
+
+    def _sleep(self, timeout):
+        if self._wakeup_fds:
+            try:
+                select.select([self._wakeup_fds[0]], [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            try:
+                while os.read(self._wakeup_fds[0], 4096):
+                    pass
+            except OSError:
+                pass
+        else:
+            self._wakeup_event.wait(timeout)
+            self._wakeup_event.clear()
+
+    def _run(self):
         while True:
-            LOG.debug('Starting log_rotate routine')
-            now = time.time()
-            for name in os.listdir(logs_dir):
-                filename = os.path.join(logs_dir, name)
-                if os.stat(filename).st_ctime + self.keep_scripting_logs_time < now:
-                    LOG.debug('Delete %s', filename)
-                    os.remove(filename)
-            time.sleep(3600)
+            due = []
+            with self._lock:
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers))
+            for _, _, fn, args in due:
+                try:
+                    fn(*args)
+                except:
+                    LOG.warn('Supervisor timer %s failed', fn, exc_info=sys.exc_info())
+
+            with self._lock:
+                scripts = self._waiters.keys()
+            for script in scripts:
+                try:
+                    if script._proc_poll() is not None:
+                        self._finish(script, True)
+                except:
+                    LOG.warn('Failed to poll script %s (pid: %s)', script.name, script.pid,
+                                    exc_info=sys.exc_info())
+                    self._finish(script, True)
+
+            with self._lock:
+                timeout = self.max_sleep
+                if self._timers:
+                    timeout = min(timeout, self._timers[0][0] - time.time())
+                if not self._sigchld or any(not script.proc for script in self._waiters):
+                    timeout = min(timeout, self.poll_interval)
+            self._sleep(max(timeout, 0))
+
+    def _finish(self, script, terminated):
+        with self._lock:
+            waiter = self._waiters.pop(script, None)
+            if not waiter:
+                return
+            self.stats['running'] -= 1
+            self.stats['finished'] += 1
+            if not terminated:
+                self.stats['timeouted'] += 1
+            self.stats['time_total'] += time.time() - script.start_time
+        waiter.terminated = terminated
+        waiter.event.set()
+
+
+class _ScriptWaiter(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.terminated = None
+
+
+supervisor = ScriptSupervisor()
@@ -18,6 +18,7 @@ else:
 import shlex
 import os
 import re
+import types
 from copy import copy
 import logging
 
@@ -64,14 +65,18 @@ _OPTIONS = {
 
 
 def iptables(**long_kwds):
+    return linux.system(_build_args(IPTABLES_BIN, long_kwds))
 
+
+def _build_args(executable, long_kwds):
+    # protocol and match should precede match-specific options (e.g. --dport)
     ordered_long = OrderedDict()
     for key in ("protocol", "match"):
         if key in long_kwds:
             ordered_long[key] = long_kwds.pop(key)
     ordered_long.update(long_kwds)
     args0 = linux.build_cmd_args(
-            executable=IPTABLES_BIN,
+            executable=executable,
             long=ordered_long)
     args = []
     for arg in args0:
@@ -79,7 +84,7 @@ def iptables(**long_kwds):
             args.extend(('!', arg.replace('not-', '')))
         else:
             args.append(arg)
-    return linux.system(args)
+    return args
 
 
 def iptables_save(filename=None, *short_args, **long_kwds):
@@ -331,24 +336,23 @@ class _Chain(object):
         # NOTE: rule comparison is far from ideal, check _to_inner method
         # NOTE: existing rules don't have table attribute
 
-        tables = [rule.get('table') for rule in rules]
-        filter(None, tables)
-        if not 'filter' in tables:
-            tables.append('filter')
+        # NOTE: each table is listed once per call and indexed by canonical
+        # rule form, so rules inserted by other tools in between calls are seen
 
-        existing = []
+        tables = set(rule.get('table') or 'filter' for rule in rules)
+        existing = {}
         for table in tables:
-            existing.extend(self.list(table))
+            existing[table] = _RuleIndex(
+                    self.list(table) if table != 'filter' else self.list())
 
         for rule in reversed(rules):
-            rule_repr = _to_inner(rule)
-            if rule_repr not in existing:
+            index = existing[rule.get('table') or 'filter']
+            if rule not in index:
                 if not append:
                     self.insert(None, rule)
-                    existing.insert(0, rule_repr)
                 else:
                     self.append(rule)
-                    existing.append(rule_repr)
+                index.add(rule)
 
 
 #? Group this two functions in a Rule class?
@@ -387,6 +391,57 @@ def _to_inner(rule):
     return inner
 
 
+_canonical_cache = {}
+_CANONICAL_CACHE_SIZE = 4096
+
+def _canonical(rule):
+    """
+    Returns hashable canonical form of a rule: sorted tuple of _to_inner()
+    items without 'table' key. Results are cached.
+    """
+    key = tuple(sorted((k, tuple(v) if isinstance(v, (tuple, types.ListType)) else v)
+                                    for k, v in rule.iteritems()))
+    try:
+        return _canonical_cache[key]
+    except KeyError:
+        pass
+    inner = _to_inner(rule)
+    inner.pop('table', None)
+    canonical = tuple(sorted((k, tuple(v) if isinstance(v, (tuple, types.ListType)) else v)
+                                    for k, v in inner.iteritems()))
+    if len(_canonical_cache) >= _CANONICAL_CACHE_SIZE:
+        _canonical_cache.clear()
+    _canonical_cache[key] = canonical
+    return canonical
+
+
+class _RuleIndex(object):
+    """
+    Multiset of rules keyed by their canonical form.
+    O(1) membership tests instead of comparing dicts one by one.
+    """
+
+    def __init__(self, rules=()):
+        self._counts = {}
+        for rule in rules:
+            self.add(rule)
+
+    def __contains__(self, rule):
+        return _canonical(rule) in self._counts
+
+    def add(self, rule):
+        key = _canonical(rule)
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def discard(self, rule):
+        key = _canonical(rule)
+        count = self._counts.get(key, 0)
+        if count > 1:
+            self._counts[key] = count - 1
+        elif count:
+            del self._counts[key]
+
+
 def _is_plain_ip(s):
     return [n.isdigit() and 0 <= int(n) <= 255 for n in s.split('.')] == \
                [True] * 4
@@ -448,6 +503,106 @@ def ensure(chain_rules, append=False):
         chains[chain].ensure(rules, append)
 
 
+class RuleSet(object):
+    """
+    Transactional set of rule changes.
+
+    Desired rules are diffed against a single iptables-save snapshot per table,
+    and all missing inserts/appends and existing deletes are applied atomically
+    by one 'iptables-restore --noflush' call on commit().
+
+    Usage:
+            with iptables.RuleSet() as rs:
+                    rs.ensure(iptables.FIREWALL, accept_rules)
+                    rs.ensure(iptables.FIREWALL, drop_rules, append=True)
+                    rs.remove(iptables.FIREWALL, stale_rules)
+    """
+
+    def __init__(self):
+        self._snapshots = {}  # {table: {chain: _RuleIndex}}
+        self._ops = OrderedDict()  # {table: [restore_line, ...]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not exc_info[0]:
+            self.commit()
+
+    def ensure(self, chain, rules, append=False):
+        # Insert or append missing rules, keeping the rules order like _Chain.ensure does
+        chain = getattr(chain, 'name', chain)
+        for rule in (rules if append else reversed(rules)):
+            table, rule = self._split_table(rule)
+            existing = self._existing(table, chain)
+            if rule in existing:
+                continue
+            existing.add(rule)
+            self._add_op(table, '-A' if append else '-I', chain, rule)
+
+    def remove(self, chain, rules):
+        # Delete rules that present in chain. Missing rules are ignored
+        chain = getattr(chain, 'name', chain)
+        for rule in rules:
+            table, rule = self._split_table(rule)
+            existing = self._existing(table, chain)
+            if rule in existing:
+                existing.discard(rule)
+                self._add_op(table, '-D', chain, rule)
+
+    def commit(self):
+        if not self._ops:
+            return
+        if not os.access(IPTABLES_RESTORE, os.X_OK):
+            LOG.debug('%s not found, applying rules one by one', IPTABLES_RESTORE)
+            self._commit_one_by_one()
+        else:
+            script = []
+            for table, lines in self._ops.items():
+                script.append('*%s' % table)
+                script.extend(' '.join(map(_quote, args)) for args in lines)
+                script.append('COMMIT')
+            linux.system(linux.build_cmd_args(executable=IPTABLES_RESTORE,
+                    long={'noflush': True}), stdin='\n'.join(script) + '\n')
+        self._ops.clear()
+        self._snapshots.clear()
+
+    def _commit_one_by_one(self):
+        for table, lines in self._ops.items():
+            for args in lines:
+                extra = ['--table', table] if table != 'filter' else []
+                linux.system([IPTABLES_BIN] + extra + args)
+
+    def _split_table(self, rule):
+        rule = copy(rule)
+        return rule.pop('table', None) or 'filter', rule
+
+    def _add_op(self, table, action, chain, rule):
+        self._ops.setdefault(table, []).append(
+                [action, chain] + _build_args(None, copy(rule)))
+
+    def _existing(self, table, chain):
+        if table not in self._snapshots:
+            self._snapshots[table] = _parse_save(iptables_save(table=table))
+        return self._snapshots[table].setdefault(chain, _RuleIndex())
+
+
+def _parse_save(output):
+    # iptables-save output -> {chain: _RuleIndex}
+    lines = {}
+    for line in (output or '').splitlines():
+        if line.startswith('-A '):
+            lines.setdefault(line.split()[1], []).append(line)
+    return dict((chain, _RuleIndex(_Chain(chain)._parse_list_rules('\n'.join(chain_lines))))
+                            for chain, chain_lines in lines.items())
+
+
+def _quote(arg):
+    if not arg or re.search(r'[\s"]', arg):
+        return '"%s"' % arg.replace('"', '\\"')
+    return arg
+
+
 def enabled():
     # amazon linux doesn't have iptables service installed by default,
     # which makes "chkconfig --list iptables" fail
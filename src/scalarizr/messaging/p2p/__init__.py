@@ -32,6 +32,8 @@ class P2pConfigOptions:
     PRODUCER_SENDER                                 = "producer_sender"
     CONSUMER_URL                                    = "consumer_url"
     MSG_HANDLER_ENABLED                             = 'msg_handler_enabled'
+    CONSUMER_WORKERS                                = 'consumer_workers'
+    CONSUMER_QUEUE_SIZE                             = 'consumer_queue_size'
 
 
 class P2pMessageService(MessageService):
@@ -53,7 +55,9 @@ class P2pMessageService(MessageService):
         if not self._default_consumer:
             self._default_consumer = self.new_consumer(
                     endpoint=self._params[P2pConfigOptions.CONSUMER_URL],
-                    msg_handler_enabled=self._params.get(P2pConfigOptions.MSG_HANDLER_ENABLED, True)
+                    msg_handler_enabled=self._params.get(P2pConfigOptions.MSG_HANDLER_ENABLED, True),
+                    workers=self._params.get(P2pConfigOptions.CONSUMER_WORKERS, 4),
+                    queue_size=self._params.get(P2pConfigOptions.CONSUMER_QUEUE_SIZE, 64)
             )
         return self._default_consumer
 
@@ -85,10 +89,14 @@ class _P2pMessageStore:
     _logger = None
 
     TAIL_LENGTH = 50
+    # Message ids per query in bulk operations (SQLite allows 999 variables)
+    BATCH_SIZE = 500
 
     def __init__(self):
         self._logger = logging.getLogger(__name__)
         self._local_storage_lock = threading.Lock()
+        self._ingoing_cond = threading.Condition(self._local_storage_lock)
+        self._ingoing_seq = 0
         ex = bus.periodical_executor
         if ex:
             self._logger.debug('Add rotate messages table task for periodical executor')
@@ -117,7 +125,8 @@ class _P2pMessageStore:
 
     def put_ingoing(self, message, queue, consumer_id):
         with self._local_storage_lock:
-            self._unhandled_messages.append((queue, message))
+            # Load unhandled messages before insert, to not get this one twice
+            self._unhandled_messages
 
         conn = self._conn()
         cur = conn.cursor()
@@ -144,16 +153,43 @@ class _P2pMessageStore:
         finally:
             cur.close()
 
+        with self._ingoing_cond:
+            self._unhandled_messages.append((queue, message))
+            self._notify_ingoing()
+
 
     def get_unhandled(self, consumer_id):
+        """
+        Return list of unhandled messages in obtaining order.
+        Messages are not copied, each one should be handled by a single consumer
+        """
         with self._local_storage_lock:
-            ret = []
-            for queue, message in self._unhandled_messages:
-                msg_copy = P2pMessage()
-                msg_copy.fromjson(message.tojson())
-                ret.append((queue, msg_copy))
+            return list(self._unhandled_messages)
 
-            return ret
+
+    def wait_ingoing(self, seq=None):
+        """
+        Block until ingoing message is put or notify_ingoing() called
+        after the store was in `seq` state. Returns immediately when `seq` is None
+        @return: current state to pass on the next call
+        """
+        with self._ingoing_cond:
+            while seq is not None and seq == self._ingoing_seq:
+                self._ingoing_cond.wait()
+            return self._ingoing_seq
+
+
+    def notify_ingoing(self):
+        """
+        Wake up all threads blocked in wait_ingoing()
+        """
+        with self._ingoing_cond:
+            self._notify_ingoing()
+
+
+    def _notify_ingoing(self):
+        self._ingoing_seq += 1
+        self._ingoing_cond.notify_all()
 
 
     def _get_unhandled_from_db(self):
@@ -161,16 +197,23 @@ class _P2pMessageStore:
         Return list of unhandled messages in obtaining order
         @return: [(queue, message), ...]
         """
+        return self._load_many('is_ingoing = ? AND in_is_handled = ?', [1, 0])
+
+
+    def _load_many(self, where, params):
+        """
+        Load messages matching condition with a single query
+        @return: [(queue, message), ...] in obtaining order
+        """
         cur = self._conn().cursor()
         try:
-            sql = 'SELECT queue, message_id FROM p2p_message ' \
-                'WHERE is_ingoing = ? AND in_is_handled = ? ' \
-                'ORDER BY id'
-            cur.execute(sql, [1, 0])
-
+            cur.execute('SELECT queue, message, format FROM p2p_message ' \
+                        'WHERE %s ORDER BY id' % where, params)
             ret = []
-            for r in cur.fetchall():
-                ret.append((r["queue"], self.load(r["message_id"], True)))
+            for row in cur.fetchall():
+                message = P2pMessage()
+                self._unmarshall(message, row)
+                ret.append((row["queue"], message))
             return ret
         finally:
             cur.close()
@@ -192,20 +235,42 @@ class _P2pMessageStore:
             self._logger.debug("Cant load message in several attempts, assume it doesn't exists. Leaving")
             return
 
+        self._update_handled([msg])
+
 
-        if 'platform_access_data' in msg.body:
-            del msg.body['platform_access_data']
-        msg_s = msg.tojson().decode('utf-8')
+    def mark_as_handled_many(self, message_ids):
+        """
+        Mark several messages as handled in one transaction.
+        Unlike mark_as_handled missing messages are silently skipped
+        """
+        message_ids = set(message_ids)
+        if not message_ids:
+            return
+        with self._local_storage_lock:
+            filter_fn = lambda x: x[1].id not in message_ids
+            self._unhandled = filter(filter_fn, self._unhandled_messages)
 
+        messages = []
+        ids = list(message_ids)
+        for i in xrange(0, len(ids), self.BATCH_SIZE):
+            batch = ids[i:i + self.BATCH_SIZE]
+            messages.extend(msg for _, msg in self._load_many(
+                            'message_id IN (%s) AND is_ingoing = ?' % ', '.join('?' * len(batch)),
+                            batch + [1]))
+        self._update_handled(messages)
+
+
+    def _update_handled(self, messages):
+        sql = 'UPDATE p2p_message SET in_is_handled = ?, message = ?, out_last_attempt_time = datetime("now")' \
+            'WHERE message_id = ? AND is_ingoing = ?'
+        params = []
+        for msg in messages:
+            if 'platform_access_data' in msg.body:
+                del msg.body['platform_access_data']
+            params.append([1, msg.tojson().decode('utf-8'), msg.id, 1])
         conn = self._conn()
-        cur = conn.cursor()
-        try:
-            sql = 'UPDATE p2p_message SET in_is_handled = ?, message = ?, out_last_attempt_time = datetime("now")' \
-                'WHERE message_id = ? AND is_ingoing = ?'
-            cur.execute(sql, [1, msg_s, message_id, 1])
-            conn.commit()
-        finally:
-            cur.close()
+        conn.executemany(sql, params)
+        conn.commit()
 
 
     def put_outgoing(self, message, queue, sender):
@@ -228,17 +293,8 @@ class _P2pMessageStore:
         """
         Return list of undelivered messages in outgoing order
         """
-        cur = self._conn().cursor()
-        try:
-            sql = 'SELECT queue, message_id FROM p2p_message ' \
-                    'WHERE is_ingoing = ? AND out_is_delivered = ? AND out_sender = ? ORDER BY id'
-            cur.execute(sql, [0, 0, sender])
-            ret = []
-            for r in cur.fetchall():
-                ret.append((r[0], self.load(r[1], False)))
-            return ret
-        finally:
-            cur.close()
+        return self._load_many('is_ingoing = ? AND out_is_delivered = ? AND out_sender = ?',
+                        [0, 0, sender])
 
     def mark_as_delivered(self, message_id):
         return self._mark_as_delivered(message_id, 1)
@@ -22,6 +22,8 @@ import sys
 import os
 import time
 import socket
+import select
+import Queue
 import HTMLParser
 
 class P2pMessageConsumer(MessageConsumer):
@@ -35,10 +37,20 @@ class P2pMessageConsumer(MessageConsumer):
     handler_status = 'stopped'
     handing_message_id = None
 
-    def __init__(self, endpoint=None, msg_handler_enabled=True):
+    keep_alive_timeout = 5
+    # Max time to wait for dispatched handler calls on shutdown
+    dispatch_shutdown_timeout = 120
+
+    def __init__(self, endpoint=None, msg_handler_enabled=True, workers=4, queue_size=64):
+        '''
+        @param workers: Number of HTTP server threads. 0 - serve requests one by one
+        @param queue_size: Max number of accepted connections waiting for a free server thread
+        '''
         MessageConsumer.__init__(self)
         self._logger = logging.getLogger(__name__)
         self.endpoint = endpoint
+        self.workers = int(workers)
+        self.queue_size = int(queue_size)
 
         if msg_handler_enabled:
             self._handler_thread = threading.Thread(name='MessageHandler', target=self.message_handler)
@@ -46,6 +58,9 @@ class P2pMessageConsumer(MessageConsumer):
             self._handler_thread = None
         self.message_to_ack = None
         self.ack_event = threading.Event()
+        # Messages with handler calls still running in the dispatch pool
+        self._pending_ids = set()
+        self._pending_lock = threading.Lock()
         #self._not_empty = threading.Event()
 
     def start(self):
@@ -66,7 +81,12 @@ class P2pMessageConsumer(MessageConsumer):
                 STATE['global.msg_port'] = msg_port
                 self._logger.info('Building message consumer server on %s:%s', r.hostname, msg_port)
                 #server_class = HTTPServer if sys.version_info >= (2,6) else _HTTPServer25
-                self._server = HTTPServer((r.hostname, msg_port), self._get_request_handler_class())
+                if self.workers:
+                    self._server = _ThreadPoolHTTPServer((r.hostname, msg_port),
+                                    self._get_request_handler_class(), self.workers,
+                                    self.queue_size, self.keep_alive_timeout)
+                else:
+                    self._server = HTTPServer((r.hostname, msg_port), self._get_request_handler_class())
         except (BaseException, Exception), e:
             self._logger.error("Cannot build server on port %s. %s", msg_port, e)
             return
@@ -81,13 +101,22 @@ class P2pMessageConsumer(MessageConsumer):
             self._logger.exception(e)
 
     def _get_request_handler_class(self):
-        class RequestHandler(BaseHTTPRequestHandler):
+        base = _KeepAliveRequestHandler if self.workers else BaseHTTPRequestHandler
+
+        class RequestHandler(base):
             consumer = None
             '''
             @cvar consumer: Message consumer instance
             @type consumer: P2pMessageConsumer
             '''
 
+            def _respond(self, code, message=None):
+                if message:
+                    message = ' '.join(str(message).split())
+                self.send_response(code, message)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
             def do_POST(self):
                 logger = logging.getLogger(__name__)
 
@@ -108,7 +137,7 @@ class P2pMessageConsumer(MessageConsumer):
                 except (BaseException, Exception), e:
                     err = 'Message consumer protocol filter raises exception: %s' % str(e)
                     logger.info(err)  # Downshift level, cause HTTP scanners do a lot of flood
-                    self.send_response(400, str(e))
+                    self._respond(400, e)
                     return
 
                 try:
@@ -122,18 +151,19 @@ class P2pMessageConsumer(MessageConsumer):
                     else:
                         message.fromxml(rawmsg)
 
-                    # Create a message copy to log it without platform_access_data and with pretty identation  
-                    msg_copy = P2pMessage(message.name, message.meta.copy(), message.body.copy())
-                    msg_copy.id = message.id
-                    if 'platform_access_data' in msg_copy.body:
-                        del msg_copy.body['platform_access_data']
-                    logger.debug('Decoding message: %s', msg_copy.tojson(indent=4))
+                    if logger.isEnabledFor(logging.DEBUG):
+                        # Create a message copy to log it without platform_access_data and with pretty identation  
+                        msg_copy = P2pMessage(message.name, message.meta.copy(), message.body.copy())
+                        msg_copy.id = message.id
+                        if 'platform_access_data' in msg_copy.body:
+                            del msg_copy.body['platform_access_data']
+                        logger.debug('Decoding message: %s', msg_copy.tojson(indent=4))
 
 
                 except (BaseException, Exception), e:
                     err = "Cannot decode message. error: %s; raw message: %s" % (str(e), rawmsg)
                     logger.exception(err)
-                    self.send_response(400, err)
+                    self._respond(400, err)
                     return
 
 
@@ -146,11 +176,10 @@ class P2pMessageConsumer(MessageConsumer):
                     #self.consumer._not_empty.set()
                 except (BaseException, Exception), e:
                     logger.exception(e)
-                    self.send_response(500, str(e))
+                    self._respond(500, e)
                     return
 
-                self.send_response(201, 'Created')
-                self.end_headers()
+                self._respond(201, 'Created')
 
 
             def log_message(self, format, *args):
@@ -163,7 +192,9 @@ class P2pMessageConsumer(MessageConsumer):
     def shutdown(self, force=False):
         self._logger.debug('entring shutdown _server: %s, running: %s', self._server, self.running)
         self.running = False
+        P2pMessageStore().notify_ingoing()
         if not self._server:
+            self._shutdown_listeners()
             return
 
         self._logger.debug('Shutdown message consumer %s ...', self.endpoint)
@@ -192,27 +223,75 @@ class P2pMessageConsumer(MessageConsumer):
             self._handler_thread.join()
             self._logger.debug("Message handler terminated")
 
+        self._shutdown_listeners()
         self._logger.debug('Message consumer %s terminated', self.endpoint)
 
+    def _shutdown_listeners(self):
+        # Complete handler calls dispatched by listeners. Messages of unfinished ones
+        # stay unhandled in the store and are delivered again after restart
+        for ln in self.listeners:
+            if hasattr(ln, 'shutdown'):
+                self._logger.debug('Waiting for dispatched handlers of %s', ln)
+                ln.shutdown(timeout=self.dispatch_shutdown_timeout)
+
     def _handle_one_message(self, message, queue, store):
+        '''
+        Returns handler calls of the message still running in listeners' dispatch pools
+        '''
+        pending = []
         try:
             self.handler_status = 'running'
             self._logger.debug('Notify message listeners (message_id: %s)', message.id)
             self.handing_message_id = message.id
             for ln in list(self.listeners):
-                ln(message, queue)
+                ret = ln(message, queue)
+                if ret is not None:
+                    pending.append(ret)
         except (BaseException, Exception), e:
             self._logger.exception(e)
         finally:
-            self._logger.debug('Mark message (message_id: %s) as handled', message.id)
-            store.mark_as_handled(message.id)
+            if pending:
+                # Message stays unhandled in the store until dispatched
+                # handlers finished, so it's delivered again after restart
+                self._mark_when_done(message, pending, store)
+            else:
+                self._logger.debug('Mark message (message_id: %s) as handled', message.id)
+                store.mark_as_handled(message.id)
             self.handler_status = 'idle'
             self.handing_message_id = None
+        return pending
+
+    def _mark_when_done(self, message, pending, store):
+        left = [len(pending)]
+        with self._pending_lock:
+            self._pending_ids.add(message.id)
+
+        def done():
+            with self._pending_lock:
+                left[0] -= 1
+                if left[0]:
+                    return
+            try:
+                self._logger.debug('Mark message (message_id: %s) as handled', message.id)
+                store.mark_as_handled(message.id)
+            finally:
+                with self._pending_lock:
+                    self._pending_ids.discard(message.id)
+
+        for calls in pending:
+            calls.then(done)
+
+    def _unhandled(self, store):
+        with self._pending_lock:
+            return [(queue, message) for queue, message in store.get_unhandled(self.endpoint)
+                            if message.id not in self._pending_ids]
 
     def wait_acknowledge(self, message):
         self.message_to_ack = message
         self.return_on_ack = False
         self.ack_event.clear()
+        # Acknowledge may be already received
+        P2pMessageStore().notify_ingoing()
         self._logger.debug('Waiting message acknowledge event: %s', message.name)
         self.ack_event.wait()
         self._logger.debug('Fired message acknowledge event: %s', message.name)
@@ -242,32 +321,170 @@ class P2pMessageConsumer(MessageConsumer):
 
         self._logger.debug('Starting message handler')
 
+        seq = None
         while self.running:
-            if not self.handler_locked:
-                try:
-                    if self.message_to_ack:
-                        for queue, message in store.get_unhandled(self.endpoint):
-                            sid = self.message_to_ack.meta['server_id']
-                            if message.name == self.message_to_ack.name and \
-                                            message.body.get('server_id', sid) == sid:
-                                self._logger.debug('Going to handle_one_message. Thread: %s', threading.currentThread().getName())
-                                self._handle_one_message(message, queue, store)
-                                self._logger.debug('Completed handle_one_message. Thread: %s', threading.currentThread().getName())
-
-                                self.message_to_ack = None
-                                self.ack_event.set()
-                                if self.return_on_ack:
-                                    return
-                                break
-                        time.sleep(0.1)
-                        continue
-
-                    for queue, message in store.get_unhandled(self.endpoint):
-                        self._handle_one_message(message, queue, store)
-
-                except (BaseException, Exception), e:
-                    self._logger.exception(e)
-            time.sleep(0.1)
+            # Sleep until new message is received or consumer state is changed
+            seq = store.wait_ingoing(seq)
+            if self.handler_locked or not self.running:
+                continue
+            try:
+                if self.message_to_ack:
+                    for queue, message in self._unhandled(store):
+                        sid = self.message_to_ack.meta['server_id']
+                        if message.name == self.message_to_ack.name and \
+                                        message.body.get('server_id', sid) == sid:
+                            self._logger.debug('Going to handle_one_message. Thread: %s', threading.currentThread().getName())
+                            pending = self._handle_one_message(message, queue, store)
+                            # Waiter expects all handlers of the message to be completed
+                            for calls in pending:
+                                calls.wait()
+                            self._logger.debug('Completed handle_one_message. Thread: %s', threading.currentThread().getName())
+
+                            self.message_to_ack = None
+                            self.ack_event.set()
+                            if self.return_on_ack:
+                                return
+                            # Handle messages received while waiting for acknowledge
+                            seq = None
+                            break
+                    continue
+
+                for queue, message in self._unhandled(store):
+                    self._handle_one_message(message, queue, store)
+
+            except (BaseException, Exception), e:
+                self._logger.exception(e)
+                seq = None
+                time.sleep(0.1)
 
         self.handler_status = 'stopped'
         self._logger.debug('Message handler stopped')
+
+
+class _KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP/1.1 request handler for _ThreadPoolHTTPServer.
+    Handles one request per call, server keeps idle connection open
+    and passes it back to a thread when the next request arrives.
+    '''
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+
+class _ThreadPoolHTTPServer(HTTPServer):
+    '''
+    HTTP server that handles requests in a fixed set of threads.
+    Requests wait for a free thread in a bounded queue, when the queue is full
+    client gets 503 with Retry-After header.
+    Idle keep-alive connections don't hold threads: they are watched with select()
+    and closed after keep_alive_timeout seconds.
+    '''
+    retry_after = 1
+
+    def __init__(self, server_address, handler_class, workers, queue_size, keep_alive_timeout=5):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self._logger = logging.getLogger(__name__)
+        self.keep_alive_timeout = keep_alive_timeout
+        self._requests = Queue.Queue(queue_size)
+        self._idle = {}
+        self._idle_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._stopped = False
+        self._workers = [self._start_thread('MessageConsumer-%d' % i, self._worker)
+                        for i in range(workers)]
+        self._poller = self._start_thread('MessageConsumerIdle', self._poll_idle)
+
+    def _start_thread(self, name, target):
+        t = threading.Thread(name=name, target=target)
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except Queue.Full:
+            self._logger.warning('Message consumer is busy, rejecting request from %s', client_address[0])
+            try:
+                request.sendall('HTTP/1.1 503 Service Unavailable\r\n'
+                                'Retry-After: %d\r\n'
+                                'Content-Length: 0\r\n'
+                                'Connection: close\r\n\r\n' % self.retry_after)
+            except socket.error:
+                pass
+            self._close(request)
+
+    def shutdown(self):
+        HTTPServer.shutdown(self)
+        with self._idle_lock:
+            self._stopped = True
+            os.write(self._wakeup_w, 'x')
+        for _ in self._workers:
+            self._requests.put(None)
+        self._poller.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            keep_alive = False
+            try:
+                handler = self.RequestHandlerClass(request, client_address, self)
+                keep_alive = not handler.close_connection
+            except:
+                self.handle_error(request, client_address)
+            if keep_alive:
+                with self._idle_lock:
+                    if not self._stopped:
+                        self._idle[request] = (client_address, time.time())
+                        os.write(self._wakeup_w, 'x')
+                        continue
+            self._close(request)
+
+    def _poll_idle(self):
+        while not self._stopped:
+            with self._idle_lock:
+                socks = self._idle.keys()
+            try:
+                readable = select.select(socks + [self._wakeup_r], [], [], 1)[0]
+            except (select.error, socket.error), e:
+                self._logger.debug('select() failed: %s', e)
+                readable = []
+            now = time.time()
+            expired = []
+            with self._idle_lock:
+                for sock in readable:
+                    if sock == self._wakeup_r:
+                        os.read(self._wakeup_r, 1024)
+                    elif sock in self._idle:
+                        # Next request or EOF, both are handled in server thread
+                        client_address = self._idle.pop(sock)[0]
+                        self.process_request(sock, client_address)
+                for sock, (_, since) in self._idle.items():
+                    if now - since > self.keep_alive_timeout:
+                        del self._idle[sock]
+                        expired.append(sock)
+            for sock in expired:
+                self._close(sock)
+
+        with self._idle_lock:
+            for sock in self._idle:
+                self._close(sock)
+            self._idle.clear()
+
+    def _close(self, request):
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.close_request(request)
@@ -9,7 +9,12 @@ import logging
 import threading
 import time
 import uuid
+import socket
+import urllib
 import urllib2
+import httplib
+import urlparse
+import collections
 
 from scalarizr import messaging, util
 from scalarizr.bus import bus
@@ -19,11 +24,77 @@ from scalarizr.node import __node__
 import sys
 
 
+class _HTTPConnectionPool(object):
+    '''
+    Keeps idle HTTP(S) keep-alive connections to a single endpoint for reuse
+    '''
+
+    def __init__(self, endpoint, size=4, timeout=60):
+        self.endpoint = endpoint
+        r = urlparse.urlparse(endpoint)
+        self.connection_class = httplib.HTTPSConnection if r.scheme == 'https' else httplib.HTTPConnection
+        self.host = r.hostname
+        self.port = r.port
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def post(self, url, data, headers):
+        '''
+        @return: (status, reason, response headers)
+        '''
+        path = urlparse.urlparse(url)[2] or '/'
+        with self._lock:
+            conn = self._idle and self._idle.pop() or None
+        if conn:
+            try:
+                resp = self._post(conn, path, data, headers)
+            except (httplib.BadStatusLine, socket.error):
+                # Server closed idle connection
+                conn.close()
+                conn = None
+        if not conn:
+            conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+            resp = self._post(conn, path, data, headers)
+
+        if resp.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn:
+                conn.close()
+        return resp.status, resp.reason, resp.msg
+
+    def _post(self, conn, path, data, headers):
+        try:
+            conn.request('POST', path, data, headers)
+            resp = conn.getresponse()
+            resp.read()
+            return resp
+        except:
+            conn.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
 class P2pMessageProducer(messaging.MessageProducer):
     endpoint = None
     retries_progression = None
     no_retry = False
     sender = 'daemon'
+    async_messages = ('Log', 'OperationDefinition', 'OperationProgress', 'OperationResult')
+    '''
+    Messages delivered by background thread after start() was called
+    '''
     _store = None
     _logger = None
     _stop_delivery = None
@@ -43,8 +114,37 @@ class P2pMessageProducer(messaging.MessageProducer):
         self._local = threading.local()
         self._local_defaults = dict(interval=None, next_retry_index=0, delivered=False)
 
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._outbox = collections.deque()
+        self._outbox_cond = threading.Condition()
+        self._delivery_thread = None
+
+    def start(self):
+        '''
+        Start background delivery of async_messages.
+        Undelivered messages from the previous run are queued first.
+        '''
+        if self.no_retry or self._delivery_thread:
+            return
+        self._stop_delivery.clear()
+        with self._outbox_cond:
+            self._outbox.extend((queue, message)
+                            for queue, message in self._store.get_undelivered(self.sender)
+                            if message.name in self.async_messages)
+        self._delivery_thread = threading.Thread(name='MessageDelivery', target=self._deliver)
+        self._delivery_thread.setDaemon(True)
+        self._delivery_thread.start()
+
     def shutdown(self):
         self._stop_delivery.set()
+        with self._outbox_cond:
+            self._outbox_cond.notify()
+        if self._delivery_thread:
+            self._delivery_thread.join(10)
+            self._delivery_thread = None
+        if self._pool:
+            self._pool.close()
 
     def send(self, queue, message):
         self._logger.debug("Sending message '%s' into queue '%s'", message.name, queue)
@@ -54,6 +154,12 @@ class P2pMessageProducer(messaging.MessageProducer):
         self.fire("before_send", queue, message)
         self._store.put_outgoing(message, queue, self.sender)
 
+        if self._delivery_thread and message.name in self.async_messages:
+            with self._outbox_cond:
+                self._outbox.append((queue, message))
+                self._outbox_cond.notify()
+            return
+
         if not self.no_retry:
             if not hasattr(self._local, "interval"):
                 for k, v in self._local_defaults.items():
@@ -79,6 +185,47 @@ class P2pMessageProducer(messaging.MessageProducer):
             self._send0(queue, message, self._delivered_cb, self._undelivered_cb_raises)
 
 
+    def _get_pool(self):
+        # Endpoint may be changed after producer was created
+        with self._pool_lock:
+            if not self._pool or self._pool.endpoint != self.endpoint:
+                if self._pool:
+                    self._pool.close()
+                self._pool = _HTTPConnectionPool(self.endpoint)
+            return self._pool
+
+    def _use_proxy(self):
+        r = urlparse.urlparse(self.endpoint)
+        return r.scheme in urllib.getproxies() and not urllib.proxy_bypass(r.hostname)
+
+    def _deliver(self):
+        next_retry_index = 0
+        while True:
+            with self._outbox_cond:
+                while not self._outbox and not self._stop_delivery.isSet():
+                    self._outbox_cond.wait()
+                if not self._outbox:
+                    return
+                # Messages are sent one by one in the same order over a kept-alive connection
+                queue, message = self._outbox[0]
+
+            result = []
+            self._send0(queue, message,
+                            lambda queue, message: result.append(True),
+                            lambda queue, message, ex: None)
+            if result:
+                with self._outbox_cond:
+                    self._outbox.popleft()
+                next_retry_index = 0
+            elif self._stop_delivery.isSet():
+                # Message stays undelivered in store and will be sent after restart
+                return
+            else:
+                interval = int(self.retries_progression[next_retry_index]) * 60.0
+                next_retry_index = min(next_retry_index + 1, len(self.retries_progression) - 1)
+                self._logger.debug("Sleep %d seconds before next delivery attempt", interval)
+                self._stop_delivery.wait(interval)
+
     def _undelivered_cb_raises(self, queue, message, ex):
         raise ex
 
@@ -111,9 +258,19 @@ class P2pMessageProducer(messaging.MessageProducer):
                 data = f(self, queue, data, headers)
 
             url = self.endpoint + "/" + queue
-            req = urllib2.Request(url, data, headers)
-            opener = urllib2.build_opener(urltool.HTTPRedirectHandler())
-            opener.open(req)
+            status = None
+            if not self._use_proxy():
+                try:
+                    status, reason, resp_headers = self._get_pool().post(url, data, headers)
+                except (socket.error, httplib.HTTPException), e:
+                    raise urllib2.URLError(e)
+                if not 200 <= status < 400:
+                    raise urllib2.HTTPError(url, status, reason, resp_headers, None)
+            if status is None or status >= 300:
+                # Proxies and redirects are handled by urllib2
+                req = urllib2.Request(url, data, headers)
+                opener = urllib2.build_opener(urltool.HTTPRedirectHandler())
+                opener.open(req)
 
             self._message_delivered(queue, message, success_callback)
 
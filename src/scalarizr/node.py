@@ -4,6 +4,7 @@ import os
 import re
 import ConfigParser
 import sys
+import threading
 try:
     import json
 except ImportError:
@@ -20,6 +21,51 @@ public_dir = os.path.join(base_dir, 'public.d')
 storage_dir = os.path.join(base_dir, 'storage')
 
 
+class _FileCache(object):
+    '''
+    Parsed file contents shared by Ini and File stores.
+    Entry is valid while mtime, inode and size of its files stay the same.
+    Stores invalidate entries when they write files themselves.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, filenames, parse):
+        '''
+        @param kind: Parser name, files are cached separately for each parser
+        @param filenames: Tuple of file names
+        @param parse: Callable that takes filenames and returns parsed value
+        '''
+        key = (kind, filenames)
+        sig = tuple(self._stat(filename) for filename in filenames)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == sig:
+            return entry[1]
+        value = parse(filenames)
+        with self._lock:
+            self._entries[key] = (sig, value)
+        return value
+
+    def invalidate(self, filename):
+        with self._lock:
+            for key in self._entries.keys():
+                if filename in key[1]:
+                    del self._entries[key]
+
+    def _stat(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_ino, st.st_size)
+
+
+_file_cache = _FileCache()
+
+
 class Store(dict):
     def __len__(self):
         return 1
@@ -48,6 +94,7 @@ class Store(dict):
 class Compound(Store):
     def __init__(self, patterns=None):
         self.__re_map = {}
+        self.__re_matches = {}
         self.__plain_map = {}
         patterns = patterns or {}
         for pattern, store in patterns.items():
@@ -85,9 +132,17 @@ class Compound(Store):
         if key in self.__plain_map:
             return self.__plain_map[key]
         else:
-            for rkey, store in self.__re_map.items():
-                if rkey.match(key):
-                    return store
+            # Patterns are fixed, so match result for each key is remembered
+            try:
+                return self.__re_matches[key]
+            except KeyError:
+                match = None
+                for rkey, store in self.__re_map.items():
+                    if rkey.match(key):
+                        match = store
+                        break
+                self.__re_matches[key] = match
+                return match
 
 
 
@@ -148,7 +203,7 @@ class Ini(Store):
 
 
     def __getitem__(self, key):
-        self._reload()
+        self.ini = _file_cache.get('ini', tuple(self.filenames), _read_ini)
         if key in self.mapping:
             key = self.mapping[key]
         try:
@@ -172,6 +227,7 @@ class Ini(Store):
         self.ini.set(self.section, key, value)
         with open(self.filenames[0], 'w+') as fp:
             self.ini.write(fp)
+        _file_cache.invalidate(self.filenames[0])
 
 
 class IniOption(Ini):
@@ -203,8 +259,7 @@ class File(Store):
 
     def __getitem__(self, key):
         try:
-            with open(self.filename) as fp:
-                return fp.read().strip()
+            return _file_cache.get('file', (self.filename, ), _read_file)
         except:
             raise KeyError(key)
 
@@ -212,6 +267,7 @@ class File(Store):
     def __setitem__(self, key, value):
         with open(self.filename, 'w+') as fp:
             fp.write(str(value).strip())
+        _file_cache.invalidate(self.filename)
 
 
 class BoolFile(Store):
@@ -274,6 +330,19 @@ class Call(Attr):
         return attr()   
 
 
+def _read_ini(filenames):
+    ini = ConfigParser.ConfigParser()
+    for filename in filenames:
+        if os.path.exists(filename):
+            ini.read(filename)
+    return ini
+
+
+def _read_file(filenames):
+    with open(filenames[0]) as fp:
+        return fp.read().strip()
+
+
 def _import(objectstr):
     try:
         __import__(objectstr)
@@ -371,7 +440,8 @@ __node__['ec2'] = Compound({
         'avail_zone': Call('scalarizr.bus', 'bus.platform.get_avail_zone'),
         'region': Call('scalarizr.bus', 'bus.platform.get_region'),
         'connect_ec2': Attr('scalarizr.bus', 'bus.platform.new_ec2_conn'),
-        'connect_s3': Attr('scalarizr.bus', 'bus.platform.new_s3_conn')
+        'connect_s3': Attr('scalarizr.bus', 'bus.platform.new_s3_conn'),
+        'invalidate_metadata': Attr('scalarizr.bus', 'bus.platform.invalidate_metadata')
 })
 __node__['cloudstack'] = Compound({
         'new_conn': Call('scalarizr.bus', 'bus.platform.new_cloudstack_conn'),
@@ -7,9 +7,14 @@ Created on Dec 24, 2009
 
 import os
 import re
+import time
 import socket
 import urllib2
+import httplib
+import urlparse
 import logging
+import threading
+import Queue
 import platform
 import sys
 import struct
@@ -63,6 +68,100 @@ class PlatformFeatures:
     SNAPSHOTS       = 'snapshots'
 
 
+class ConnectionPool(object):
+    '''
+    Cloud API connections keyed by (service, region, credentials).
+
+    Connection is used by one thread at a time: it's bound to the thread that got it
+    and goes back to the pool on release(), so short-lived worker threads
+    reuse connections too. Connections of a thread that exited without release()
+    go back when its locals are collected. Connection is recreated after max_age seconds
+    or when it was discarded. invalidate() drops all connections.
+    '''
+    max_age = 3600
+    max_idle = 8
+
+    def __init__(self):
+        self._local = threading.local()
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key, factory):
+        '''
+        @param key: Hashable (service, region, credentials) tuple
+        @param factory: Callable that creates new connection
+        '''
+        owned = self._owned()
+        entry = owned.conns.get(key)
+        if not self._valid(entry):
+            entry = self._checkout(key)
+            if not entry:
+                entry = (factory(), time.time(), self._generation)
+            owned.conns[key] = entry
+        return entry[0]
+
+    def discard(self, conn):
+        '''
+        Drop broken connection, next get() will create a new one
+        '''
+        owned = self._owned()
+        for key, entry in owned.conns.items():
+            if entry[0] is conn:
+                del owned.conns[key]
+
+    def release(self):
+        '''
+        Return connections of the current thread to the pool.
+        Worker threads call it before exit
+        '''
+        owned = getattr(self._local, 'owned', None)
+        if owned and owned.conns:
+            conns, owned.conns = owned.conns, {}
+            self._release(conns)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._idle.clear()
+
+    def _owned(self):
+        try:
+            return self._local.owned
+        except AttributeError:
+            self._local.owned = _OwnedConnections(self)
+            return self._local.owned
+
+    def _valid(self, entry):
+        return entry and entry[2] == self._generation and \
+                        time.time() - entry[1] < self.max_age
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                entry = idle.pop()
+                if self._valid(entry):
+                    return entry
+
+    def _release(self, conns):
+        with self._lock:
+            for key, entry in conns.items():
+                idle = self._idle.setdefault(key, [])
+                if self._valid(entry) and len(idle) < self.max_idle:
+                    idle.append(entry)
+
+
+class _OwnedConnections(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.conns = {}
+
+    def __del__(self):
+        # Thread exited, it's connections can be used by others
+        self.pool._release(self.conns)
+
+
 class Platform():
     name = None
     _arch = None
@@ -75,6 +174,7 @@ class Platform():
     def __init__(self):
         self.scalrfs = self._scalrfs(self)
         self._access_data = {} 
+        self._connection_pool = ConnectionPool()
 
     def get_private_ip(self):
         return self.get_public_ip()
@@ -99,6 +199,9 @@ class Platform():
             return self._userdata
 
     def set_access_data(self, access_data):
+        if access_data != self._access_data:
+            # Credentials were changed, drop connections created with old ones
+            self._connection_pool.invalidate()
         self._access_data = access_data
 
     def get_access_data(self, prop=None):
@@ -113,6 +216,12 @@ class Platform():
     def clear_access_data(self):
         self._access_data = {}
 
+    def release_connections(self):
+        '''
+        Return cloud API connections of the current thread to the pool
+        '''
+        self._connection_pool.release()
+
     def get_architecture(self):
         """
         @return Architectures
@@ -201,24 +310,184 @@ class Platform():
                 return os.path.join(self.root(), '%s-backup' % service)
 
 
+class MetadataClient(object):
+    '''
+    Client for EC2-compatible instance metadata service.
+
+    Requests are sent over a kept-alive connection (one per thread).
+    Values are cached: keys that start with one of the volatile prefixes
+    expire after volatile_ttl seconds, others are kept until invalidate().
+    prefetch() walks the whole metadata tree with several threads
+    and fills the cache in one sweep.
+    '''
+    volatile_ttl = 60
+    prefetch_threads = 4
+
+    def __init__(self, url, volatile=None, timeout=10):
+        self.url = url
+        r = urlparse.urlparse(url)
+        self.host = r.hostname
+        self.port = r.port
+        self.path = r.path or '/'
+        self.volatile = tuple(volatile or ())
+        self.timeout = timeout
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and (entry[1] is None or entry[1] > time.time()):
+            return entry[0]
+        value = self.fetch(key)
+        self._put(key, value)
+        return value
+
+    def fetch(self, key):
+        '''
+        Get value bypassing cache.
+        @return: Value or empty string when key doesn't exists
+        @raise PlatformError: When metadata service failed
+        '''
+        status, reason, body = self._request(key)
+        if status == 404:
+            return ''
+        if status != 200:
+            raise PlatformError("Cannot fetch metadata url '%s'. Error: HTTP Error %s: %s" % (
+                            self.url + key, status, reason))
+        return body.strip()
+
+    def invalidate(self, prefix=''):
+        with self._lock:
+            for key in self._cache.keys():
+                if key.startswith(prefix):
+                    del self._cache[key]
+
+    def prefetch(self, root, exclude=None):
+        '''
+        Fetch all values under root directory (e.g. 'latest/meta-data/')
+        '''
+        exclude = tuple(exclude or ())
+        keys = Queue.Queue()
+        keys.put(root)
+        errors = []
+
+        def worker():
+            while True:
+                key = keys.get()
+                try:
+                    if key is None:
+                        return
+                    value = self.fetch(key)
+                    if key.endswith('/'):
+                        for name in value.splitlines():
+                            if '=' in name:
+                                # public-keys/ lists '0=keyname', values are under '0/'
+                                name = name.split('=', 1)[0] + '/'
+                            child = key + name
+                            if not child.startswith(exclude):
+                                keys.put(child)
+                        # Directory listing is also available without trailing slash
+                        self._put(key.rstrip('/'), value)
+                    else:
+                        self._put(key, value)
+                except (BaseException, Exception), e:
+                    errors.append(e)
+                finally:
+                    keys.task_done()
+
+        threads = [threading.Thread(target=worker, name='MetadataPrefetch-%d' % i)
+                        for i in range(self.prefetch_threads)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        keys.join()
+        for _ in threads:
+            keys.put(None)
+        if errors:
+            raise errors[0]
+
+    def _put(self, key, value):
+        expires = None
+        if key.startswith(self.volatile):
+            expires = time.time() + self.volatile_ttl
+        with self._lock:
+            self._cache[key] = (value, expires)
+
+    def _request(self, key):
+        path = self.path + key
+        conn = getattr(self._local, 'conn', None)
+        if conn:
+            try:
+                return self._request0(conn, path)
+            except (httplib.HTTPException, socket.error):
+                # Server closed idle connection
+                pass
+        conn = self._local.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            return self._request0(conn, path)
+        except (httplib.HTTPException, socket.error), e:
+            raise PlatformError("Cannot fetch metadata url '%s'. Error: %s" % (self.url + key, e))
+
+    def _request0(self, conn, path):
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            body = resp.read()
+        except:
+            conn.close()
+            self._local.conn = None
+            raise
+        if resp.will_close:
+            conn.close()
+            self._local.conn = None
+        return resp.status, resp.reason, body
+
+
 class Ec2LikePlatform(Platform):
 
     _meta_url = "http://169.254.169.254/"
     _userdata_key = 'latest/user-data'
     _metadata_key = 'latest/meta-data'
-    _metadata = {}
+    _volatile_properties = ('block-device-mapping', 'public-ipv4', 'public-hostname',
+                    'network/', 'iam/')
     _userdata = None
+    _metadata_client = None
 
     def __init__(self):
         Platform.__init__(self)
         self._logger = logging.getLogger(__name__)
         self._cnf = bus.cnf
 
+    @property
+    def metadata(self):
+        '''
+        @rtype: MetadataClient
+        '''
+        # Metadata url can be changed after platform was created
+        if not self._metadata_client or self._metadata_client.url != self._meta_url:
+            self._metadata_client = MetadataClient(self._meta_url,
+                            ['%s/%s' % (self._metadata_key, name) for name in self._volatile_properties])
+        return self._metadata_client
+
+    def prefetch_metadata(self):
+        '''
+        Load all metadata with a few concurrent requests
+        '''
+        try:
+            self.metadata.prefetch(self._metadata_key + '/', exclude=[self._metadata_key + '/iam/'])
+        except (BaseException, Exception), e:
+            self._logger.debug('Cannot prefetch %s metadata: %s', self.name, e)
+
+    def invalidate_metadata(self, name=''):
+        '''
+        Drop cached metadata property (or properties that start with name)
+        '''
+        self.metadata.invalidate(self._metadata_key + '/' + name)
+
     def _get_property(self, name):
-        if not self._metadata.has_key(name):
-            full_name = self._metadata_key + "/" + name
-            self._metadata[name] = self._fetch_metadata(full_name)
-        return self._metadata[name]
+        return self.metadata.get(self._metadata_key + "/" + name)
 
     def get_user_data(self, key=None):
         if self._userdata is None:
@@ -230,15 +499,10 @@ class Ec2LikePlatform(Platform):
             return self._userdata
 
     def _fetch_metadata(self, key):
-        url = self._meta_url + key
         try:
-            r = urllib2.urlopen(url)
-            return r.read().strip()
-        except IOError, e:
-            if isinstance(e, urllib2.HTTPError):
-                if e.code == 404:
-                    return ""
-            raise PlatformError("Cannot fetch %s metadata url '%s'. Error: %s" % (self.name, url, e))
+            return self.metadata.fetch(key)
+        except PlatformError, e:
+            raise PlatformError("Cannot fetch %s metadata. %s" % (self.name, e))
 
     def get_private_ip(self):
         return self._get_property("local-ipv4")
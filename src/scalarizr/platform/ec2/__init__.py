@@ -77,17 +77,21 @@ class Ec2Platform(Ec2LikePlatform):
     def new_ec2_conn(self):
         """ @rtype: boto.ec2.connection.EC2Connection """
         region = self.get_region()
-        self._logger.debug("Return ec2 connection (region: %s)", region)  
         key_id, key = self.get_access_keys()
-        return boto.ec2.connect_to_region(region, aws_access_key_id=key_id, aws_secret_access_key=key)
+        def connect():
+            self._logger.debug("Return ec2 connection (region: %s)", region)  
+            return boto.ec2.connect_to_region(region, aws_access_key_id=key_id, aws_secret_access_key=key)
+        return self._connection_pool.get(('ec2', region, key_id, key), connect)
 
 
     def new_s3_conn(self):
         region = self.get_region()
         endpoint = self._s3_endpoint(region)
         key_id, key = self.get_access_keys()
-        self._logger.debug("Return s3 connection (endpoint: %s)", endpoint)
-        return boto.connect_s3(host=endpoint, aws_access_key_id=key_id, aws_secret_access_key=key)
+        def connect():
+            self._logger.debug("Return s3 connection (endpoint: %s)", endpoint)
+            return boto.connect_s3(host=endpoint, aws_access_key_id=key_id, aws_secret_access_key=key)
+        return self._connection_pool.get(('s3', endpoint, key_id, key), connect)
 
 
     @property
@@ -133,7 +133,9 @@ class EucaPlatform(Ec2Platform):
                     region = RegionInfo(name='euca', endpoint=u.hostname)
             )
 
-        return boto.connect_ec2(*self.get_access_keys(), **self._ec2_conn_params)
+        keys = self.get_access_keys()
+        return self._connection_pool.get(('ec2', self._cnf.rawini.get(self.name, OPT_EC2_URL)) + keys,
+                        lambda: boto.connect_ec2(*keys, **self._ec2_conn_params))
 
     def new_s3_conn(self):
         ''' @rtype: boto.ec2.connection.S3Connection '''
@@ -151,4 +153,6 @@ class EucaPlatform(Ec2Platform):
                     calling_format = OrdinaryCallingFormat()
             )
 
-        return boto.connect_s3(*self.get_access_keys(), **self._s3_conn_params)
+        keys = self.get_access_keys()
+        return self._connection_pool.get(('s3', self._cnf.rawini.get(self.name, OPT_S3_URL)) + keys,
+                        lambda: boto.connect_s3(*keys, **self._s3_conn_params))
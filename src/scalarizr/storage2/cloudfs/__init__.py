@@ -15,7 +15,9 @@ import time
 import hashlib
 import uuid
 import errno
+import random
 from copy import copy
+from collections import deque
 if sys.version_info[0:2] >= (2, 7):
     from collections import OrderedDict
 else:
@@ -26,8 +28,10 @@ except ImportError:
     import simplejson as json
 
 from scalarizr import storage2
+from scalarizr.bus import bus
 from scalarizr.libs import bases
 from scalarizr.linux import coreutils, pkgmgr, LinuxError
+from scalarizr.storage2.cloudfs.base import DriverError, MemoryChunk, source_size, source_name
 
 
 LOG = logging.getLogger(__name__)
@@ -93,6 +97,175 @@ def readfp_thread(fp):
     t.start()
     return t, buf
 
+
+def readinto(stream, view):
+    '''
+    Reads from stream into writable memoryview, restarting on EINTR.
+    Falls back to read() for streams without readinto().
+    Returns number of bytes read, 0 on EOF
+    '''
+    while True:
+        try:
+            if hasattr(stream, 'readinto'):
+                return stream.readinto(view)
+            bytes_ = stream.read(len(view))
+            view[:len(bytes_)] = bytes_
+            return len(bytes_)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            LOG.debug("EINTR while reading %s", stream)
+
+def is_throttled(exc):
+    '''
+    Whether cloud storage asks to slow down: S3 503 SlowDown, Swift 429, etc.
+    '''
+    if isinstance(exc, DriverError) and exc.args:
+        # drivers wrap errors of the underlying library
+        exc = exc.args[0]
+    status = getattr(exc, 'status', None) or getattr(exc, 'http_status', None)
+    if status in (429, 503):
+        return True
+    code = getattr(exc, 'error_code', None) or getattr(exc, 'code', None)
+    return code in ('SlowDown', 'Throttling', 'RequestLimitExceeded',
+                    'TooManyRequests', 'rateLimitExceeded')
+
+
+class ConcurrencyController(object):
+    '''
+    AIMD limit of simultaneous transfers.
+    Limit is halved on throttling or when most transfers in a window failed.
+    After a clean window it grows by one, unless the previous increase didn't
+    bring more throughput: then it steps back and stays below that level
+    until the next decrease.
+    '''
+
+    # relative throughput gain that justifies one more worker
+    min_gain = 0.05
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = max_limit
+        self.active = 0
+        self._ceiling = max_limit
+        self._rate_at_increase = None
+        self._successes = 0
+        self._errors = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, stop_event):
+        '''
+        Waits for a free slot. Returns False if stop_event was set meanwhile
+        '''
+        with self._cond:
+            while self.active >= self.limit:
+                if stop_event.isSet():
+                    return False
+                self._cond.wait(0.5)
+            self.active += 1
+            return True
+
+    def release(self, success, throttled=False, rate=None):
+        with self._cond:
+            self.active -= 1
+            if throttled:
+                self._decrease()
+            else:
+                if success:
+                    self._successes += 1
+                else:
+                    self._errors += 1
+                window = self._successes + self._errors
+                if window >= self.limit:
+                    if self._errors * 2 > window:
+                        self._decrease()
+                    elif not self._errors:
+                        self._increase(rate)
+                    self._successes = self._errors = 0
+            self._cond.notifyAll()
+
+    def _decrease(self):
+        limit = max(self.min_limit, self.limit / 2)
+        if limit != self.limit:
+            LOG.debug('Decreasing transfer concurrency %d -> %d', self.limit, limit)
+        self.limit = limit
+        self._ceiling = self.max_limit
+        self._rate_at_increase = None
+        self._successes = self._errors = 0
+
+    def _increase(self, rate):
+        if self._rate_at_increase is not None and rate is not None and \
+                        rate < self._rate_at_increase * (1 + self.min_gain):
+            self._ceiling = max(self.min_limit, self.limit - 1)
+            self.limit = self._ceiling
+            self._rate_at_increase = None
+            LOG.debug('No throughput gain, transfer concurrency back to %d', self.limit)
+        elif self.limit < self._ceiling:
+            self.limit += 1
+            self._rate_at_increase = rate
+            LOG.debug('Increasing transfer concurrency to %d', self.limit)
+
+
+class TransferStats(object):
+    '''
+    Transferred bytes and throughput over a sliding window
+    '''
+
+    window = 10
+
+    def __init__(self):
+        self.bytes_done = 0
+        self.errors = 0
+        self._inflight = {}
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    def progress(self, job, transferred):
+        with self._lock:
+            self._inflight[job] = transferred
+            self._sample()
+
+    def complete(self, job, size):
+        with self._lock:
+            self._inflight.pop(job, None)
+            self.bytes_done += size
+            self._sample()
+
+    def error(self, job):
+        with self._lock:
+            self._inflight.pop(job, None)
+            self.errors += 1
+
+    def _total(self):
+        return self.bytes_done + sum(self._inflight.values())
+
+    def _sample(self):
+        now = time.time()
+        self._samples.append((now, self._total()))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    def rate(self):
+        '''
+        Bytes per second
+        '''
+        with self._lock:
+            if len(self._samples) < 2:
+                return None
+            (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+            return (b1 - b0) / (t1 - t0) if t1 > t0 else None
+
+    def snapshot(self):
+        rate = self.rate()
+        with self._lock:
+            return {
+                    'bytes': self._total(),
+                    'rate': rate,
+                    'errors': self.errors,
+            }
+
+
 class BaseTransfer(bases.Task):
 
     def __init__(self, src=None, dst=None, **kwds):
@@ -132,10 +305,19 @@ class FileTransfer(BaseTransfer):
 
     _url_re = re.compile(r'^[\w-]+://')
 
-    def __init__(self, num_workers=8, retries=3, multipart=False, **kwds):
+    # Retry delay is random in [0, min(backoff_max, backoff_base * 2 ** (retry - 1))]
+    backoff_base = 0.5
+    backoff_max = 30
+
+    def __init__(self, num_workers=8, retries=3, multipart=False, min_workers=1, **kwds):
         '''
         :type num_workers: int
-        :param num_workers: Number of worker threads
+        :param num_workers: Number of worker threads. Number of simultaneous
+                transfers is adjusted between min_workers and num_workers, see
+                :class:`ConcurrencyController`
+
+        :type min_workers: int
+        :param min_workers: Lower bound of simultaneous transfers
 
         :type retries: int
         :param retries: Max retries to transfer one file
@@ -156,6 +338,10 @@ class FileTransfer(BaseTransfer):
 
         :event transfer_error: Fired when file transfer failed
 
+        :event progress_report: Fired by drivers during transfer with
+                (src, dst, retry, chunk_num, transferred, total, stats=dict),
+                stats is :meth:`stats` of the whole transfer
+
         @param: src transfer source path
                 - str file or directory path. directory processed recursively
                 - list of path strings
@@ -212,8 +398,11 @@ class FileTransfer(BaseTransfer):
             multipart = False
 
         super(FileTransfer, self).__init__(num_workers=num_workers,
-                                        retries=retries, multipart=multipart, **kwds)
+                                        retries=retries, multipart=multipart,
+                                        min_workers=min_workers, **kwds)
         self.define_events('progress_report')
+        self._concurrency = ConcurrencyController(num_workers, min_workers)
+        self._stats = TransferStats()
 
         self._completed = []
         self._failed = []
@@ -223,6 +412,7 @@ class FileTransfer(BaseTransfer):
         self._gen_lock = threading.RLock()
         self._worker_lock = threading.Lock()
         self._upload_id = None
+        self._multipart_driver = None
         self._chunk_num = -1
         self._multipart_result = None
 
@@ -261,16 +451,50 @@ class FileTransfer(BaseTransfer):
         return isinstance(path, basestring) and self._url_re.match(path)
 
 
+    def _backoff(self, retry):
+        return random.uniform(0, min(self.backoff_max,
+                        self.backoff_base * 2 ** (retry - 1)))
+
+
+    def stats(self):
+        '''
+        bytes: transferred so far, including unfinished files
+        rate: bytes per second over the last TransferStats.window seconds
+        errors: failed attempts
+        workers: current limit of simultaneous transfers
+        active: transfers in progress
+        '''
+        ret = self._stats.snapshot()
+        ret['workers'] = self._concurrency.limit
+        ret['active'] = self._concurrency.active
+        return ret
+
+
+    def _worker_thread(self):
+        try:
+            self._worker()
+        finally:
+            # Next transfer's workers reuse cloud connections of this one
+            if bus.platform:
+                bus.platform.release_connections()
+
     def _worker(self):
         driver = None
         for src, dst, retry, chunk_num in self._job_generator():
+            job = (src, dst, chunk_num)
 
             def progress_report_cb(uploaded, total):
-                self.fire("progress_report", src, dst, retry, chunk_num, uploaded, total)
+                self._stats.progress(job, uploaded)
+                self.fire("progress_report", src, dst, retry, chunk_num, uploaded, total,
+                                stats=self.stats())
 
+            if not self._concurrency.acquire(self._stop_all):
+                break
+            slot_taken = True
             self.fire('transfer_start', src, dst, retry, chunk_num)
             try:
-                uploading = self._is_remote_path(dst) and os.path.isfile(src)
+                uploading = self._is_remote_path(dst) and \
+                                (isinstance(src, MemoryChunk) or os.path.isfile(src))
                 downloading = self._is_remote_path(src) and not self._is_remote_path(dst)
                 assert not (uploading and downloading)
                 assert uploading or downloading
@@ -280,8 +504,9 @@ class FileTransfer(BaseTransfer):
                     driver = cloudfs(urlparse.urlparse(rem).scheme)
                 with self._worker_lock:
                     if self.multipart and not self._upload_id:
-                        chunk_size = os.path.getsize(loc)
+                        chunk_size = source_size(loc)
                         self._upload_id = driver.multipart_init(rem, chunk_size)
+                        self._multipart_driver = driver
 
                 zero = int(time.time())
                 if uploading:
@@ -289,19 +514,25 @@ class FileTransfer(BaseTransfer):
                         driver.multipart_put(self._upload_id, chunk_num, src)
                     else:
                         driver.put(src, dst, report_to=progress_report_cb)
-                        LOG.debug("*** BENCH %s %s uploaded", int(time.time() - zero), os.path.basename(src))
+                        LOG.debug("*** BENCH %s %s uploaded", int(time.time() - zero),
+                                        os.path.basename(source_name(src)))
+                    size = source_size(src)
                     self._completed.append({
                                     'src': src,
                                     'dst': dst,
                                     'chunk_num': chunk_num,
-                                    'size': os.path.getsize(src)})
+                                    'size': size})
                 else:
                     driver.get(src, dst, report_to=progress_report_cb)
                     LOG.debug("*** BENCH %s %s downloaded", int(time.time() - zero), os.path.basename(src))
+                    size = os.path.getsize(dst)
                     self._completed.append({
                                     'src': src,
                                     'dst': dst,
-                                    'size': os.path.getsize(dst)})
+                                    'size': size})
+                self._stats.complete(job, size)
+                slot_taken = False
+                self._concurrency.release(True, rate=self._stats.rate())
                 self.fire('transfer_complete', src, dst, retry, chunk_num)
 
             except AssertionError:
@@ -312,7 +543,15 @@ class FileTransfer(BaseTransfer):
                                 src, dst, sys.exc_info()[1],
                                 exc_info=sys.exc_info())
                 retry += 1
+                self._stats.error(job)
+                if slot_taken:
+                    slot_taken = False
+                    self._concurrency.release(False, throttled=is_throttled(sys.exc_info()[1]))
                 if retry <= self.retries:
+                    # Backoff holds this worker, not a transfer slot
+                    delay = self._backoff(retry)
+                    LOG.debug('Retrying %s in %.1f seconds', src, delay)
+                    self._stop_all.wait(delay)
                     self._retries_queue.put((src, dst, retry, chunk_num))
                 else:
                     self._failed.append({
@@ -322,6 +561,8 @@ class FileTransfer(BaseTransfer):
                     self.fire('transfer_error', src, dst, retry, chunk_num,
                                             sys.exc_info())
             finally:
+                if slot_taken:
+                    self._concurrency.release(False)
                 if self._stop_all.isSet():
                     with self._worker_lock:
                         if self.multipart and self._upload_id:
@@ -329,13 +570,6 @@ class FileTransfer(BaseTransfer):
                             self._upload_id = None
                     break
 
-        with self._worker_lock:
-            # 'if driver' condition prevents threads that did nothing from
-            # entering (could happen in case num_workers > chunks)
-            if driver and self.multipart and self._upload_id:
-                self._multipart_result = driver.multipart_complete(self._upload_id)
-                self._upload_id = None
-
 
     def _run(self):
         self._stop_all.clear()
@@ -346,7 +580,7 @@ class FileTransfer(BaseTransfer):
             for n in range(self.num_workers):
                 worker = threading.Thread(
                                         name='transfer-worker-%s' % n,
-                                        target=self._worker)
+                                        target=self._worker_thread)
                 LOG.debug("Starting worker '%s'", worker.getName())
                 worker.start()
                 pool.append(worker)
@@ -355,6 +589,12 @@ class FileTransfer(BaseTransfer):
                 LOG.debug("Worker '%s' join...", worker.getName())
                 worker.join()
                 LOG.debug("Worker '%s' finished", worker.getName())
+            # Completed after all workers exit: a worker that ran out of jobs
+            # must not complete upload while another one still retries a part
+            if self.multipart and self._upload_id:
+                self._multipart_result = self._multipart_driver.multipart_complete(
+                                self._upload_id)
+                self._upload_id = None
             return {
                     'completed': self._completed,
                     'failed': self._failed,
@@ -375,6 +615,82 @@ class FileTransfer(BaseTransfer):
 
 
 
+class TransferJournal(object):
+    '''
+    Local record of LargeTransfer progress. One json object per line,
+    each line is flushed to disk before the next chunk is accounted
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        ret = []
+        try:
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        ret.append(json.loads(line))
+                    except ValueError:
+                        # torn write of the last entry
+                        break
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        return ret
+
+    def open(self, truncate=False):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._fp = open(self.path, 'w' if truncate else 'a')
+
+    def record(self, **entry):
+        with self._lock:
+            self._fp.write(json.dumps(entry) + '\n')
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    def remove(self):
+        self.close()
+        coreutils.remove(self.path)
+
+
+class BufferPool(object):
+    '''
+    At most count reusable buffers of the same size, allocated on demand.
+    acquire() doesn't block and returns None when all buffers are taken
+    '''
+
+    def __init__(self, size, count):
+        self.size = size
+        self.count = count
+        self._free = []
+        self._allocated = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if self._allocated < self.count:
+                self._allocated += 1
+                return bytearray(self.size)
+
+    def release(self, buf):
+        with self._lock:
+            self._free.append(buf)
+
+
 class LargeTransfer(bases.Task):
     '''
     LargeTransfer's main objective is to prepare incoming data (e.g. files,
@@ -404,6 +720,11 @@ class LargeTransfer(bases.Task):
 
     pigz_bin = '/usr/bin/pigz'
     gzip_bin = '/bin/gzip'
+    # split and restore copy data through one preallocated buffer of this size
+    buf_size = 1024 * 1024
+    journal_dir = '/var/lib/scalarizr/transfers'
+    # dedup refs are saved before skipping a stored chunk, at most once in this many seconds
+    chunk_refs_interval = 30
 
     def __init__(self, src, dst,
                             transfer_id=None,
@@ -414,6 +735,10 @@ class LargeTransfer(bases.Task):
                             manifest='manifest.json',
                             description='',
                             tags=None,
+                            dedup=False,
+                            resumable=False,
+                            in_memory=False,
+                            memory_limit=512,
                             **kwds):
         '''
         :param src: DL: manifest url. UL: str file or directory path,
@@ -431,6 +756,20 @@ class LargeTransfer(bases.Task):
         :param manifest: manifest file basename
         :param description: description to save in manifest
         :param tags: tags to save in manifest
+        :param dedup: UL: store chunks under their md5 in a "chunks" dir shared
+                                 by all transfers to the same dst, and skip chunks
+                                 that are already there. Chunks in use are listed in
+                                 "refs" dir from the start of upload, see
+                                 :meth:`Manifest.delete`. Ignored when downloading:
+                                 manifest tells whether chunks are shared
+        :param resumable: keep a journal of transferred chunks in journal_dir,
+                                 and keep uploaded chunks when transfer fails,
+                                 so it can be continued with :meth:`resume`
+        :param in_memory: UL: keep chunks in memory buffers and upload them
+                                 from there, without tranzit tmpfs volume.
+                                 Chunks that don't fit in memory_limit are
+                                 written to a temporary dir on disk
+        :param memory_limit: memory for in_memory chunk buffers in megabytes
         :param **kwds: additional kwargs for :class:`FileTransfer`
         '''
 
@@ -444,6 +783,12 @@ class LargeTransfer(bases.Task):
                     ' Got src: %s and dst: %s' % (src, dst))
         if self._up and isinstance(src, basestring) and os.path.isdir(src) and not streamer:
             raise ValueError('Passed src is a directory. streamer expected')
+        if dedup and kwds.get("multipart"):
+            raise ValueError('dedup and multipart upload are mutually exclusive')
+        if resumable and kwds.get("multipart"):
+            raise ValueError("multipart upload can't be resumed")
+        if in_memory and kwds.get("multipart"):
+            raise ValueError('in_memory and multipart upload are mutually exclusive')
         if self._up:
             if callable(src):
                 src = (item for item in src())
@@ -469,6 +814,20 @@ class LargeTransfer(bases.Task):
         self.compressor = compressor
         self.chunk_size = chunk_size
         self.try_pigz = try_pigz
+        self.dedup = dedup
+        self.resumable = resumable
+        self.in_memory = in_memory and self._up
+        self._buffers = None
+        if self.in_memory:
+            self._buffers = BufferPool(chunk_size * 1024 * 1024,
+                            memory_limit // chunk_size)
+        self._resume = False
+        self._journal = None
+        self._journaled = []
+        self._chunk_store = None
+        self._chunk_refs = None
+        self._chunk_refs_dirty = False
+        self._chunk_refs_saved_at = 0
         self._upload_res = None
         self._restorer = None
         self._killed = False
@@ -533,16 +892,37 @@ class LargeTransfer(bases.Task):
             self.manifest = Manifest()
             # supposedly, manifest's destination path; assumes that dst
             # generator yields self.dst.next()+transfer_id
-            self.manifest.cloudfs_path = os.path.join(self.dst.next(),
+            dst_root = self.dst.next()
+            self.manifest.cloudfs_path = os.path.join(dst_root,
                     self.transfer_id, self.manifest_path)
             self.manifest["description"] = self.description
             if self.tags:
                 self.manifest["tags"] = self.tags
+            if self.dedup:
+                self._chunk_store = os.path.join(dst_root, 'chunks', '')
+                self.manifest["chunk_store"] = self._chunk_store
+                # Refs are saved before the chunk store is listed, so the
+                # chunks we are going to skip aren't deleted as unreferenced
+                self._chunk_refs = Manifest()
+                self._chunk_refs.cloudfs_path = chunk_refs_path(self._chunk_store,
+                                self.manifest.cloudfs_path)
+                self._chunk_refs.data = {"chunk_store": self._chunk_store, "chunks": []}
+                self._save_chunk_refs()
+                stored_chunks = self._stored_chunks()
 
             def delete_uploaded_chunk(src, dst, retry, chunk_num):
-                os.remove(src)
+                self._discard_chunk(src)
             self._transfer.on(transfer_complete=delete_uploaded_chunk)
 
+            uploaded = dict((entry["chunk"], entry["md5sum"]) for entry in self._journaled)
+            journaling = {}
+            if self._journal:
+                def journal_chunk(src, dst, retry, chunk_num):
+                    if src in journaling:
+                        chunk_name, md5sum = journaling.pop(src)
+                        self._journal.record(chunk=chunk_name, md5sum=md5sum)
+                self._transfer.on(transfer_complete=journal_chunk)
+
             for src in self.src:
                 LOG.debug('src: %s, type: %s', src, type(src))
                 fileinfo = {
@@ -553,7 +933,7 @@ class LargeTransfer(bases.Task):
                 }
                 self.manifest["files"].append(fileinfo)  # moved here from the
                                                                                                  # bottom
-                prefix = self._tranzit_vol.mpoint
+                prefix = prefix_dir = self._tranzit_vol.mpoint
                 stream = None
                 cmd = tar = gzip = None
 
@@ -631,7 +1011,32 @@ class LargeTransfer(bases.Task):
                     stream = cmd.stdout
 
                 for filename, md5sum, size in self._split(stream, prefix):
-                    fileinfo["chunks"].append((os.path.basename(filename), md5sum, size))
+                    chunk_name = os.path.basename(source_name(filename))
+                    fileinfo["chunks"].append((chunk_name, md5sum, size))
+                    if self.dedup:
+                        self._add_chunk_ref(md5sum)
+                    if uploaded.get(chunk_name) == md5sum:
+                        LOG.debug("LargeTransfer src_generator %s was uploaded before", chunk_name)
+                        if self.dedup:
+                            self._ref_skipped_chunk()
+                        self._discard_chunk(filename)
+                        continue
+                    if self.dedup:
+                        if md5sum in stored_chunks:
+                            LOG.debug("LargeTransfer src_generator %s is already stored as %s",
+                                            chunk_name, md5sum)
+                            self._ref_skipped_chunk()
+                            self._discard_chunk(filename)
+                            continue
+                        stored_chunks.add(md5sum)
+                        content_name = os.path.join(prefix_dir, md5sum)
+                        if isinstance(filename, MemoryChunk):
+                            filename.name = content_name
+                        else:
+                            os.rename(filename, content_name)
+                            filename = content_name
+                    if self._journal:
+                        journaling[filename] = (chunk_name, md5sum)
                     LOG.debug("LargeTransfer src_generator yield %s", filename)
                     yield filename
                 if cmd:
@@ -639,8 +1044,9 @@ class LargeTransfer(bases.Task):
                     if err:
                         LOG.debug("LargeTransfer src_generator cmd pipe stderr: %s", err)
 
-            # send manifest to file transfer
-            if not self.multipart:
+            # send manifest to file transfer. Shared chunks go to a different
+            # dir, so _run saves dedup manifest itself
+            if not self.multipart and not self.dedup:
                 LOG.debug("Manifest: %s", self.manifest.data)
                 manifest_f = os.path.join(self._tranzit_vol.mpoint, self.manifest_path)
                 self.manifest.write(manifest_f)
@@ -679,6 +1085,7 @@ class LargeTransfer(bases.Task):
             # chunk order
             with self._chunks_events_access:
                 if not self._killed:
+                    self._chunk_store = manifest.data.get("chunk_store")
                     self.files = copy(manifest["files"])
                     for file_ in self.files:
                         file_["chunks"] = OrderedDict([(
@@ -690,6 +1097,7 @@ class LargeTransfer(bases.Task):
                                 }
                         ) for chunk in file_["chunks"]])
                         # chunk is [basename, md5sum, size]
+                        file_["restored"] = self._restored_chunks(file_)
 
             # launch restorer
             if self._restorer is None:
@@ -698,18 +1106,26 @@ class LargeTransfer(bases.Task):
                 self._restorer.start()
 
             def wait_chunk(src, dst, retry, chunk_num):
-                chunk_name = os.path.basename(src)
+                if self._chunk_store:
+                    chunk_name = os.path.basename(dst)
+                else:
+                    chunk_name = os.path.basename(src)
                 for file_ in self.files:
                     if chunk_name in file_["chunks"]:
                         chunk = file_["chunks"][chunk_name]
                 chunk["downloaded"].set()
                 chunk["processed"].wait()
-                os.remove(os.path.join(dst, chunk_name))
+                os.remove(self._chunk_location(chunk_name, chunk))
+                if self._chunk_store:
+                    os.rmdir(dst)
             self._transfer.on(transfer_complete=wait_chunk)
 
             for file_ in self.files:
-                for chunk in file_["chunks"]:
-                    yield os.path.join(remote_path, chunk)
+                for chunk, info in self._pending_chunks(file_):
+                    if self._chunk_store:
+                        yield os.path.join(self._chunk_store, info["md5sum"])
+                    else:
+                        yield os.path.join(remote_path, chunk)
 
 
     def _dst_generator(self):
@@ -717,15 +1133,141 @@ class LargeTransfer(bases.Task):
             # last yield for manifest
             # NOTE: this only works if dst is a dir
             for dst in self.dst:
-                yield os.path.join(dst, self.transfer_id, '')
+                if self.dedup:
+                    yield os.path.join(dst, 'chunks', '')
+                else:
+                    yield os.path.join(dst, self.transfer_id, '')
         else:
-            while True:
-                yield self._tranzit_vol.mpoint
+            # manifest
+            yield self._tranzit_vol.mpoint
+            if self._chunk_store:
+                # Shared chunks are named by md5 and the same one can appear
+                # several times, so each chunk gets a dir named after it
+                for file_ in self.files or ():
+                    for chunk, info in self._pending_chunks(file_):
+                        path = os.path.join(self._tranzit_vol.mpoint, chunk)
+                        os.mkdir(path)
+                        yield path
+            else:
+                while True:
+                    yield self._tranzit_vol.mpoint
+
+
+    def _pending_chunks(self, file_):
+        '''
+        (name, info) of chunks to download, without ones restored before
+        '''
+        return itertools.islice(file_["chunks"].iteritems(), file_["restored"], None)
+
+
+    def _restored_chunks(self, file_):
+        '''
+        Number of leading chunks of file_ restored by previous run, according
+        to journal. Decompressed or unpacked files are skipped only as a whole
+        '''
+        if {"file": file_["name"], "restored": True} in self._journaled:
+            return len(file_["chunks"])
+        if file_["streamer"] or file_["compressor"] or hasattr(self.streamer, "popen"):
+            return 0
+        restored = dict((entry["chunk"], entry["md5sum"]) for entry in self._journaled
+                        if entry.get("file") == file_["name"] and "chunk" in entry)
+        count = size = 0
+        for chunk, info in file_["chunks"].iteritems():
+            if info["size"] is None or restored.get(chunk) != info["md5sum"]:
+                break
+            count += 1
+            size += info["size"]
+        path = os.path.join(self.dst, file_["name"])
+        if count and (not os.path.exists(path) or os.path.getsize(path) < size):
+            LOG.debug("%s is shorter than journal says, restoring from scratch", path)
+            return 0
+        return count
+
+
+    def resume(self, transfer_id):
+        '''
+        Continues transfer that failed or was interrupted, using its journal.
+        Upload skips chunks uploaded before (source is still read and split),
+        download skips restored files and chunks of uncompressed files
+        '''
+        if self.multipart:
+            raise ValueError("multipart upload can't be resumed")
+        self.transfer_id = transfer_id
+        self.resumable = True
+        self._resume = True
+        return self.run()
+
+
+    def _chunk_location(self, chunk_name, chunk):
+        '''
+        Local path of a downloaded chunk
+        '''
+        if self._chunk_store:
+            return os.path.join(self._tranzit_vol.mpoint, chunk_name, chunk["md5sum"])
+        return os.path.join(self._tranzit_vol.mpoint, chunk_name)
+
+
+    def _discard_chunk(self, chunk):
+        if isinstance(chunk, MemoryChunk):
+            chunk.release()
+        else:
+            os.remove(chunk)
+
+
+    def _stored_chunks(self, strict=False):
+        '''
+        Set of chunk md5 sums already present in the chunk store
+        '''
+        driver = cloudfs(urlparse.urlparse(self._chunk_store).scheme)
+        try:
+            return set(os.path.basename(url) for url in driver.ls(self._chunk_store))
+        except:
+            if strict:
+                raise
+            LOG.debug("Can't list chunk store %s, uploading all chunks: %s",
+                            self._chunk_store, sys.exc_info()[1])
+            return set()
+
+
+    def _add_chunk_ref(self, md5sum):
+        if md5sum not in self._chunk_refs["chunks"]:
+            self._chunk_refs["chunks"].append(md5sum)
+            self._chunk_refs_dirty = True
+
+
+    def _ref_skipped_chunk(self):
+        '''
+        Saves refs before a stored chunk is skipped, so Manifest.delete()
+        keeps it. Saves are batched by chunk_refs_interval: a chunk deleted
+        before its ref was saved is found by _missing_chunks()
+        '''
+        now = time.time()
+        if self._chunk_refs_dirty and \
+                        now - self._chunk_refs_saved_at >= self.chunk_refs_interval:
+            self._save_chunk_refs()
+            self._chunk_refs_saved_at = now
+
+
+    def _save_chunk_refs(self, pending=True):
+        self._chunk_refs["pending"] = pending
+        self._chunk_refs["updated_at"] = time.time()
+        self._chunk_refs.save()
+        self._chunk_refs_dirty = False
+
+
+    def _missing_chunks(self):
+        '''
+        Referenced chunks that aren't in the chunk store. A chunk that was
+        skipped as stored can be deleted by Manifest.delete() that had read refs
+        before this transfer added its own
+        '''
+        return set(self._chunk_refs["chunks"]) - self._stored_chunks(strict=True)
 
 
     def _split(self, stream, prefix):
         try:
-            buf_size = 4096
+            buf = bytearray(self.buf_size)
+            view = memoryview(buf)
             chunk_size = self.chunk_size * 1024 * 1024
 
             for chunk_n in itertools.count():
@@ -734,34 +1276,37 @@ class LargeTransfer(bases.Task):
                 chunk_md5 = hashlib.md5()
 
                 zero = int(time.time())
-                with open(chunk_name, 'w') as chunk:
+                mem = self._buffers.acquire() if self._buffers else None
+                if mem is not None:
+                    # read right into the chunk buffer, it goes to the driver as is
+                    mem_view = memoryview(mem)
                     while chunk_capacity:
-
-                        while True:
-                            try:
-                                bytes_ = stream.read(min(buf_size, chunk_capacity))
-                            except IOError, e:
-                                if e.errno == errno.EINTR:
-                                    LOG.debug("EINTR while reading data for %s",
-                                            chunk_name)
-                                    continue
-                                else:
-                                    raise
-                            else:
-                                break
-
-                        if not bytes_:
+                        offset = chunk_size - chunk_capacity
+                        size = readinto(stream, mem_view[offset:chunk_size])
+                        if not size:
                             break
-                        chunk.write(bytes_)
-                        chunk_capacity -= len(bytes_)
-                        chunk_md5.update(bytes_)
+                        chunk_capacity -= size
+                        chunk_md5.update(buffer(mem, offset, size))
+                    chunk = MemoryChunk(chunk_name, mem, chunk_size - chunk_capacity,
+                                    self._buffers.release)
+                else:
+                    with open(chunk_name, 'wb') as chunk:
+                        while chunk_capacity:
+                            size = readinto(stream, view[:min(self.buf_size, chunk_capacity)])
+                            if not size:
+                                break
+                            bytes_ = buffer(buf, 0, size)
+                            chunk.write(bytes_)
+                            chunk_capacity -= size
+                            chunk_md5.update(bytes_)
+                    chunk = chunk_name
 
                 if chunk_capacity != chunk_size:  # non-empty chunk
-                    LOG.debug("*** BENCH %s %s created", int(time.time() - zero),
-                                    os.path.basename(chunk_name))
-                    yield chunk_name, chunk_md5.hexdigest(), chunk_size - chunk_capacity
+                    LOG.debug("*** BENCH %s %s created%s", int(time.time() - zero),
+                                    os.path.basename(chunk_name), ' in memory' if mem else '')
+                    yield chunk, chunk_md5.hexdigest(), chunk_size - chunk_capacity
                 else:  # empty chunk
-                    os.remove(chunk_name)
+                    self._discard_chunk(chunk)
                 if chunk_capacity:  # empty or half-empty chunk, meaning stream
                                                         # is empty
                     break
@@ -771,10 +1316,15 @@ class LargeTransfer(bases.Task):
 
 
     def _dl_restorer(self):
-        buf_size = 4096
+        buf = bytearray(self.buf_size)
+        view = memoryview(buf)
 
         for file_ in self.files:
             dst = self.dst
+            chunks = list(self._pending_chunks(file_))
+            if not chunks:
+                LOG.debug("RESTORER file %s was restored before", file_["name"])
+                continue
 
             LOG.debug("RESTORER start")
             LOG.debug("RESTORER file %s to %s", file_["name"], dst)
@@ -787,7 +1337,16 @@ class LargeTransfer(bases.Task):
             # create 'cmd' and 'stream'
             if not file_["streamer"] and not file_["compressor"]:
                 cmd = None
-                stream = open(os.path.join(dst, file_["name"]), 'w')
+                path = os.path.join(dst, file_["name"])
+                if file_["restored"]:
+                    offset = sum(info["size"] for chunk, info in
+                                    itertools.islice(file_["chunks"].iteritems(), file_["restored"]))
+                    LOG.debug("RESTORER continue %s from %d", path, offset)
+                    stream = open(path, 'r+b')
+                    stream.truncate(offset)
+                    stream.seek(offset)
+                else:
+                    stream = open(path, 'w')
             else:
                 compressor_out = subprocess.PIPE
 
@@ -835,30 +1394,41 @@ class LargeTransfer(bases.Task):
                         stream = cmd.stdin
 
             try:
-                for chunk, info in file_["chunks"].iteritems():
+                for chunk, info in chunks:
 
                     LOG.debug("RESTORER before wait %s", chunk)
                     info["downloaded"].wait()
                     zero = int(time.time())
+                    chunk_md5 = hashlib.md5()
 
-                    location = os.path.join(self._tranzit_vol.mpoint, chunk)
+                    location = self._chunk_location(chunk, info)
                     with open(location, 'rb') as fd:
                         while True:
                             try:
-                                bytes_ = fd.read(buf_size)
-                                if not bytes_:
+                                size = readinto(fd, view)
+                                if not size:
                                     LOG.debug("RESTORER break %s", chunk)
                                     LOG.debug("*** BENCH %s %s restored", int(time.time() - zero),
                                                     chunk)
                                     break
 
+                                bytes_ = buffer(buf, 0, size)
+                                chunk_md5.update(bytes_)
                                 stream.write(bytes_)
                             except Exception:
                                 LOG.exception("Caught error in restore loop\ncmd.stderr: %s",
-                                                cmd.stderr.read())
+                                                cmd.stderr.read() if cmd else None)
                                 self.kill()
                                 raise
 
+                    if chunk_md5.hexdigest() != info["md5sum"]:
+                        self.kill()
+                        raise Exception("Chunk %s is corrupted: md5 %s, expected %s" % (
+                                        chunk, chunk_md5.hexdigest(), info["md5sum"]))
+                    if self._journal and not cmd:
+                        stream.flush()
+                        self._journal.record(file=file_["name"], chunk=chunk,
+                                        md5sum=info["md5sum"])
                     info["processed"].set()  # this leads to chunk removal
             finally:
                 stream.close()
@@ -870,13 +1440,29 @@ class LargeTransfer(bases.Task):
                     cmd.wait()
                     LOG.debug("LargeTransfer download: finished restoring")
 
+            if self._journal and not (cmd and cmd.returncode):
+                self._journal.record(file=file_["name"], restored=True)
+
 
     def _run(self):
         # ..
-        LOG.debug("Creating tmpfs...")
-        self._tranzit_vol.size = int(self.chunk_size * self._transfer.num_workers * 1.2)
-        self._tranzit_vol.ensure(mkfs=True)
-        LOG.debug("Creating tmpfs...")
+        if self.resumable:
+            self._journal = TransferJournal(os.path.join(self.journal_dir,
+                            '%s.journal' % self.transfer_id))
+            if self._resume:
+                self._journaled = self._journal.read()
+                LOG.debug("Resuming transfer %s, %d journal entries",
+                                self.transfer_id, len(self._journaled))
+            self._journal.open(truncate=not self._resume)
+        if self.in_memory:
+            # chunks that don't fit in memory and manifest go to the plain
+            # temporary dir on disk
+            LOG.debug("Chunks are kept in memory, no tmpfs")
+        else:
+            LOG.debug("Creating tmpfs...")
+            self._tranzit_vol.size = int(self.chunk_size * self._transfer.num_workers * 1.2)
+            self._tranzit_vol.ensure(mkfs=True)
+            LOG.debug("Creating tmpfs...")
         try:
             res = self._transfer.run()
             LOG.debug("self._transfer finished")
@@ -885,21 +1471,40 @@ class LargeTransfer(bases.Task):
                 if self._restorer:
                     LOG.debug("waiting restorer to finish...")
                     self._restorer.join()
+                if self._journal and not res["failed"] and not self._killed:
+                    self._journal.remove()
                 return res
 
             elif self._up:
                 if res["failed"] or self._killed:
-                    if self.manifest:
+                    # resumable transfer keeps uploaded chunks, unless killed
+                    if self.manifest and (self._killed or not self.resumable):
                         # TODO: get rid of the duplicate delete
                         self.manifest.delete()
                     return
                 if self.multipart:
-                    return res["multipart_result"]
+                    ret = res["multipart_result"]
                 else:
-                    return self.manifest
+                    if self.dedup:
+                        missing = self._missing_chunks()
+                        if missing:
+                            LOG.error("Shared chunks were deleted during upload: %s",
+                                            ', '.join(sorted(missing)))
+                            if not self.resumable:
+                                self.manifest.delete()
+                            return
+                        self.manifest.save()
+                        self._save_chunk_refs(pending=False)
+                    ret = self.manifest
+                if self._journal:
+                    self._journal.remove()
+                return ret
         finally:
-            LOG.debug("Destroying tmpfs")
-            self._tranzit_vol.destroy()
+            if self._journal:
+                self._journal.close()
+            if not self.in_memory:
+                LOG.debug("Destroying tmpfs")
+                self._tranzit_vol.destroy()
             coreutils.remove(self._tranzit_vol.mpoint)
 
 
@@ -919,7 +1524,7 @@ class LargeTransfer(bases.Task):
                         chunkinfo["downloaded"].interrupt()
                         chunkinfo["processed"].interrupt()
 
-        def interrupt(*args):
+        def interrupt(*args, **kwds):
             raise Exception("LargeTransfer is being killed")  #?
         self._transfer.on(progress_report=interrupt)
 
@@ -946,7 +1551,9 @@ class Manifest(object):
                     compressor,  # "gzip" | python function | None
                     chunks: [(basename001, md5sum, size_in_bytes)]
                 }
-            ]
+            ],
+            chunk_store  # optional. Chunks are stored there as md5sum and
+                         # may be shared with other manifests
         }
 
 
@@ -958,6 +1565,9 @@ class Manifest(object):
 
     filename = None
     cloudfs_path = None
+    # Refs of uploads that are still pending after this many seconds
+    # (failed resumable ones) don't keep shared chunks from deletion
+    pending_refs_ttl = 7 * 24 * 3600
 
     def __init__(self, filename=None, cloudfs_path=None):
         self.reset()
@@ -1099,6 +1709,15 @@ class Manifest(object):
             self.write(self.filename)
 
     def delete(self, destroyers=4):
+        '''
+        Deletes chunks from cloudfs. Shared chunks (see chunk_store) are deleted
+        with the manifest itself and only if no other transfer refers to them,
+        including uploads in progress.
+
+        Concurrent dedup upload can still skip a chunk that is deleted here,
+        if it adds its ref after this method read refs. Such upload finds
+        the chunk missing at the end and fails instead of saving the manifest
+        '''
         LOG.debug("Performing cloudfs clean up")
         try:
             path = os.path.dirname(self.cloudfs_path)
@@ -1106,11 +1725,29 @@ class Manifest(object):
             LOG.debug("'cloudfs_path' for the manifest isn't defined")
             raise
         driver = cloudfs(urlparse.urlparse(path).scheme)
+        chunk_store = self.data.get("chunk_store")
 
         pieces = Queue.Queue()
-        for file_ in self.data["files"]:
-            for name, checksum, size in file_["chunks"]:
-                pieces.put(os.path.join(path, name))
+        if chunk_store:
+            for url in (self.cloudfs_path, chunk_refs_path(chunk_store, self.cloudfs_path)):
+                try:
+                    driver.delete(url)
+                except:
+                    LOG.debug("Can't delete %s: %s", url, sys.exc_info()[1])
+            try:
+                referenced = self._referenced_chunks(driver, chunk_store)
+            except:
+                # Without all refs we can't tell which chunks other transfers use
+                LOG.warn("Can't read chunk refs, keeping shared chunks of %s: %s",
+                                self.cloudfs_path, sys.exc_info()[1])
+            else:
+                for md5sum in set(chunk[1] for file_ in self.data["files"]
+                                for chunk in file_["chunks"]) - referenced:
+                    pieces.put(os.path.join(chunk_store, md5sum))
+        else:
+            for file_ in self.data["files"]:
+                for name, checksum, size in file_["chunks"]:
+                    pieces.put(os.path.join(path, name))
 
         def delete_obj():
             driver = cloudfs(urlparse.urlparse(path).scheme)
@@ -1126,6 +1763,35 @@ class Manifest(object):
             map(lambda x: x.start(), threads)
             map(lambda x: x.join(), threads)
 
+    def _referenced_chunks(self, driver, chunk_store):
+        '''
+        md5 sums of chunks used by other transfers to the chunk store.
+        Relies on driver.ls() listing all refs
+        '''
+        refs_dir = os.path.dirname(chunk_refs_path(chunk_store, self.cloudfs_path))
+        ret = set()
+        now = time.time()
+        for url in driver.ls(os.path.join(refs_dir, '')):
+            refs = Manifest(cloudfs_path=url)
+            if refs.data.get("chunk_store") != chunk_store:
+                continue
+            if refs.data.get("pending") and \
+                            now - refs.data.get("updated_at", 0) > self.pending_refs_ttl:
+                LOG.debug("Ignoring refs of abandoned upload %s", url)
+                continue
+            ret.update(refs["chunks"])
+        return ret
+
+
+def chunk_refs_path(chunk_store, manifest_path):
+    '''
+    Shared chunks of a dedup transfer are listed in <root>/refs/<transfer_id>.json,
+    next to the chunk store
+    '''
+    root = os.path.dirname(chunk_store.rstrip('/'))
+    transfer_id = os.path.basename(os.path.dirname(manifest_path))
+    return os.path.join(root, 'refs', transfer_id + '.json')
+
 
 class _CloudfsTypes(dict):
 
@@ -1,6 +1,15 @@
+from __future__ import with_statement
+
+import os
 import sys
+import time
+import random
+import logging
 import urlparse
-import os
+import threading
+
+
+LOG = logging.getLogger(__name__)
 
 
 class DriverError(Exception):
@@ -89,6 +98,13 @@ class CloudFileSystem(object):
             'multipart': False
     }
 
+    # Drivers that support it put and get files larger than multipart_threshold
+    # in part_size parts, part_concurrency parts at a time
+    multipart_threshold = 64 * 1024 * 1024
+    part_size = 16 * 1024 * 1024
+    part_concurrency = 4
+    part_retries = 3
+
     def _parse_url(self, url):
         """
         :returns: bucket, key
@@ -133,7 +149,7 @@ class CloudFileSystem(object):
         '''
         raise NotImplementedError()
 
-    def multipart_put(self, upload_id, src):
+    def multipart_put(self, upload_id, part_num, src):
         raise NotImplementedError()
 
     def multipart_complete(self, upload_id):
@@ -141,3 +157,206 @@ class CloudFileSystem(object):
 
     def multipart_abort(self, upload_id):
         raise NotImplementedError()
+
+
+    def _part_ranges(self, size, max_parts=None):
+        '''
+        :returns: list of (part_num, offset, length). part_size is increased
+                when more than max_parts parts would be needed
+        '''
+        part_size = self.part_size
+        if max_parts:
+            part_size = max(part_size, -(-size // max_parts))
+        return [(num, offset, min(part_size, size - offset))
+                        for num, offset in enumerate(xrange(0, size, part_size))]
+
+
+    def _transfer_parts(self, parts, transfer_part, report_to=None):
+        '''
+        Calls transfer_part(part_num, offset, length) for every part from
+        part_concurrency threads. Failed part is retried up to part_retries times
+        with jittered exponential delay. Once a part failed for good, remaining
+        parts are skipped and its error is raised
+        '''
+        parts = list(parts)
+        total = sum(part[2] for part in parts)
+        pending = list(reversed(parts))
+        state = {'done': 0, 'error': None}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending or state['error']:
+                        return
+                    num, offset, length = pending.pop()
+                for attempt in range(self.part_retries + 1):
+                    try:
+                        transfer_part(num, offset, length)
+                        break
+                    except:
+                        exc_info = sys.exc_info()
+                        LOG.debug('Part %d (%d bytes at %d) failed, attempt %d: %s',
+                                        num, length, offset, attempt + 1, exc_info[1])
+                        if attempt == self.part_retries:
+                            with lock:
+                                state['error'] = state['error'] or exc_info
+                            return
+                        time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+                with lock:
+                    state['done'] += length
+                    done = state['done']
+                if report_to:
+                    report_to(done, total)
+
+        threads = [threading.Thread(target=worker, name='part-worker-%d' % n)
+                        for n in range(min(self.part_concurrency, len(parts)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if state['error']:
+            raise state['error'][0], state['error'][1], state['error'][2]
+
+
+    def _get_ranges(self, dest_path, size, get_range, report_to=None):
+        '''
+        Downloads file of known size in parallel byte ranges.
+        get_range(fp, offset, length) writes the range at fp's position
+        '''
+        with open(dest_path, 'wb') as fp:
+            fp.truncate(size)
+
+        def get_part(num, offset, length):
+            with open(dest_path, 'r+b') as fp:
+                fp.seek(offset)
+                get_range(fp, offset, length)
+                if fp.tell() != offset + length:
+                    raise IOError('Got %d bytes of %d for range at %d' % (
+                                    fp.tell() - offset, length, offset))
+
+        self._transfer_parts(self._part_ranges(size), get_part, report_to)
+
+
+def read_part(path, offset, length):
+    '''
+    Returns file-like object with length bytes of path from offset
+    '''
+    fp = open_source(path)
+    fp.seek(offset)
+    return PartFile(fp, length)
+
+
+def open_source(src):
+    '''
+    Opens upload source: local file path or :class:`MemoryChunk`
+    '''
+    if isinstance(src, MemoryChunk):
+        return src.open()
+    return open(src, 'rb')
+
+
+def source_size(src):
+    if isinstance(src, MemoryChunk):
+        return src.size
+    return os.path.getsize(src)
+
+
+def source_name(src):
+    if isinstance(src, MemoryChunk):
+        return src.name
+    return src
+
+
+class MemoryChunk(object):
+    '''
+    Upload source held in memory. Drivers read it with open_source(), each
+    call returns a new reader, so retries and parallel parts don't interfere.
+    release() gives the buffer back to its owner
+    '''
+
+    def __init__(self, name, buf, size, release=None):
+        self.name = name
+        self.size = size
+        self._buf = buf
+        self._release = release
+
+    def open(self):
+        return PartFile(BufferFile(self._buf), self.size)
+
+    def release(self):
+        if self._release:
+            self._release(self._buf)
+            self._release = self._buf = None
+
+    def __repr__(self):
+        return '<MemoryChunk %s, %d bytes>' % (self.name, self.size)
+
+
+class BufferFile(object):
+    '''
+    Seekable reader of a bytearray that doesn't copy it
+    '''
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = len(self._buf) if size < 0 else min(len(self._buf), self._pos + size)
+        ret = str(buffer(self._buf, self._pos, max(0, end - self._pos)))
+        self._pos = max(self._pos, end)
+        return ret
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._buf)
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._buf = bytearray()
+
+
+class PartFile(object):
+    '''
+    Read-only window of a file, for clients that read until EOF
+    '''
+
+    def __init__(self, fp, length):
+        self._fp = fp
+        self._start = fp.tell()
+        self._length = length
+
+    def read(self, size=-1):
+        left = self._start + self._length - self._fp.tell()
+        if size < 0 or size > left:
+            size = left
+        return self._fp.read(size) if size > 0 else ''
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            offset += self._start
+        elif whence == 2:
+            offset += self._start + self._length
+            whence = 0
+        self._fp.seek(offset, whence)
+
+    def tell(self):
+        return self._fp.tell() - self._start
+
+    def __len__(self):
+        return self._length
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
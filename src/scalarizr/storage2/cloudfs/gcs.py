@@ -11,7 +11,8 @@ import random
 from apiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 from apiclient.errors import HttpError
 
-from scalarizr.storage2.cloudfs.base import CloudFileSystem
+from scalarizr.storage2.cloudfs.base import CloudFileSystem, read_part, \
+        open_source, source_size, source_name
 from scalarizr.storage2.cloudfs import cloudfs_types
 from scalarizr.bus import bus
 from scalarizr.node import __node__
@@ -28,6 +29,7 @@ class GCSFileSystem(CloudFileSystem):
 
     chunk_size = 2*1024*1024
     report_interval = 10  # percent; every <value> percent at most
+    max_parts = 32  # compose request limit
 
     def _parse_url(self, url):
         bucket, key = super(GCSFileSystem, self)._parse_url(url)
@@ -44,12 +46,14 @@ class GCSFileSystem(CloudFileSystem):
 
         path = path.rstrip('/') + '/' if path else ''
 
-        req = self.cloudstorage.objects().list(
-                bucket=bucket, prefix=path)
-        resp = req.execute()
-
-        items = (self._format_url(bucket, x["name"])
-                         for x in resp.setdefault("items", []))
+        objects = self.cloudstorage.objects()
+        req = objects.list(bucket=bucket, prefix=path)
+        items = []
+        while req is not None:
+            resp = req.execute()
+            items.extend(self._format_url(bucket, x["name"])
+                             for x in resp.get("items", []))
+            req = objects.list_next(req, resp)
         return tuple(items)
 
 
@@ -58,6 +62,15 @@ class GCSFileSystem(CloudFileSystem):
         bucket, name = self._parse_url(remote_path)
         local_path = os.path.join(local_path, os.path.basename(remote_path))
 
+        size = int(self.cloudstorage.objects().get(
+                bucket=bucket, object=name).execute()['size'])
+        if size > self.multipart_threshold:
+            self._get_ranges(local_path, size,
+                    lambda fp, offset, length: self._get_range(bucket, name, fp, offset, length),
+                    report_to)
+            LOG.debug("Finished downloading %s", os.path.basename(local_path))
+            return local_path
+
         request = self.cloudstorage.objects().get_media(
                 bucket=bucket, object=name)
 
@@ -84,7 +97,7 @@ class GCSFileSystem(CloudFileSystem):
 
     def put(self, local_path, remote_path, report_to=None):
         LOG.debug('Uploading %s to cloud storage (remote path: %s)', local_path, remote_path)
-        filename = os.path.basename(local_path)
+        filename = os.path.basename(source_name(local_path))
         bucket, name = self._parse_url(remote_path)
         if name.endswith("/"):
             name = os.path.join(name, filename)
@@ -93,7 +106,13 @@ class GCSFileSystem(CloudFileSystem):
         if bucket not in buckets:
             self._create_bucket(bucket)
 
-        fd = open(local_path, 'rb')
+        size = source_size(local_path)
+        if size > self.multipart_threshold:
+            self._put_composite(local_path, bucket, name, size, report_to)
+            LOG.debug("Finished uploading %s", filename)
+            return self._format_url(bucket, name)
+
+        fd = open_source(local_path)
         try:
             media = MediaIoBaseUpload(fd,
                     'application/octet-stream',
@@ -125,7 +144,7 @@ class GCSFileSystem(CloudFileSystem):
                     time.sleep(sec_to_wait)
         finally:
             fd.close()
-        LOG.debug("Finished uploading %s", os.path.basename(local_path))
+        LOG.debug("Finished uploading %s", filename)
         return self._format_url(bucket, name)
 
 
@@ -142,6 +161,42 @@ class GCSFileSystem(CloudFileSystem):
             else:
                 raise
 
+    def _put_composite(self, local_path, bucket, name, size, report_to=None):
+        '''
+        Parallel composite upload: parts are uploaded as separate objects
+        and composed into the destination one
+        '''
+        parts = self._part_ranges(size, self.max_parts)
+        part_names = ['%s.part-%08d' % (name, num) for num, _, _ in parts]
+
+        def put_part(num, offset, length):
+            with read_part(local_path, offset, length) as fp:
+                media = MediaIoBaseUpload(fp, 'application/octet-stream', resumable=False)
+                # client is created per call, httplib2 isn't thread-safe
+                self.cloudstorage.objects().insert(bucket=bucket,
+                        name=part_names[num], media_body=media).execute()
+
+        try:
+            self._transfer_parts(parts, put_part, report_to)
+            self.cloudstorage.objects().compose(destinationBucket=bucket,
+                    destinationObject=name, body={
+                        'sourceObjects': [{'name': part} for part in part_names],
+                        'destination': {'contentType': 'application/octet-stream'}
+                    }).execute()
+        finally:
+            for part in part_names:
+                try:
+                    self.cloudstorage.objects().delete(bucket=bucket, object=part).execute()
+                except HttpError, e:
+                    LOG.debug('Failed to delete part %s: %s', part, e)
+
+
+    def _get_range(self, bucket, name, fp, offset, length):
+        request = self.cloudstorage.objects().get_media(bucket=bucket, object=name)
+        request.headers['range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        fp.write(request.execute())
+
+
     def _list_buckets(self):
         pl = bus.platform
         proj_id = pl.get_numeric_project_id()
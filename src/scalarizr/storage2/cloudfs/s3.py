@@ -4,9 +4,11 @@ __author__ = 'vladimir'
 import logging
 import os
 import sys
+import threading
 
 from scalarizr.node import __node__
-from scalarizr.storage2.cloudfs.base import CloudFileSystem
+from scalarizr.storage2.cloudfs.base import CloudFileSystem, read_part, \
+        open_source, source_size, source_name
 from scalarizr.storage2.cloudfs import cloudfs_types
 
 from boto.s3.key import Key
@@ -22,6 +24,19 @@ class S3FileSystem(CloudFileSystem):
 
     _bucket = None
 
+    features = {
+            'multipart': True
+    }
+
+    # S3 limits
+    max_parts = 10000
+    min_part_size = 5 * 1024 * 1024
+
+    # FileTransfer workers use their own driver instances,
+    # so multipart uploads in progress are shared between them
+    _uploads = {}
+    _uploads_lock = threading.Lock()
+
     # TODO: change report frequency
     def __init__(self, acl='aws-exec-read', report_frequency=11):
         self.acl = acl
@@ -54,7 +69,7 @@ class S3FileSystem(CloudFileSystem):
         LOG.info("Uploading '%s' to S3 under '%s'", local_path, remote_path)
         bucket_name, key_name = self._parse_url(remote_path)
         if key_name.endswith("/"):
-            key_name = os.path.join(key_name, os.path.basename(local_path))
+            key_name = os.path.join(key_name, os.path.basename(source_name(local_path)))
         LOG.debug("Uploading '%s'", key_name)
 
         try:
@@ -75,15 +90,20 @@ class S3FileSystem(CloudFileSystem):
                 # Cache bucket
                 self._bucket = bck
 
+            size = source_size(local_path)
+            if size > max(self.multipart_threshold, self.min_part_size):
+                self._put_parts(local_path, key_name, size, report_to)
+                return self._format_url(bucket_name, key_name)
+
             file_ = None
             try:
                 key = Key(self._bucket)
                 key.name = key_name
-                file_ = open(local_path, "rb")
-                LOG.debug("Actually uploading %s", os.path.basename(local_path))
+                file_ = open_source(local_path)
+                LOG.debug("Actually uploading %s", os.path.basename(key_name))
                 key.set_contents_from_file(file_, policy=self.acl,
                         cb=report_to, num_cb=self.report_frequency)
-                LOG.debug("Finished uploading %s", os.path.basename(local_path))
+                LOG.debug("Finished uploading %s", os.path.basename(key_name))
                 return self._format_url(bucket_name, key_name)
             finally:
                 if file_:
@@ -107,8 +127,13 @@ class S3FileSystem(CloudFileSystem):
         assert key, "No such key: %s" % key_name
 
         LOG.debug("Actually downloading %s", os.path.basename(dest_path))
-        key.get_contents_to_filename(dest_path, cb=report_to,
-                num_cb=self.report_frequency)
+        if key.size > self.multipart_threshold:
+            self._get_ranges(dest_path, key.size,
+                    lambda fp, offset, length: self._get_range(key_name, fp, offset, length),
+                    report_to)
+        else:
+            key.get_contents_to_filename(dest_path, cb=report_to,
+                    num_cb=self.report_frequency)
         LOG.debug("Finished downloading %s", os.path.basename(dest_path))
         return dest_path
 
@@ -124,6 +149,60 @@ class S3FileSystem(CloudFileSystem):
 
         return key.delete() if key else None
 
+    def multipart_init(self, path, part_size):
+        '''
+        Returns upload_id
+        '''
+        bucket_name, key_name = self._parse_url(path)
+        if not self._bucket_check_cache(bucket_name):
+            self._bucket = self._get_connection().get_bucket(bucket_name, validate=False)
+        mp = self._bucket.initiate_multipart_upload(key_name, policy=self.acl)
+        with self._uploads_lock:
+            self._uploads[mp.id] = mp
+        return mp.id
+
+    def multipart_put(self, upload_id, part_num, src):
+        # FileTransfer counts parts from 0, S3 from 1
+        with open_source(src) as fp:
+            self._uploads[upload_id].upload_part_from_file(fp, part_num + 1)
+
+    def multipart_complete(self, upload_id):
+        with self._uploads_lock:
+            mp = self._uploads.pop(upload_id)
+        mp.complete_upload()
+        return self._format_url(mp.bucket_name, mp.key_name)
+
+    def multipart_abort(self, upload_id):
+        with self._uploads_lock:
+            mp = self._uploads.pop(upload_id, None)
+        if mp:
+            mp.cancel_upload()
+
+    def _put_parts(self, local_path, key_name, size, report_to=None):
+        mp = self._bucket.initiate_multipart_upload(key_name, policy=self.acl)
+        LOG.debug('Uploading %s in parts, upload id: %s', key_name, mp.id)
+
+        def put_part(num, offset, length):
+            with read_part(local_path, offset, length) as fp:
+                mp.upload_part_from_file(fp, num + 1, size=length)
+
+        try:
+            self._transfer_parts(self._part_ranges(size, self.max_parts),
+                    put_part, report_to)
+            mp.complete_upload()
+        except:
+            exc_info = sys.exc_info()
+            try:
+                mp.cancel_upload()
+            except:
+                LOG.debug('Failed to cancel upload %s: %s', mp.id, sys.exc_info()[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _get_range(self, key_name, fp, offset, length):
+        key = self._bucket.new_key(key_name)
+        key.get_contents_to_file(fp,
+                headers={'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+
     def _bucket_check_cache(self, bucket):
         if self._bucket and self._bucket.name != bucket:
             self._bucket = None
@@ -5,7 +5,8 @@ import logging
 
 from swiftclient.client import ClientException
 
-from scalarizr.storage2.cloudfs.base import CloudFileSystem
+from scalarizr.storage2.cloudfs.base import CloudFileSystem, read_part, \
+        open_source, source_size, source_name
 from scalarizr.storage2.cloudfs import cloudfs_types
 from scalarizr.node import __node__
 
@@ -17,40 +18,48 @@ LOG = logging.getLogger(__name__)
 
 class SwiftFileSystem(CloudFileSystem):
 
+    # Files larger than multipart_threshold are uploaded as segments
+    # into <container>_segments and a manifest object pointing to them
+    segments_container_suffix = '_segments'
+
     def _get_connection(self):
         return __node__['openstack']['new_swift_connection']
 
 
     def ls(self, remote_path):
         container, prefix = self._parse_url(remote_path)
-        conn = self._get_connection()
-        objects = conn.get_container(container)[1]
-
-        objects = (obj["name"] for obj in objects)
-
         if prefix:
             prefix = prefix.rstrip("/") + "/"
-            objects = (obj for obj in objects if obj.startswith(prefix))
+        conn = self._get_connection()
+        # Without full_listing only the first 10000 objects are returned
+        objects = conn.get_container(container, prefix=prefix or None,
+                        full_listing=True)[1]
 
-        return tuple((self._format_url(container, obj) for obj in objects))
+        return tuple((self._format_url(container, obj["name"]) for obj in objects))
 
 
     def put(self, local_path, remote_path, report_to=None):
         LOG.info("Uploading '%s' to Swift under '%s'", local_path, remote_path)
         container, object_ = self._parse_url(remote_path)
         if object_.endswith("/"):
-            object_ = os.path.join(object_, os.path.basename(local_path))
+            object_ = os.path.join(object_, os.path.basename(source_name(local_path)))
 
-        fd = open(local_path, 'rb')
+        size = source_size(local_path)
+        if size > self.multipart_threshold:
+            self._put_segments(local_path, container, object_, size, report_to)
+            return self._format_url(container, object_)
+
+        fd = open_source(local_path)
         try:
             conn = self._get_connection()
             try:
-                conn.put_object(container, object_, fd)
+                conn.put_object(container, object_, fd, content_length=size)
             except ClientException, e:
                 if e.http_reason == "Not Found":
                     # stand closer, shoot again
                     conn.put_container(container)
-                    conn.put_object(container, object_, fd)
+                    fd.seek(0)
+                    conn.put_object(container, object_, fd, content_length=size)
                 else:
                     raise
         finally:
@@ -65,9 +74,16 @@ class SwiftFileSystem(CloudFileSystem):
         #? join only if local_path.endswith("/")
         dest_path = os.path.join(local_path, os.path.basename(remote_path))
 
+        conn = self._get_connection()
+        size = int(conn.head_object(container, object_)['content-length'])
+        if size > self.multipart_threshold:
+            self._get_ranges(dest_path, size,
+                    lambda fp, offset, length: self._get_range(container, object_, fp, offset, length),
+                    report_to)
+            return dest_path
+
         fd = open(dest_path, 'w')
         try:
-            conn = self._get_connection()
             res = conn.get_object(container, object_)
             fd.write(res[1])
         finally:
@@ -81,7 +97,12 @@ class SwiftFileSystem(CloudFileSystem):
 
         try:
             conn = self._get_connection()
+            manifest = conn.head_object(container, object_).get('x-object-manifest')
             conn.delete_object(container, object_)
+            if manifest:
+                seg_container, prefix = manifest.split('/', 1)
+                for obj in conn.get_container(seg_container, prefix=prefix, full_listing=True)[1]:
+                    conn.delete_object(seg_container, obj['name'])
         except ClientException, e:
             if e.http_reason == "Not Found":
                 return False
@@ -89,4 +110,30 @@ class SwiftFileSystem(CloudFileSystem):
                 raise
 
 
+
+    def _put_segments(self, local_path, container, object_, size, report_to=None):
+        seg_container = container + self.segments_container_suffix
+        # Unique prefix, so segments of the previous version are never mixed in
+        prefix = '%s/%d/' % (object_, size)
+        conn = self._get_connection()
+        conn.put_container(container)
+        conn.put_container(seg_container)
+
+        def put_segment(num, offset, length):
+            with read_part(local_path, offset, length) as fp:
+                # connections aren't thread-safe
+                self._get_connection().put_object(seg_container,
+                                '%s%08d' % (prefix, num), fp, content_length=length)
+
+        self._transfer_parts(self._part_ranges(size), put_segment, report_to)
+        conn.put_object(container, object_, '',
+                        headers={'X-Object-Manifest': '%s/%s' % (seg_container, prefix)})
+
+
+    def _get_range(self, container, object_, fp, offset, length):
+        res = self._get_connection().get_object(container, object_,
+                        headers={'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+        fp.write(res[1])
+
+
 cloudfs_types["swift"] = SwiftFileSystem
@@ -47,16 +47,13 @@ class FreeDeviceLetterMgr(object):
         self._local = threading.local()
 
     def __enter__(self):
-        letters = list(self._all - self._acquired)
-        letters.sort()
-        for l in letters:
-            pattern = name2device('/dev/vd' + l) + '*'
-            if not glob.glob(pattern):
-                with self._lock:
-                    if not l in self._acquired:
-                        self._acquired.add(l)
-                        self._local.letter = l
-                        return self
+        with self._lock:
+            for l in sorted(self._all - self._acquired):
+                pattern = name2device('/dev/vd' + l) + '*'
+                if not glob.glob(pattern):
+                    self._acquired.add(l)
+                    self._local.letter = l
+                    return self
         msg = 'No free letters for block device name remains'
         raise storage2.StorageError(msg)
 
@@ -65,7 +62,8 @@ class FreeDeviceLetterMgr(object):
 
     def __exit__(self, *args):
         if hasattr(self._local, 'letter'):
-            self._acquired.remove(self._local.letter)
+            with self._lock:
+                self._acquired.remove(self._local.letter)
             del self._local.letter
 
 
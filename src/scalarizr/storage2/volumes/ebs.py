@@ -57,18 +57,18 @@ class FreeDeviceLetterMgr(object):
 
 
     def __enter__(self):
+        # Letter is checked and acquired atomically, so concurrent attaches get different ones
         with self._lock:
             detached = __node__['ec2']['t1micro_detached_ebs'] or list()
             detached = set(name[-1] for name in detached)
-        letters = list(set(self._all) - self._acquired - detached)
-        for l in letters:
-            pattern = name2device('/dev/sd' + l) + '*'
-            if not glob.glob(pattern):
-                with self._lock:
-                    if not l in self._acquired:
-                        self._acquired.add(l)
-                        self._local.letter = l
-                        return self
+            for l in self._all:
+                if l in self._acquired or l in detached:
+                    continue
+                pattern = name2device('/dev/sd' + l) + '*'
+                if not glob.glob(pattern):
+                    self._acquired.add(l)
+                    self._local.letter = l
+                    return self
         msg = 'No free letters for block device name remains'
         raise storage2.StorageError(msg)
 
@@ -77,13 +77,170 @@ class FreeDeviceLetterMgr(object):
 
     def __exit__(self, *args):
         if hasattr(self._local, 'letter'):
-            self._acquired.remove(self._local.letter)
+            with self._lock:
+                self._acquired.remove(self._local.letter)
             del self._local.letter
 
 
+class StatePoller(object):
+    '''
+    Background thread that refreshes all waited EBS volumes and snapshots
+    with one DescribeVolumes/DescribeSnapshots call per tick.
+    Interval grows when EC2 throttles requests and shrinks back after success
+    '''
+    min_interval = 5
+    max_interval = 60
+    # Waiters that came together are polled in one batch
+    batch_delay = 1
+    throttle_codes = ('RequestLimitExceeded', 'Throttling')
+
+    def __init__(self, connect=None):
+        self._connect = connect or (lambda: __node__['ec2']['connect_ec2']())
+        self._waiters = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self.interval = self.min_interval
+
+    def wait(self, obj, condition, timeout=None, error_text=None):
+        '''
+        Blocks until condition(obj) is true. obj is refreshed by poller
+
+        @param obj: boto Volume or Snapshot
+        @param condition: Callable that takes refreshed obj
+        '''
+        waiter = _Waiter(obj, condition, timeout, error_text)
+        with self._cond:
+            self._waiters.append(waiter)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='EbsStatePoller')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+        waiter.event.wait(timeout and timeout + self.max_interval + self.batch_delay)
+        if not waiter.event.isSet():
+            self._finish(waiter, waiter.timeout_error())
+        if waiter.exc_info:
+            raise waiter.exc_info[0], waiter.exc_info[1], waiter.exc_info[2]
+        return True
+
+    def _run(self):
+        next_poll = time.time() + self.batch_delay
+        while True:
+            with self._cond:
+                while not self._waiters:
+                    self._cond.wait()
+                    next_poll = max(next_poll, time.time() + self.batch_delay)
+            delay = next_poll - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                waiters = list(self._waiters)
+            try:
+                self._poll(waiters)
+            except:
+                # Waiters without timeout would block forever
+                LOG.warn('EBS state poller failed: %s', sys.exc_info()[1], exc_info=sys.exc_info())
+                for w in waiters:
+                    self._finish(w, sys.exc_info())
+            next_poll = time.time() + self.interval
+
+    def _poll(self, waiters):
+        try:
+            conn = self._connect()
+        except:
+            for w in waiters:
+                self._finish(w, sys.exc_info())
+            return
+        throttled = False
+        for kind in ('volume', 'snapshot'):
+            batch = [w for w in waiters if w.kind == kind]
+            if not batch:
+                continue
+            try:
+                self._refresh(conn, kind, batch)
+            except boto.exception.EC2ResponseError, e:
+                if e.error_code in self.throttle_codes:
+                    throttled = True
+                elif e.error_code and e.error_code.endswith('.NotFound') and len(batch) > 1:
+                    # Find out which one is missing
+                    for w in batch:
+                        try:
+                            self._refresh(conn, kind, [w])
+                        except:
+                            self._finish(w, sys.exc_info())
+                else:
+                    for w in batch:
+                        self._finish(w, sys.exc_info())
+            except:
+                for w in batch:
+                    self._finish(w, sys.exc_info())
+
+        if throttled:
+            self.interval = min(self.max_interval, self.interval * 2)
+            LOG.debug('EC2 throttles requests, poll every %d seconds', self.interval)
+        else:
+            self.interval = max(self.min_interval, self.interval / 2)
+
+        now = time.time()
+        for w in waiters:
+            if w.event.isSet():
+                continue
+            try:
+                if w.refreshed and w.condition(w.obj):
+                    self._finish(w)
+                elif w.deadline and now >= w.deadline:
+                    self._finish(w, w.timeout_error())
+            except:
+                self._finish(w, sys.exc_info())
+
+    def _refresh(self, conn, kind, waiters):
+        ids = list(set(w.obj.id for w in waiters))
+        if kind == 'volume':
+            fresh = conn.get_all_volumes(volume_ids=ids)
+        else:
+            fresh = conn.get_all_snapshots(snapshot_ids=ids)
+        fresh = dict((obj.id, obj) for obj in fresh)
+        for w in waiters:
+            if w.obj.id in fresh:
+                # Keep object bound to the waiter's connection
+                connection = w.obj.connection
+                w.obj._update(fresh[w.obj.id])
+                w.obj.connection = connection
+                w.refreshed = True
+
+    def _finish(self, waiter, exc_info=None):
+        with self._cond:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                waiter.exc_info = exc_info
+                waiter.event.set()
+
+
+class _Waiter(object):
+    def __init__(self, obj, condition, timeout, error_text):
+        self.obj = obj
+        self.kind = 'snapshot' if isinstance(obj, boto.ec2.snapshot.Snapshot) else 'volume'
+        self.condition = condition
+        self.timeout = timeout
+        self.deadline = timeout and time.time() + timeout
+        self.error_text = error_text
+        self.refreshed = False
+        self.event = threading.Event()
+        self.exc_info = None
+
+    def timeout_error(self):
+        msg = self.error_text + '. ' if self.error_text else ''
+        msg += 'Timeout: %d seconds reached' % (self.timeout, )
+        try:
+            raise BaseException(msg)
+        except BaseException:
+            return sys.exc_info()
+
+
 class EbsMixin(object):
 
     _conn = None
+    _state_poller = StatePoller()
 
     def __init__(self):
         self.error_messages.update({
@@ -318,6 +475,8 @@ class EbsVolume(base.Volume, EbsMixin):
                                 iops=self.iops,
                                 tags=self.tags)
                 size = ebs.size
+                # Let caller destroy volume when attach fails
+                self.id = ebs.id
 
             if not (ebs.volume_state() == 'in-use' and
                             ebs.attach_data.instance_id == self._instance_id()):
@@ -389,11 +548,9 @@ class EbsVolume(base.Volume, EbsMixin):
         msg = "EBS volume %s is not in 'available' state. " \
                         "Timeout reached (%s seconds)" % (
                         ebs.id, self._global_timeout)
-        util.wait_until(
-                lambda: ebs.update() == "available",
-                logger=LOG, timeout=self._global_timeout,
-                error_text=msg
-        )
+        self._state_poller.wait(ebs,
+                lambda ebs: ebs.volume_state() == 'available',
+                timeout=self._global_timeout, error_text=msg)
         LOG.debug('EBS volume %s available', ebs.id)
 
         if tags:
@@ -421,12 +578,11 @@ class EbsVolume(base.Volume, EbsMixin):
         LOG.debug('Checking that EBS volume %s is attached', ebs.id)
         msg = "EBS volume %s wasn't attached. Timeout reached (%s seconds)" % (
                         ebs.id, self._global_timeout)
-        util.wait_until(
-                lambda: ebs.update() and ebs.attachment_state() == 'attached',
-                logger=LOG, timeout=self._global_timeout,
-                error_text=msg
-        )
+        self._state_poller.wait(ebs,
+                lambda ebs: ebs.attachment_state() == 'attached',
+                timeout=self._global_timeout, error_text=msg)
         LOG.debug('EBS volume %s attached', ebs.id)
+        self._invalidate_block_device_mapping()
 
         device = name2device(device_name)
         LOG.debug('EBS device name %s is mapped to %s in operation system',
@@ -455,23 +611,28 @@ class EbsVolume(base.Volume, EbsMixin):
         msg = "EBS volume %s is not in 'available' state. " \
                         "Timeout reached (%s seconds)" % (
                         ebs.id, self._global_timeout)
-        util.wait_until(
-                lambda: ebs.update() == 'available',
-                logger=LOG, timeout=self._global_timeout,
-                error_text=msg
-        )
+        self._state_poller.wait(ebs,
+                lambda ebs: ebs.volume_state() == 'available',
+                timeout=self._global_timeout, error_text=msg)
         LOG.debug('EBS volume %s is available', ebs.id)
+        self._invalidate_block_device_mapping()
+
+
+    def _invalidate_block_device_mapping(self):
+        # Instance metadata caches block devices for a while
+        try:
+            __node__['ec2']['invalidate_metadata']('block-device-mapping')
+        except (KeyError, AttributeError):
+            pass
 
 
     def _wait_attachment_state_change(self, volume):
         ebs = self._ebs_volume(volume)
         msg = 'EBS volume %s hangs in attaching state. ' \
                         'Timeout reached (%s seconds)' % (ebs.id, self._global_timeout)
-        util.wait_until(
-                lambda: ebs.update() and ebs.attachment_state() not in ('attaching', 'detaching'),
-                logger=LOG, timeout=self._global_timeout,
-                error_text=msg
-        )
+        self._state_poller.wait(ebs,
+                lambda ebs: ebs.attachment_state() not in ('attaching', 'detaching'),
+                timeout=self._global_timeout, error_text=msg)
 
 
     def _wait_snapshot(self, snapshot):
@@ -480,11 +641,9 @@ class EbsVolume(base.Volume, EbsMixin):
         msg = "EBS snapshot %s wasn't completed. " \
                         "Timeout reached (%s seconds)" % (
                         snapshot.id, self._global_timeout)
-        util.wait_until(
-                lambda: snapshot.update() and snapshot.status != 'pending',
-                logger=LOG,
-                error_text=msg
-        )
+        self._state_poller.wait(snapshot,
+                lambda snapshot: snapshot.status != 'pending',
+                error_text=msg)
         if snapshot.status == 'error':
             msg = 'Snapshot %s creation failed. AWS status is "error"' % snapshot.id
             raise storage2.StorageError(msg)
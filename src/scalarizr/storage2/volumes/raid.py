@@ -26,6 +26,8 @@ class RaidVolume(base.Volume):
 
 
     lv_re = re.compile(r'Logical volume "([^\"]+)" created')
+    # Max number of disks created and attached at the same time
+    _ensure_concurrency = 4
 
 
     def __init__(self,
@@ -74,7 +76,6 @@ class RaidVolume(base.Volume):
             disks = []
             snaps = []
             try:
-                # @todo: create disks concurrently
                 for disk_snap in self.snap['disks']:
                     if self._v1_compat:
                         disk_snap = disk_snap['snapshot']
@@ -117,12 +118,7 @@ class RaidVolume(base.Volume):
 
         assert int(self.level) in (0,1,5,10), 'Unknown raid level: %s' % self.level
 
-        disks = []
-        for disk in self.disks:
-            disk = storage2.volume(disk)
-            disk.ensure()
-            disks.append(disk)
-        self.disks = disks
+        self.disks = self._ensure_disks(self.disks)
 
         disks_devices = [disk.device for disk in self.disks]
 
@@ -238,6 +234,55 @@ class RaidVolume(base.Volume):
         mdadm.mdadm('misc', raid_device, wait=True)
 
 
+    def _ensure_disks(self, disks):
+        '''
+        Concurrently ensures disks, returns list of disks in the same order.
+        When any of them fails, disks that were created here are destroyed
+        and the first error is reraised
+        '''
+        disks = [storage2.volume(disk) for disk in disks]
+        created = [not disk.id for disk in disks]
+        queue = Queue.Queue()
+        for disk in disks:
+            queue.put(disk)
+        errors = []
+
+        def ensure():
+            while not errors:
+                try:
+                    disk = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    disk.ensure()
+                except:
+                    exc_info = sys.exc_info()
+                    LOG.warn('Failed to ensure raid disk %s(%s): %s',
+                                    disk.id, disk.type, exc_info[1], exc_info=exc_info)
+                    errors.append(exc_info)
+
+        threads = []
+        for _ in range(min(self._ensure_concurrency, len(disks))):
+            t = threading.Thread(target=ensure, name='RaidDiskEnsure')
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        if errors:
+            # Rollback
+            for disk, new in zip(disks, created):
+                if new and disk.id:
+                    try:
+                        disk.destroy(force=True)
+                    except:
+                        exc_info = sys.exc_info()
+                        LOG.warn('Failed to destroy raid disk %s(%s): %s',
+                                        disk.id, disk.type, exc_info[1], exc_info=exc_info)
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return disks
+
+
     def _detach(self, force, **kwds):
         self.lvm_group_cfg = lvm2.backup_vg_config(self.vg)
         lvm2.vgremove(self.vg, force=True)
@@ -7,6 +7,7 @@ Created on Mar 14, 2012
 
 import time
 import Queue
+import collections
 import threading
 import weakref
 import logging
@@ -18,6 +19,22 @@ import sqlite3
 
 LOG = logging.getLogger(__name__)
 GLOBAL_TIMEOUT = 30
+# Rows returned together with execute() result. Statements returning
+# less rows are fully served in a single round trip
+PREFETCH_SIZE = 2
+# Rows transferred per fetchmany() round trip when paging through results
+FETCH_SIZE = 100
+
+
+def _executemany(conn, sql, seq_of_parameters):
+    # Autocommit connection: all statements in one explicit transaction
+    conn.execute('BEGIN')
+    try:
+        conn.executemany(sql, seq_of_parameters)
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
 
 class Proxy(object):
 
@@ -52,7 +69,9 @@ class CursorProxy(Proxy):
 
     def __init__(self, tasks_queue):
         super(CursorProxy, self).__init__(tasks_queue)
-        self._execute_result = None
+        self._rows = collections.deque()
+        self._more = False
+        self._rowcount = -1
         self._call('cursor_create', [self])
 
 
@@ -60,42 +79,72 @@ class CursorProxy(Proxy):
         args = [sql]
         if parameters:
             args += [parameters]
-        self._execute_result = self._call('cursor_execute', args)
+        result = self._call('cursor_execute', args)
 
-        if not self._execute_result:
-            self._execute_result = dict(data=[], rowcount=0)
+        if not result:
+            result = dict(data=[], rowcount=0, more=False)
+        self._rows = collections.deque(result['data'])
+        self._more = result['more']
+        self._rowcount = result['rowcount']
+        return self
 
-        # Temporary
-        #LOG.debug('Execute result: %s', self._execute_result)
 
-        self._execute_result['iter'] = iter(self._execute_result['data'] or [None])
-        return self
+    def _fetch_page(self, size):
+        result = self._call('cursor_fetchmany', [size])
+        self._rows.extend(result['data'])
+        self._more = result['more']
 
 
     def fetchone(self):
-        try:
-            return self._execute_result['iter'].next()
-        except StopIteration:
+        if self._rows is None:
             return None
+        if not self._rows and self._more:
+            self._fetch_page(FETCH_SIZE)
+        return self._rows.popleft() if self._rows else None
+
+
+    def fetchmany(self, size=FETCH_SIZE):
+        if self._rows is None:
+            return []
+        while len(self._rows) < size and self._more:
+            self._fetch_page(max(size - len(self._rows), FETCH_SIZE))
+        return [self._rows.popleft() for _ in xrange(min(size, len(self._rows)))]
 
 
     def fetchall(self):
+        if self._rows is None:
+            return None
+        while self._more:
+            self._fetch_page(FETCH_SIZE)
         try:
-            return self._execute_result['data']
+            return list(self._rows)
         finally:
-            self._execute_result['data'] = None
+            self._rows = None
+
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
 
     @property
     def rowcount(self):
-        return self._execute_result['rowcount']
+        return self._rowcount
 
 
     def close(self):
-        pass
-        #self._call('cursor_delete', wait=False)
+        # Release server cursor, only when it wasn't exhausted
+        if self._more:
+            self._more = False
+            self._call('cursor_close')
 
 
-    __del__ = close
+    def __del__(self):
+        if self._more:
+            # Client is already unregistered on server, don't wait for result
+            self._call('cursor_close', wait=False)
 
 
 class ConnectionProxy(Proxy):
@@ -114,6 +163,14 @@ class ConnectionProxy(Proxy):
         return self._call('conn_executescript', [sql])
 
 
+    def executemany(self, sql, seq_of_parameters):
+        '''
+        Executes sql with each parameters in one transaction.
+        Server runs it as a single task, so statements of other clients can't get into it
+        '''
+        return self._call('conn_executemany', [sql, list(seq_of_parameters)])
+
+
 
 
     def _get_row_factory(self):
@@ -203,21 +260,48 @@ class SqliteServer(object):
                 del self._cursors[hash]
         return result
         """
+        self._cursor_close(hash)
         if hash in self._clients:
             #LOG.debug('delete cursor %s', hash)
             del self._clients[hash]
 
 
+    def _cursor_close(self, hash):
+        cur = self._cursors.pop(hash, None)
+        if cur:
+            cur.close()
+
+
     def _cursor_execute(self, hash, *args, **kwds):
+        # Client may reuse cursor proxy before reading all rows
+        self._cursor_close(hash)
         cur = self._master_conn.cursor()
         try:
             cur.execute(*args, **kwds)
-            return {
-                    'data': cur.fetchall(),
-                    'rowcount': cur.rowcount
-            }
-        finally:
+            result = {'rowcount': cur.rowcount}
+            result.update(self._fetch_page(hash, cur, PREFETCH_SIZE))
+            return result
+        except:
+            self._cursor_close(hash)
             cur.close()
+            raise
+
+
+    def _cursor_fetchmany(self, hash, size=FETCH_SIZE):
+        if hash in self._cursors:
+            return self._fetch_page(hash, self._cursors[hash], size)
+        return {'data': [], 'more': False}
+
+
+    def _fetch_page(self, hash, cur, size):
+        data = cur.fetchmany(size) if cur.description else []
+        more = len(data) == size
+        if more:
+            self._cursors[hash] = cur
+        else:
+            self._cursors.pop(hash, None)
+            cur.close()
+        return {'data': data, 'more': more}
 
 
     def _cursor_fetchone(self, hash):
@@ -261,6 +345,10 @@ class SqliteServer(object):
         return self._master_conn.executescript(sql)
 
 
+    def _conn_executemany(self, hash, sql, seq_of_parameters):
+        _executemany(self._master_conn, sql, seq_of_parameters)
+
+
     def _conn_execute(self, hash, *args, **kwds):
         cur = self._cursor_create(hash, self._single_conn_proxy)
         try:
@@ -287,6 +375,97 @@ class SqliteServer(object):
             self._cursor_delete(hash)
 
 
+class ConnectionPool(object):
+    '''
+    Connection-per-thread alternative to SqliteServer.
+    Exposes ConnectionProxy interface, so it can be used as bus.db.
+    Each thread lazily opens its own autocommit connection in WAL journal mode,
+    so readers don't wait for a writer and threads don't serialize behind
+    a single queue.
+    '''
+
+    def __init__(self, conn_creator, busy_timeout=GLOBAL_TIMEOUT):
+        self._conn_creator = conn_creator
+        self._busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._local.conn = self._connect()
+        self._row_factory = conn.row_factory
+        self._text_factory = conn.text_factory
+
+
+    def _connect(self):
+        conn = self._conn_creator()
+        conn.isolation_level = None
+        # WAL requires SQLite >= 3.7.0. Older versions silently keep their journal mode
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=%d' % (self._busy_timeout * 1000))
+        return conn
+
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        if conn.row_factory is not self._row_factory:
+            conn.row_factory = self._row_factory
+        if conn.text_factory is not self._text_factory:
+            conn.text_factory = self._text_factory
+        return conn
+
+
+    def cursor(self):
+        return self._connection().cursor()
+
+
+    def commit(self):
+        # Connections are in autocommit mode, this only ends an explicit BEGIN
+        self._connection().commit()
+
+
+    def executescript(self, sql):
+        return self._connection().executescript(sql)
+
+
+    def executemany(self, sql, seq_of_parameters):
+        '''
+        Executes sql with each parameters in one transaction of the thread's connection
+        '''
+        _executemany(self._connection(), sql, seq_of_parameters)
+
+
+    def close(self):
+        # Close current thread connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+
+    def _get_row_factory(self):
+        return self._row_factory
+
+
+    def _set_row_factory(self, f):
+        self._row_factory = f
+        self._connection()
+
+
+    row_factory = property(_get_row_factory, _set_row_factory)
+
+
+    def _get_text_factory(self):
+        return self._text_factory
+
+
+    def _set_text_factory(self, f):
+        self._text_factory = f
+        self._connection()
+
+
+    text_factory = property(_get_text_factory, _set_text_factory)
+
+
 class _NULL(object):
     pass
 
@@ -0,0 +1,156 @@
+'''
+Load test for p2p message consumer: posts encrypted messages to a local
+consumer instance from several client threads and reports throughput,
+latency and number of rejected (503) requests.
+
+Usage:
+    PYTHONPATH=src python tests/benchmarks/bench_consumer.py [num_messages] [clients] [workers ...]
+
+Each workers value starts a separate consumer, 0 is the single-threaded server.
+'''
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import uuid
+import socket
+import binascii
+import httplib
+import tempfile
+import threading
+import ConfigParser
+import sqlite3 as sqlite
+
+from scalarizr.bus import bus
+from scalarizr.util import sqlite_server, cryptotool
+from scalarizr.messaging import p2p
+from scalarizr.messaging.p2p import consumer
+from scalarizr.messaging.p2p.security import P2pMessageSecurity
+
+
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '../../share/db.sql')
+
+
+class _Cnf(object):
+    # Messages and security filter read server id and crypto key through bus.cnf
+    def __init__(self):
+        self.rawini = ConfigParser.ConfigParser()
+        self.rawini.add_section('general')
+        self.rawini.set('general', 'server_id', str(uuid.uuid4()))
+
+    def read_key(self, path):
+        with open(path) as fp:
+            return fp.read()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _new_db():
+    db_file = tempfile.mktemp(suffix='.sqlite')
+    conn = sqlite.connect(db_file)
+    conn.executescript(open(DB_SCRIPT).read())
+    conn.close()
+
+    def connect():
+        conn = sqlite.connect(db_file, 5.0)
+        conn.row_factory = sqlite.Row
+        conn.text_factory = sqlite.OptimizedUnicode
+        return conn
+    return db_file, connect
+
+
+def _messages(count, crypto_key):
+    ret = []
+    for _ in xrange(count):
+        msg = p2p.P2pMessage('HostInit', meta={'server_id': str(uuid.uuid4())},
+                        body={'local_ip': '10.0.0.1', 'remote_ip': '8.8.8.8',
+                        'behaviour': ['app', 'www'], 'role_name': 'bench'})
+        ret.append(cryptotool.encrypt(msg.toxml(), crypto_key))
+    return ret
+
+
+def _client(port, messages, latencies, statuses, lock):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    for data in messages:
+        start = time.time()
+        try:
+            conn.request('POST', '/control', data, {'Content-Type': 'application/xml'})
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            status = 'error'
+        with lock:
+            latencies.append(time.time() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+
+def run(workers, messages, clients, key_path):
+    db_file, connect = _new_db()
+    bus.db = sqlite_server.ConnectionPool(connect)
+    p2p._message_store = None
+    port = _free_port()
+    cons = consumer.P2pMessageConsumer('http://127.0.0.1:%d' % port,
+                    msg_handler_enabled=False, workers=workers)
+    cons.filters['protocol'].append(P2pMessageSecurity('bench', key_path).in_protocol_filter)
+    server_thread = threading.Thread(target=cons.start)
+    server_thread.start()
+    try:
+        while not cons._server:
+            time.sleep(0.05)
+
+        latencies = []
+        statuses = {}
+        lock = threading.Lock()
+        threads = [threading.Thread(target=_client,
+                        args=(port, messages[i::clients], latencies, statuses, lock))
+                        for i in range(clients)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        latencies.sort()
+        pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        print '  workers: %-3d %8.3f s (%7.1f msg/s)  p50: %6.1f ms  p99: %6.1f ms  statuses: %s' % (
+                        workers, elapsed, len(messages) / elapsed, pct(0.5), pct(0.99), statuses)
+    finally:
+        cons.shutdown(force=True)
+        server_thread.join()
+        bus.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    workers = map(int, sys.argv[3:]) or [0, 4, 8]
+
+    crypto_key = cryptotool.keygen()
+    key_path = tempfile.mktemp()
+    with open(key_path, 'w') as fp:
+        fp.write(crypto_key)
+    bus.cnf = _Cnf()
+    try:
+        messages = _messages(num_messages, binascii.a2b_base64(crypto_key))
+        print 'messages: %d, clients: %d' % (num_messages, clients)
+        for w in workers:
+            run(w, messages, clients, key_path)
+    finally:
+        os.remove(key_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''
+Measures LargeTransfer split and restore throughput with different copy
+buffer sizes. 4096 is the buffer size LargeTransfer used before.
+
+Two passes for each buffer size:
+    split   - LargeTransfer._split of a file into a temporary dir
+    roundtrip - upload of a file to file:// storage with LargeTransfer and
+              download of it back (uses tmpfs tranzit volume, needs root),
+              then upload with in-memory chunks instead of tmpfs
+
+Usage:
+    PYTHONPATH=src python tests/benchmarks/bench_large_transfer.py [size_mb] [buf_size ...]
+'''
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from scalarizr.storage2 import cloudfs
+from scalarizr.storage2.cloudfs import local
+
+
+def _make_source(path, size_mb):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as fp:
+        for _ in xrange(size_mb):
+            fp.write(block)
+
+
+def _transfer(src, dst, buf_size, **kwds):
+    trn = cloudfs.LargeTransfer(src, dst, compressor=None, try_pigz=False, **kwds)
+    trn.buf_size = buf_size
+    return trn
+
+
+def bench_split(source, size_mb, buf_size):
+    workdir = tempfile.mkdtemp()
+    try:
+        trn = _transfer(source, 'file://%s/' % workdir, buf_size)
+        start = time.time()
+        with open(source, 'rb') as stream:
+            for chunk_name, _, _ in trn._split(stream, os.path.join(workdir, 'data.')):
+                os.remove(chunk_name)
+        return size_mb / (time.time() - start)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_roundtrip(source, size_mb, buf_size):
+    storage = tempfile.mkdtemp()
+    restored = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        manifest = _transfer(source, 'file://%s/' % storage, buf_size).run()
+        upload = size_mb / (time.time() - start)
+
+        start = time.time()
+        _transfer(manifest.cloudfs_path, restored, buf_size).run()
+        download = size_mb / (time.time() - start)
+        assert os.path.getsize(os.path.join(restored, os.path.basename(source))) == \
+                        size_mb * 1024 * 1024
+
+        start = time.time()
+        _transfer(source, 'file://%s/' % storage, buf_size, in_memory=True).run()
+        in_memory = size_mb / (time.time() - start)
+        return upload, download, in_memory
+    finally:
+        shutil.rmtree(storage)
+        shutil.rmtree(restored)
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    buf_sizes = map(int, sys.argv[2:]) or [4096, 64 * 1024, cloudfs.LargeTransfer.buf_size]
+
+    source = tempfile.mktemp()
+    _make_source(source, size_mb)
+    print 'source: %d MB' % size_mb
+    try:
+        for buf_size in buf_sizes:
+            split = bench_split(source, size_mb, buf_size)
+            if os.getuid() == 0:
+                upload, download, in_memory = bench_roundtrip(source, size_mb, buf_size)
+                print '  buf_size: %-8d split: %7.1f MB/s  upload: %7.1f MB/s  ' \
+                                'download: %7.1f MB/s  in-memory upload: %7.1f MB/s' % (
+                                buf_size, split, upload, download, in_memory)
+            else:
+                print '  buf_size: %-8d split: %7.1f MB/s' % (buf_size, split)
+    finally:
+        os.remove(source)
+
+
+if __name__ == '__main__':
+    main()
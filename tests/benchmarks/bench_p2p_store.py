@@ -0,0 +1,106 @@
+'''
+Measures p2p message store throughput on a large p2p_message table,
+with and without indexes from share/db.sql.
+
+Usage:
+    PYTHONPATH=src python tests/benchmarks/bench_p2p_store.py [num_messages]
+'''
+from __future__ import with_statement
+
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+import sqlite3 as sqlite
+
+from scalarizr.bus import bus
+from scalarizr.util import sqlite_server
+from scalarizr.messaging import p2p
+
+
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '../../share/db.sql')
+SENDER = 'bench'
+
+
+def _new_db(indexes):
+    script = open(DB_SCRIPT).read()
+    if not indexes:
+        script = re.sub(r'CREATE INDEX [^;]+;', '', script)
+    db_file = tempfile.mktemp(suffix='.sqlite')
+    conn = sqlite.connect(db_file)
+    conn.executescript(script)
+    conn.close()
+    return db_file
+
+
+def _connect_fn(db_file):
+    def connect():
+        conn = sqlite.connect(db_file, 5.0)
+        conn.row_factory = sqlite.Row
+        conn.text_factory = sqlite.OptimizedUnicode
+        return conn
+    return connect
+
+
+def _timeit(title, fn, count=1):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print '  %-36s %8.3f s (%9.1f ops/s)' % (title, elapsed, count / elapsed)
+
+
+def _load_n_plus_one(store):
+    # Loader used before bulk loading: one query per message
+    cur = store._conn().cursor()
+    cur.execute('SELECT queue, message_id FROM p2p_message '
+                    'WHERE is_ingoing = ? AND in_is_handled = ? ORDER BY id', [1, 0])
+    return [(row['queue'], store.load(row['message_id'], True)) for row in cur.fetchall()]
+
+
+def run(indexes, num_messages):
+    db_file = _new_db(indexes)
+    try:
+        bus.db = sqlite_server.ConnectionPool(_connect_fn(db_file))
+        p2p._message_store = None
+        store = p2p.P2pMessageStore()
+        print 'indexes: %s' % ('on' if indexes else 'off')
+
+        ids = ['%08d' % i for i in xrange(num_messages)]
+
+        def put():
+            for message_id in ids:
+                msg = p2p.P2pMessage('HostInit', body={'local_ip': '10.0.0.1',
+                                'platform_access_data': {'key': 'secret'}})
+                msg.id = message_id
+                store.put_ingoing(msg, 'control', SENDER)
+                store.put_outgoing(msg, 'control', SENDER)
+        _timeit('put_ingoing + put_outgoing', put, num_messages * 2)
+
+        sample = random.sample(ids, min(1000, num_messages))
+        _timeit('load', lambda: [store.load(i, True) for i in sample], len(sample))
+        _timeit('unhandled (N+1 loads)', lambda: _load_n_plus_one(store), num_messages)
+        _timeit('unhandled (single query)', store._get_unhandled_from_db, num_messages)
+        _timeit('get_undelivered', lambda: store.get_undelivered(SENDER), num_messages)
+        _timeit('mark_as_delivered', lambda: [store.mark_as_delivered(i) for i in sample],
+                        len(sample))
+        _timeit('mark_as_handled', lambda: [store.mark_as_handled(i) for i in sample[:100]],
+                        len(sample[:100]))
+        _timeit('mark_as_handled_many', lambda: store.mark_as_handled_many(ids), num_messages)
+    finally:
+        bus.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print 'messages: %d' % num_messages
+    run(True, num_messages)
+    run(False, num_messages)
+
+
+if __name__ == '__main__':
+    main()
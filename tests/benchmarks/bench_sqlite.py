@@ -0,0 +1,96 @@
+'''
+Compares SqliteServer (single queue) and ConnectionPool (connection per thread, WAL)
+under concurrent put_ingoing/put_outgoing load.
+
+Usage:
+    PYTHONPATH=src python tests/benchmarks/bench_sqlite.py [num_threads] [num_messages]
+'''
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import sqlite3 as sqlite
+
+from scalarizr.bus import bus
+from scalarizr.util import sqlite_server
+from scalarizr.messaging import p2p
+
+
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '../../share/db.sql')
+
+
+def _connect_fn(db_file):
+    def connect():
+        conn = sqlite.connect(db_file, 5.0)
+        conn.row_factory = sqlite.Row
+        conn.text_factory = sqlite.OptimizedUnicode
+        return conn
+    return connect
+
+
+def _new_db():
+    db_file = tempfile.mktemp(suffix='.sqlite')
+    conn = sqlite.connect(db_file)
+    conn.executescript(open(DB_SCRIPT).read())
+    conn.close()
+    return db_file
+
+
+def _server(db_file):
+    t = sqlite_server.SQLiteServerThread(_connect_fn(db_file))
+    t.setDaemon(True)
+    t.start()
+    sqlite_server.wait_for_server_thread(t)
+    return t.connection
+
+
+def _pool(db_file):
+    return sqlite_server.ConnectionPool(_connect_fn(db_file))
+
+
+def run(name, backend, num_threads, num_messages):
+    db_file = _new_db()
+    try:
+        bus.db = backend(db_file)
+        p2p._message_store = None
+        store = p2p.P2pMessageStore()
+
+        def work(n):
+            for i in xrange(num_messages):
+                msg = p2p.P2pMessage('HostInit', body={'local_ip': '10.0.0.%d' % (i % 255)})
+                msg.id = '%d-%d-in' % (n, i)
+                store.put_ingoing(msg, 'control', 'bench')
+                msg.id = '%d-%d-out' % (n, i)
+                store.put_outgoing(msg, 'control', 'bench')
+
+        threads = [threading.Thread(target=work, args=(n, )) for n in range(num_threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        total = num_threads * num_messages * 2
+        print '%-12s %6d inserts in %7.3f s (%8.1f/s)' % (name, total, elapsed, total / elapsed)
+    finally:
+        if isinstance(bus.db, sqlite_server.ConnectionPool):
+            bus.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+
+
+def main():
+    num_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    num_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print 'threads: %d, messages per thread: %d' % (num_threads, num_messages)
+    run('server', _server, num_threads, num_messages)
+    run('pool', _pool, num_threads, num_messages)
+
+
+if __name__ == '__main__':
+    main()
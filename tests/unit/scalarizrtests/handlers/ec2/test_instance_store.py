@@ -0,0 +1,90 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import mock
+
+from scalarizr.handlers import HandlerError
+from scalarizr.handlers.ec2.rebundle import RebundleInstanceStoreStrategy
+from scalarizr.storage2.cloudfs import local
+
+
+class TestStreamParts(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.images = tempfile.mkdtemp()
+        with mock.patch('scalarizr.handlers.ec2.rebundle.bus') as bus:
+            bus.platform.scalrfs.images.return_value = 'file://%s/' % self.images
+            self.strategy = RebundleInstanceStoreStrategy(mock.Mock(), 'role', 'image',
+                            [], destination=self.workdir)
+        self.strategy._IMAGE_CHUNK_SIZE = 1000
+        self.strategy._IMAGE_IO_SIZE = 300
+        self.strategy._MAX_PARTS_ON_DISK = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+        shutil.rmtree(self.images)
+
+    def test_split_stream(self):
+        data = os.urandom(2500)
+        src = tempfile.TemporaryFile()
+        src.write(data)
+        src.seek(0)
+        parts = list(self.strategy._split_stream(src, 'image', self.workdir))
+
+        self.assertEqual([p[0] for p in parts],
+                        ['image.part.00', 'image.part.01', 'image.part.02'])
+        self.assertEqual([p[2] for p in parts], [1000, 1000, 500])
+        for i, (part_name, digest, size) in enumerate(parts):
+            chunk = data[i * 1000:(i + 1) * 1000]
+            self.assertEqual(open(os.path.join(self.workdir, part_name)).read(), chunk)
+            self.assertEqual(digest, hashlib.sha1(chunk).hexdigest())
+
+    def test_stream_parts(self):
+        data_file = os.path.join(self.workdir, 'data')
+        data = os.urandom(5500)
+        open(data_file, 'w').write(data)
+        on_disk = []
+        split_stream = self.strategy._split_stream
+
+        def watch_disk(*args):
+            for part in split_stream(*args):
+                on_disk.append(len([name for name in os.listdir(self.workdir)
+                                if '.part.' in name]))
+                yield part
+        self.strategy._split_stream = watch_disk
+
+        parts = self.strategy._stream_parts('cat %s' % data_file, 'image', self.workdir)
+
+        self.assertEqual(len(parts), 6)
+        self.assertTrue(max(on_disk) <= 2)
+        self.assertEqual(self.strategy._uploaded_parts, set(p[0] for p in parts))
+        self.assertEqual(os.listdir(self.workdir), ['data'])
+        uploaded = ''.join(open(os.path.join(self.images, p[0])).read() for p in parts)
+        self.assertEqual(uploaded, data)
+
+    def test_stream_parts_command_failed(self):
+        self.assertRaises(HandlerError, self.strategy._stream_parts,
+                        'echo -n abc; exit 3', 'image', self.workdir)
+
+    def _bundle(self, key):
+        image_file = os.path.join(self.workdir, 'image')
+        open(image_file, 'w').write(os.urandom(3000))
+        digest_pipe = os.path.join(self.workdir, 'digest-pipe')
+        os.mkfifo(digest_pipe)
+        self.digest_file = os.path.join(self.workdir, 'digest')
+        cmd = self.strategy._bundle_cmd(image_file, self.digest_file, digest_pipe,
+                        key, '00' * 16)
+        return self.strategy._stream_parts(cmd, 'image', self.workdir)
+
+    def test_bundle(self):
+        parts = self._bundle('00' * 16)
+        self.assertTrue(parts)
+        self.assertTrue(open(self.digest_file).read().strip())
+
+    def test_bundle_encryption_failed(self):
+        # Bundle command exit status is openssl enc's, not the digest job's
+        self.assertRaises(HandlerError, self._bundle, 'not-a-hex-key')
@@ -0,0 +1,96 @@
+import threading
+import time
+
+from scalarizr import handlers
+
+import mock
+
+
+class _LogHandler(handlers.LogShippingHandler):
+    message_name = 'DeployLog'
+    flush_interval = 0.05
+
+    def __init__(self):
+        with mock.patch.object(handlers, 'bus') as bus:
+            handlers.LogShippingHandler.__init__(self)
+        self.task_id = 'task-1'
+        self.sent_bodies = []
+        self._msg_service.new_message.side_effect = lambda name, body: body
+        self._msg_service.get_producer.return_value.send.side_effect = \
+                        lambda queue, body: self.sent_bodies.append(body)
+
+    def message_body(self):
+        return dict(deploy_task_id=self.task_id)
+
+
+def _record(msg, *args):
+    return mock.Mock(msg=msg, args=args, levelno=20)
+
+
+def test_coalesce():
+    hdlr = _LogHandler()
+    for i in range(3):
+        hdlr.emit(_record('line %d', i))
+    hdlr.task_id = 'task-2'
+    hdlr.emit(_record('other task'))
+
+    assert hdlr.flush(timeout=5)
+    assert hdlr.sent_bodies == [
+            {'deploy_task_id': 'task-1', 'message': 'line 0\nline 1\nline 2'},
+            {'deploy_task_id': 'task-2', 'message': 'other task'}]
+
+
+def test_batch_size():
+    hdlr = _LogHandler()
+    hdlr.batch_size = 10
+    for _ in range(4):
+        hdlr.emit(_record('12345'))
+    assert hdlr.flush(timeout=5)
+    assert '\n'.join(b['message'] for b in hdlr.sent_bodies).split('\n') == ['12345'] * 4
+    assert all(len(b['message']) <= 10 for b in hdlr.sent_bodies)
+
+
+def test_emit_doesnt_wait_for_delivery():
+    hdlr = _LogHandler()
+    release = threading.Event()
+    hdlr._msg_service.get_producer.return_value.send.side_effect = \
+                    lambda queue, body: release.wait()
+    start = time.time()
+    for i in range(100):
+        hdlr.emit(_record('line %d', i))
+    assert time.time() - start < 0.5
+    assert not hdlr.flush(timeout=0.1)
+    # logging.shutdown() flushes without timeout, it doesn't wait either
+    start = time.time()
+    assert not hdlr.flush()
+    assert time.time() - start < 0.1
+    release.set()
+    assert hdlr.flush(timeout=5)
+
+
+def test_capacity():
+    hdlr = _LogHandler()
+    hdlr.capacity = 2
+    release = threading.Event()
+    hdlr._msg_service.get_producer.return_value.send.side_effect = \
+                    lambda queue, body: release.wait()
+    hdlr.emit(_record('in flight'))
+    while not hdlr._in_flight:
+        time.sleep(0.01)
+    for i in range(5):
+        hdlr.emit(_record('line %d', i))
+    assert hdlr.dropped == 3
+    release.set()
+    assert hdlr.flush(timeout=5)
+
+
+def test_send_failure():
+    hdlr = _LogHandler()
+    hdlr._msg_service.get_producer.return_value.send.side_effect = Exception('Scalr is down')
+    hdlr.emit(_record('lost'))
+    assert hdlr.flush(timeout=5)
+    hdlr._msg_service.get_producer.return_value.send.side_effect = \
+                    lambda queue, body: hdlr.sent_bodies.append(body)
+    hdlr.emit(_record('delivered'))
+    assert hdlr.flush(timeout=5)
+    assert hdlr.sent_bodies == [{'deploy_task_id': 'task-1', 'message': 'delivered'}]
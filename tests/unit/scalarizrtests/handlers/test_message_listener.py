@@ -0,0 +1,124 @@
+import threading
+import time
+
+from scalarizr import handlers
+
+import mock
+
+
+class _Handler(handlers.Handler):
+    def __init__(self, key=None, delay=0):
+        self.key = key
+        self.delay = delay
+        self.calls = []
+
+    def accept(self, message, queue, **kwds):
+        return True
+
+    def ordering_key(self, message, queue):
+        return self.key
+
+    def __call__(self, message):
+        time.sleep(self.delay)
+        self.calls.append((message.name, threading.currentThread().getName()))
+
+
+def _listener(chain, dispatch_workers=0):
+    with mock.patch.object(handlers, 'bus') as bus:
+        bus.cnf.rawini.get.return_value = 'base'
+        with mock.patch.object(handlers.MessageListener, 'get_handlers_chain'):
+            ln = handlers.MessageListener(dispatch_workers=dispatch_workers)
+    ln._accept_kwargs = {}
+    ln._handlers_chain = chain
+    return ln
+
+
+def _message(name):
+    message = mock.Mock(body={}, meta={})
+    message.name = name
+    return message
+
+
+def _call(ln, message):
+    with mock.patch.object(handlers, 'bus'):
+        ln(message, 'control')
+
+
+def test_serial():
+    hnd = _Handler(key='key')
+    ln = _listener([hnd])
+    _call(ln, _message('HostInit'))
+    assert hnd.calls == [('HostInit', threading.currentThread().getName())]
+    assert ln.get_stats()['_Handler']['calls'] == 1
+
+
+def test_parallel_keeps_key_order():
+    slow = _Handler(key='slow', delay=0.3)
+    fast = _Handler(key='fast')
+    inline = _Handler()
+    ln = _listener([slow, fast, inline], dispatch_workers=4)
+    try:
+        for name in ('HostInit', 'HostDown', 'HostUp'):
+            _call(ln, _message(name))
+        # Keyless handler runs in caller thread, keyed ones don't wait for the slow one
+        assert [c[0] for c in inline.calls] == ['HostInit', 'HostDown', 'HostUp']
+        time.sleep(0.1)
+        assert [c[0] for c in fast.calls] == ['HostInit', 'HostDown', 'HostUp']
+        assert len(slow.calls) < 3
+        ln.join()
+        assert [c[0] for c in slow.calls] == ['HostInit', 'HostDown', 'HostUp']
+        assert len(set(c[1] for c in slow.calls)) == 1
+    finally:
+        ln.shutdown()
+
+
+def test_stats():
+    class Failing(_Handler):
+        def __call__(self, message):
+            raise Exception('failed')
+    ln = _listener([Failing(key='k')], dispatch_workers=1)
+    try:
+        _call(ln, _message('HostInit'))
+        _call(ln, _message('HostInit'))
+        ln.join()
+        stats = ln.get_stats()['Failing']
+        assert stats['calls'] == 2
+        assert stats['errors'] == 2
+        assert stats['time_avg'] <= stats['time_max']
+    finally:
+        ln.shutdown()
+
+
+def test_dispatch_after_inline_handlers():
+    order = []
+    class Recording(_Handler):
+        def __call__(self, message):
+            _Handler.__call__(self, message)
+            order.append(self.key)
+    ln = _listener([Recording(key='scripts', delay=0.2), Recording()], dispatch_workers=2)
+    try:
+        with mock.patch.object(handlers, 'bus'):
+            pending = ln(_message('HostInit'), 'control')
+        assert order == [None]
+        done = threading.Event()
+        pending.then(done.set)
+        assert not done.isSet()
+        done.wait(5)
+        assert order == [None, 'scripts']
+    finally:
+        ln.shutdown()
+
+
+def test_serial_returns_nothing_pending():
+    ln = _listener([_Handler(key='key')])
+    with mock.patch.object(handlers, 'bus'):
+        assert ln(_message('HostInit'), 'control') is None
+
+
+def test_shutdown_completes_dispatched_calls():
+    hnd = _Handler(key='scripts', delay=0.1)
+    ln = _listener([hnd], dispatch_workers=1)
+    for name in ('HostInit', 'HostUp'):
+        _call(ln, _message(name))
+    ln.shutdown()
+    assert [c[0] for c in hnd.calls] == ['HostInit', 'HostUp']
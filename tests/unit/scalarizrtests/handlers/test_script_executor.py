@@ -11,6 +11,9 @@ from scalarizr.handlers import script_executor
 from scalarizr.config import ScalarizrState
 
 import os
+import time
+import signal
+import tempfile
 import platform
 import binascii
 import threading
@@ -115,3 +118,122 @@ class TestScript(object):
 
     def test_interrupted_and_timeouted(self):
         pass
+
+
+class _SupervisorTest(object):
+
+    def setup(self):
+        self.supervisor = script_executor.ScriptSupervisor()
+        self.patcher = mock.patch.object(script_executor, 'supervisor', self.supervisor)
+        self.patcher.start()
+        self.old_sigchld = signal.signal(signal.SIGCHLD, lambda *args: None)
+        self.supervisor.install_wakeup_fd()
+        script_executor.exec_dir_prefix = tempfile.mkdtemp() + '/scalr-scripting.'
+        script_executor.logs_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, self.old_sigchld)
+        self.patcher.stop()
+
+    def script(self, body, exec_timeout=10, **kwds):
+        script = script_executor.Script(name='test', body='#!/bin/sh\n' + body,
+                        exec_timeout=exec_timeout, event_name='HostInit', **kwds)
+        script.start()
+        return script
+
+
+class TestScriptSupervisor(_SupervisorTest):
+
+    def test_terminated(self):
+        self.supervisor.max_sleep = 10
+        scripts = [self.script('sleep 0.%d; echo done' % i) for i in range(1, 4)]
+        start = time.time()
+        for script in scripts:
+            assert self.supervisor.wait(script)
+        assert time.time() - start < 1
+        assert self.supervisor.stats['finished'] == 3
+        assert self.supervisor.stats['running'] == 0
+
+    def test_timeouted(self):
+        script = self.script('sleep 5', exec_timeout=1)
+        assert not self.supervisor.wait(script)
+        assert self.supervisor.stats['timeouted'] == 1
+        os.kill(script.pid, signal.SIGKILL)
+
+    def test_call_later(self):
+        calls = []
+        done = threading.Event()
+        self.supervisor.call_later(0.2, lambda: (calls.append(2), done.set()))
+        self.supervisor.call_later(0.1, calls.append, 1)
+        done.wait(2)
+        assert calls == [1, 2]
+
+
+class TestAsyncPool(object):
+
+    def test_limit(self):
+        with mock.patch.object(script_executor, 'bus'):
+            executor = script_executor.ScriptExecutor()
+        executor.async_workers = 2
+        running = []
+        lock = threading.Lock()
+        finished = threading.Event()
+        state = dict(max=0, done=0)
+
+        def execute(script):
+            with lock:
+                running.append(script)
+                state['max'] = max(state['max'], len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(script)
+                state['done'] += 1
+                if state['done'] == 6:
+                    finished.set()
+
+        executor._execute_one_script0 = execute
+        for i in range(6):
+            executor._execute_one_script(mock.Mock(asynchronous=True))
+        finished.wait(5)
+        assert state['done'] == 6
+        assert state['max'] == 2
+        assert len(executor._async_threads) == 2
+
+
+class TestScriptOutput(_SupervisorTest):
+
+    def test_incremental_read(self):
+        script = self.script('echo first; sleep 0.3; echo second; echo error >&2',
+                        execution_id='exec-1')
+        time.sleep(0.2)
+        assert script_executor.is_running('exec-1')
+        data, offset = script_executor.read_log('exec-1', 'stdout', 0)
+        assert data == 'first\n'
+
+        assert self.supervisor.wait(script)
+        data, offset = script_executor.read_log('exec-1', 'stdout', offset)
+        assert data == 'second\n'
+        assert offset == len('first\nsecond\n')
+        assert open(script.stdout_path).read() == 'first\nsecond\n'
+        assert script_executor.read_log('exec-1', 'stderr')[0] == 'error\n'
+
+    def test_ring_buffer(self):
+        script = self.script('for i in 1 2 3 4 5 6 7 8 9; do echo 0123456789; done',
+                        execution_id='exec-2')
+        assert self.supervisor.wait(script)
+        output = script.outputs['stdout']
+        with mock.patch.object(script_executor, 'logs_buffer_size', 20):
+            assert output.read(88, 11) == '0123456789\n'
+        assert output.size == 99
+        assert len(output._buf) == 20
+        # Dropped from memory, read from file
+        assert output.read(0, 11) == '0123456789\n'
+
+    def test_find_log_not_indexed(self):
+        path = os.path.join(script_executor.logs_dir, 'name.HostInit.exec-3-out.log')
+        open(path, 'w').write('out')
+        assert script_executor.find_log('exec-3', 'stdout') == path
+        assert script_executor.find_log('exec-3', 'stderr') is None
+        assert script_executor.read_log('exec-3', 'stdout', 1) == ('ut', 3)
+        assert script_executor.read_log('exec-4', 'stdout') is None
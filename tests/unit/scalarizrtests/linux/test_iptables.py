@@ -193,3 +193,82 @@ class TestIptables(object):
         iptables.chains["INPUT"].list.assert_called_once_with()
         iptables.chains["INPUT"].insert.assert_called_once_with(None, two_rules[0])
         assert not iptables.chains["INPUT"].append.called
+
+    @mock.patch('scalarizr.linux.iptables.os.access')
+    @mock.patch('scalarizr.linux.iptables.iptables_save')
+    def test_rule_set(self, iptables_save, access):
+        iptables.linux.build_cmd_args.side_effect = IPTABLES_LINUX.build_cmd_args
+        access.return_value = True
+        iptables_save.return_value = '*filter\n' \
+                ':INPUT ACCEPT [0:0]\n' \
+                '-A INPUT -s 192.168.0.1/32 -p tcp -m tcp --dport 22 -j ACCEPT\n' \
+                '-A INPUT -p tcp -m tcp --dport 22 -j DROP\n' \
+                'COMMIT\n'
+
+        with iptables.RuleSet() as rule_set:
+            rule_set.ensure(iptables.INPUT, [
+                    {"source": "192.168.0.1", "protocol": "tcp", "match": "tcp",
+                            "dport": 22, "jump": "ACCEPT"},
+                    {"source": "192.168.0.2", "protocol": "tcp", "match": "tcp",
+                            "dport": "22", "jump": "ACCEPT"},
+                    {"source": "192.168.0.3", "protocol": "tcp", "match": "tcp",
+                            "dport": "22", "jump": "ACCEPT"}])
+            rule_set.ensure(iptables.INPUT, [
+                    {"protocol": "tcp", "match": "tcp", "dport": "22", "jump": "DROP"}],
+                    append=True)
+            rule_set.remove(iptables.INPUT, [
+                    {"source": "192.168.0.1/32", "protocol": "tcp", "match": "tcp",
+                            "dport": "22", "jump": "ACCEPT"},
+                    {"source": "192.168.0.4", "protocol": "tcp", "match": "tcp",
+                            "dport": "22", "jump": "ACCEPT"}])
+
+        iptables_save.assert_called_once_with(table='filter')
+        iptables.linux.system.assert_called_once_with(
+                ['/sbin/iptables-restore', '--noflush'], stdin='*filter\n'
+                '-I INPUT --protocol tcp --match tcp --dport 22 --source 192.168.0.3 --jump ACCEPT\n'
+                '-I INPUT --protocol tcp --match tcp --dport 22 --source 192.168.0.2 --jump ACCEPT\n'
+                '-D INPUT --protocol tcp --match tcp --dport 22 --source 192.168.0.1/32 --jump ACCEPT\n'
+                'COMMIT\n')
+
+    @mock.patch('scalarizr.linux.iptables.iptables_save')
+    def test_rule_set_nothing_to_do(self, iptables_save):
+        iptables_save.return_value = '*filter\n' \
+                '-A INPUT -p tcp -m tcp --dport 22 -j DROP\n' \
+                'COMMIT\n'
+
+        with iptables.RuleSet() as rule_set:
+            rule_set.ensure(iptables.INPUT, [
+                    {"protocol": "tcp", "match": "tcp", "dport": 22, "jump": "DROP"}])
+            rule_set.remove(iptables.INPUT, [
+                    {"protocol": "tcp", "match": "tcp", "dport": 80, "jump": "DROP"}])
+
+        assert not iptables.linux.system.called
+
+    def test_canonical(self):
+        assert iptables._canonical({"source": "192.168.0.1", "dport": 22}) == \
+                iptables._canonical({"dport": "22", "source": "192.168.0.1/32",
+                                                        "table": "filter"})
+        assert iptables._canonical({"dport": "22"}) != \
+                iptables._canonical({"dport": "22", "jump": "DROP"})
+
+        index = iptables._RuleIndex([{"dport": "22"}, {"dport": "22"}])
+        assert {"dport": 22} in index
+        index.discard({"dport": 22})
+        assert {"dport": 22} in index
+        index.discard({"dport": 22})
+        assert {"dport": 22} not in index
+
+    @mock.patch('scalarizr.linux.iptables.PREROUTING.list')
+    @mock.patch('scalarizr.linux.iptables.PREROUTING.insert')
+    def test_ensure_lists_table_once(self, insert_w, list_w):
+        rules = [
+                {"table": "nat", "destination": "10.0.0.1", "jump": "DNAT"},
+                {"table": "nat", "destination": "10.0.0.2", "jump": "DNAT"},
+        ]
+        list_w.return_value = [
+                {"table": "nat", "destination": "10.0.0.1/32", "jump": "DNAT"}]
+
+        iptables.ensure({"PREROUTING": rules})
+
+        list_w.assert_called_once_with('nat')
+        insert_w.assert_called_once_with(None, rules[1])
@@ -0,0 +1,230 @@
+import os
+import time
+import socket
+import sqlite3
+import httplib
+import threading
+
+import mock
+
+from scalarizr import handlers
+from scalarizr.bus import bus
+from scalarizr.messaging import p2p
+from scalarizr.messaging.p2p import consumer
+from scalarizr.util import sqlite_server
+
+
+DATABASE = '/tmp/p2p_consumer_test.db'
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '../../../../../share/db.sql')
+
+
+def _connect():
+    conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class TestMessageHandler(object):
+
+    def setup(self):
+        self._db = bus.db
+        bus.db = sqlite_server.ConnectionPool(_connect)
+        bus.db.executescript(open(DB_SCRIPT).read())
+        p2p._message_store = None
+        self.store = p2p.P2pMessageStore()
+        self.consumer = consumer.P2pMessageConsumer('http://0.0.0.0:8013')
+        self.consumer.running = True
+        self.handled = []
+        self.done = threading.Event()
+
+    def teardown(self):
+        self.consumer.shutdown()
+        self.consumer._handler_thread.join(5)
+        bus.db.close()
+        bus.db = self._db
+        p2p._message_store = None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
+
+    def _message(self, message_id, name='HostInit'):
+        msg = p2p.P2pMessage(name, meta={'server_id': '1'})
+        msg.id = message_id
+        return msg
+
+    def _listener(self, count):
+        def listener(message, queue):
+            self.handled.append(message.id)
+            if len(self.handled) == count:
+                self.done.set()
+        return listener
+
+    def test_handle_in_order(self):
+        self.consumer.listeners.append(self._listener(5))
+        self.consumer._handler_thread.start()
+        for i in range(5):
+            self.store.put_ingoing(self._message(str(i)), 'control', 'consumer')
+
+        self.done.wait(5)
+        assert self.handled == ['0', '1', '2', '3', '4']
+        assert not self.store.get_unhandled('consumer')
+
+    def test_wait_acknowledge(self):
+        self.consumer.listeners.append(self._listener(2))
+        self.consumer.handler_locked = True
+        self.consumer._handler_thread.start()
+        self.store.put_ingoing(self._message('1', 'HostInit'), 'control', 'consumer')
+        self.store.put_ingoing(self._message('2', 'HostInitResponse'), 'control', 'consumer')
+        self.consumer.handler_locked = False
+
+        self.consumer.wait_acknowledge(self._message('0', 'HostInitResponse'))
+
+        self.done.wait(5)
+        assert self.handled == ['2', '1']
+
+    def test_dispatched_message_marked_when_done(self):
+        pending = handlers.PendingCalls(1)
+        def listener(message, queue):
+            self.handled.append(message.id)
+            self.done.set()
+            if message.id == '1':
+                return pending
+        self.consumer.listeners.append(listener)
+        self.consumer._handler_thread.start()
+        self.store.put_ingoing(self._message('1'), 'control', 'consumer')
+        self.done.wait(5)
+
+        # New message wakes the handler, dispatched one isn't handled twice
+        self.done.clear()
+        self.store.put_ingoing(self._message('2'), 'control', 'consumer')
+        self.done.wait(5)
+        time.sleep(0.1)
+        assert self.handled == ['1', '2']
+        assert [m.id for q, m in self.store.get_unhandled('consumer')] == ['1']
+
+        pending.done()
+        assert not self.store.get_unhandled('consumer')
+
+    def test_wait_subhandler_waits_dispatched_calls(self):
+        pending = handlers.PendingCalls(1)
+        def listener(message, queue):
+            threading.Timer(0.2, pending.done).start()
+            return pending
+        self.consumer.listeners.append(listener)
+        # Only the subhandler thread handles messages
+        self.consumer._handler_thread = threading.Thread(target=lambda: None)
+        self.consumer._handler_thread.start()
+        self.store.put_ingoing(self._message('1', 'BeforeHostUp'), 'control', 'consumer')
+
+        with mock.patch.object(consumer, 'bus'):
+            self.consumer.wait_subhandler(self._message('0', 'BeforeHostUp'))
+        assert not self.store.get_unhandled('consumer')
+
+    def test_shutdown_stops_listeners(self):
+        ln = mock.Mock()
+        self.consumer.listeners.append(ln)
+        self.consumer._handler_thread.start()
+        self.consumer.shutdown()
+        ln.shutdown.assert_called_once_with(timeout=self.consumer.dispatch_shutdown_timeout)
+
+    def test_shutdown_wakes_handler(self):
+        self.consumer._handler_thread.start()
+        self.consumer.shutdown()
+        self.consumer._handler_thread.join(5)
+        assert not self.consumer._handler_thread.isAlive()
+        assert self.consumer.handler_status == 'stopped'
+
+
+class TestServer(object):
+
+    def setup(self):
+        self._db = bus.db
+        bus.db = sqlite_server.ConnectionPool(_connect)
+        bus.db.executescript(open(DB_SCRIPT).read())
+        p2p._message_store = None
+        self.store = p2p.P2pMessageStore()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+    def teardown(self):
+        self.consumer.shutdown(force=True)
+        self.thread.join(5)
+        bus.db.close()
+        bus.db = self._db
+        p2p._message_store = None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
+
+    def _start(self, **kwds):
+        self.consumer = consumer.P2pMessageConsumer('http://127.0.0.1:%d' % self.port,
+                        msg_handler_enabled=False, **kwds)
+        self.thread = threading.Thread(target=self.consumer.start)
+        self.thread.start()
+        for _ in range(50):
+            if self.consumer._server:
+                break
+            time.sleep(0.1)
+
+    def _post(self, conn, message_id):
+        msg = p2p.P2pMessage('HostInit', meta={'server_id': '1'})
+        msg.id = message_id
+        conn.request('POST', '/control', msg.tojson(), {'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        resp.read()
+        return resp
+
+    def test_keep_alive(self):
+        self._start(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self._post(conn, '1')
+        sock = conn.sock
+        for i in range(2, 4):
+            assert self._post(conn, str(i)).status == 201
+        assert conn.sock is sock
+        conn.close()
+
+        assert [msg.id for _, msg in self.store.get_unhandled(self.consumer.endpoint)] == ['1', '2', '3']
+
+    def test_idle_connection_releases_thread(self):
+        self._start(workers=1)
+        conns = [httplib.HTTPConnection('127.0.0.1', self.port) for _ in range(3)]
+        for i in range(6):
+            assert self._post(conns[i % 3], str(i)).status == 201
+        for conn in conns:
+            conn.close()
+        assert len(self.store.get_unhandled(self.consumer.endpoint)) == 6
+
+    def test_bad_request_keeps_connection(self):
+        self._start(workers=1)
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        conn.request('POST', '/control', '{bad json', {'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 400
+        assert self._post(conn, '1').status == 201
+        conn.close()
+
+    def test_back_pressure(self):
+        self._start(workers=1, queue_size=1)
+        # Idle connection occupies the only server thread, next one waits in queue
+        idle = [socket.create_connection(('127.0.0.1', self.port))]
+        time.sleep(0.2)
+        idle.append(socket.create_connection(('127.0.0.1', self.port)))
+        time.sleep(0.2)
+
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        resp = self._post(conn, '1')
+        assert resp.status == 503
+        assert resp.getheader('Retry-After') == '1'
+        for sock in idle:
+            sock.close()
+
+    def test_single_threaded(self):
+        self._start(workers=0)
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        assert self._post(conn, '1').status == 201
+        conn.close()
+        assert len(self.store.get_unhandled(self.consumer.endpoint)) == 1
@@ -0,0 +1,124 @@
+import os
+import json
+import sqlite3
+import threading
+import urllib2
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from scalarizr.bus import bus
+from scalarizr.messaging import p2p
+from scalarizr.messaging.p2p import producer
+from scalarizr.util import sqlite_server
+
+import mock
+
+
+DATABASE = '/tmp/p2p_producer_test.db'
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '../../../../../share/db.sql')
+
+
+def _connect():
+    conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    status = 201
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _RequestHandler)
+        self.received = []
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.client_address, self.path, json.loads(data)['name']))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProducer(object):
+
+    def setup(self):
+        self._db = bus.db
+        bus.db = sqlite_server.ConnectionPool(_connect)
+        bus.db.executescript(open(DB_SCRIPT).read())
+        p2p._message_store = None
+        self.store = p2p.P2pMessageStore()
+        self.server = _Server()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.endpoint = 'http://127.0.0.1:%d/messaging' % self.server.server_address[1]
+        self.node = mock.patch.object(producer, '__node__', {'message_format': 'json'})
+        self.node.start()
+
+    def teardown(self):
+        self.node.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        bus.db.close()
+        bus.db = self._db
+        p2p._message_store = None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
+
+    def _message(self, name='HostInit'):
+        return p2p.P2pMessage(name, body={'local_ip': '10.0.0.1'})
+
+    def test_keep_alive(self):
+        prod = producer.P2pMessageProducer(self.endpoint)
+        for _ in range(3):
+            prod.send('control', self._message())
+        prod.shutdown()
+
+        assert len(self.server.received) == 3
+        assert len(set(addr for addr, _, _ in self.server.received)) == 1
+        assert self.server.received[0][1] == '/messaging/control'
+        assert not self.store.get_undelivered(prod.sender)
+
+    def test_reconnect(self):
+        prod = producer.P2pMessageProducer(self.endpoint)
+        prod.send('control', self._message())
+        # Server closed idle connection
+        prod._pool._idle[0].sock.close()
+        prod.send('control', self._message())
+        assert len(self.server.received) == 2
+
+    def test_error_status(self):
+        self.server.status = 400
+        prod = producer.P2pMessageProducer(self.endpoint)
+        try:
+            prod.send('control', self._message())
+            assert 0, 'HTTPError expected'
+        except urllib2.HTTPError, e:
+            assert e.code == 400
+        assert len(self.store.get_undelivered(prod.sender)) == 1
+
+    def test_async_delivery(self):
+        prod = producer.P2pMessageProducer(self.endpoint, '1')
+        undelivered = self._message('OperationProgress')
+        undelivered.id = 'undelivered'
+        self.store.put_outgoing(undelivered, 'log', prod.sender)
+
+        with mock.patch.object(prod, '_send0', wraps=prod._send0) as send0:
+            prod.start()
+            for name in ('Log', 'OperationResult', 'HostUp'):
+                prod.send('log' if name != 'HostUp' else 'control', self._message(name))
+            prod.shutdown()
+
+            # HostUp is sent synchronously, async messages keep their order
+            assert [name for _, _, name in self.server.received if name != 'HostUp'] == \
+                            ['OperationProgress', 'Log', 'OperationResult']
+            assert send0.call_count == 4
+        assert not self.store.get_undelivered(prod.sender)
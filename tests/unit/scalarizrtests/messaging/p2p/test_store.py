@@ -0,0 +1,115 @@
+import os
+import time
+import sqlite3
+import threading
+
+from scalarizr.bus import bus
+from scalarizr.messaging import p2p
+from scalarizr.util import sqlite_server
+
+
+DATABASE = '/tmp/p2p_store_test.db'
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '../../../../../share/db.sql')
+
+
+def _connect():
+    conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class TestMessageStore(object):
+
+    def setup(self):
+        self._db = bus.db
+        bus.db = sqlite_server.ConnectionPool(_connect)
+        bus.db.executescript(open(DB_SCRIPT).read())
+        p2p._message_store = None
+        self.store = p2p.P2pMessageStore()
+
+    def teardown(self):
+        bus.db.close()
+        bus.db = self._db
+        p2p._message_store = None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
+
+    def _message(self, message_id, name='HostInit'):
+        msg = p2p.P2pMessage(name, body={'platform_access_data': {'key': 'secret'}})
+        msg.id = message_id
+        return msg
+
+    def test_indexes(self):
+        cur = bus.db.cursor()
+        cur.execute("EXPLAIN QUERY PLAN SELECT * FROM p2p_message "
+                        "WHERE message_id = ? AND is_ingoing = ?", ['1', 1])
+        assert 'p2p_message_message_id_idx' in ' '.join(str(row[-1]) for row in cur.fetchall())
+
+    def test_get_unhandled_from_db(self):
+        for i in range(3):
+            self.store.put_ingoing(self._message(str(i)), 'control', 'consumer')
+        self.store.put_outgoing(self._message('out'), 'control', 'producer')
+
+        unhandled = self.store._get_unhandled_from_db()
+
+        assert [(queue, msg.id) for queue, msg in unhandled] == \
+                [('control', '0'), ('control', '1'), ('control', '2')]
+        assert unhandled[0][1].name == 'HostInit'
+
+    def test_get_undelivered(self):
+        self.store.put_outgoing(self._message('1'), 'log', 'producer')
+        self.store.put_outgoing(self._message('2'), 'log', 'producer')
+        self.store.mark_as_delivered('1')
+
+        undelivered = self.store.get_undelivered('producer')
+
+        assert [(queue, msg.id) for queue, msg in undelivered] == [('log', '2')]
+
+    def test_mark_as_handled_many(self):
+        for i in range(3):
+            self.store.put_ingoing(self._message(str(i)), 'control', 'consumer')
+
+        self.store.mark_as_handled_many(['0', '2', 'unknown'])
+
+        assert [msg.id for _, msg in self.store.get_unhandled('consumer')] == ['1']
+        assert [msg.id for _, msg in self.store._get_unhandled_from_db()] == ['1']
+        assert 'platform_access_data' not in self.store.load('0', True).body
+        assert 'platform_access_data' in self.store.load('1', True).body
+
+    def test_mark_as_handled_many_shared_connection(self):
+        # sqlite_server = 1: all threads use one connection served by a thread
+        t = sqlite_server.SQLiteServerThread(_connect)
+        t.setDaemon(True)
+        t.start()
+        sqlite_server.wait_for_server_thread(t)
+        pool, bus.db = bus.db, t.connection
+        try:
+            for i in range(3):
+                self.store.put_ingoing(self._message(str(i)), 'control', 'consumer')
+
+            self.store.mark_as_handled_many(['0', '2'])
+
+            assert [msg.id for _, msg in self.store._get_unhandled_from_db()] == ['1']
+        finally:
+            bus.db = pool
+
+    def test_get_unhandled_doesnt_copy(self):
+        msg = self._message('1')
+        self.store.put_ingoing(msg, 'control', 'consumer')
+        assert self.store.get_unhandled('consumer') == [('control', msg)]
+
+    def test_wait_ingoing(self):
+        seq = self.store.wait_ingoing()
+        received = []
+
+        def wait():
+            received.append(self.store.wait_ingoing(seq))
+        t = threading.Thread(target=wait)
+        t.start()
+        time.sleep(0.05)
+        assert not received
+
+        self.store.put_ingoing(self._message('1'), 'control', 'consumer')
+        t.join(1)
+        assert received == [seq + 1]
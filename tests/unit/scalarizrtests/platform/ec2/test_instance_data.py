@@ -1,64 +1,81 @@
 import unittest
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from scalarizr.platform.ec2 import Ec2Platform
-import threading
-
-class DummyBus:
-    cnf = None
-
-bus = DummyBus()
 
-class HttpRequestHanler(BaseHTTPRequestHandler):
+import mock
 
-    def do_GET(self):
-        if self.path in instance_data:
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(instance_data[self.path])
-        else:
-            self.send_response(404)
+from scalarizr.platform.ec2 import Ec2Platform
+from scalarizrtests.platform.metadata_server import MetadataServer
 
 
+instance_data = {'latest': {
+        'user-data': 'key=value;another_key=another_value',
+        'meta-data': {
+                'instance-id': 'i-12345678',
+                'ami-id': 'ami-12345678',
+                'local-ipv4': '123.123.123.123',
+                'public-ipv4': '1.1.1.1',
+                'placement': {'availability-zone': 'us-east-1a'},
+                'block-device-mapping': {'ami': 'sda1', 'ephemeral0': 'sdb'},
+                'public-keys': {'0=my-key': {'openssh-key': 'ssh-rsa AAA'}}
+        }
+}}
 
-instance_data = {"/latest/meta-data/instance-id"        : "i-12345678",
-                                 "/latest/meta-data/ami-id"                     : "ami-12345678",
-                                 "/latest/user-data"                            : "key=value;another_key=another_value",
-                                 "/latest/meta-data/local-ipv4"         : "123.123.123.123",
-                                 "/latest/meta-data/public-ipv4"        : "1.1.1.1"}
 
 class TestInstanceDataRetrieveing(unittest.TestCase):
 
+    def setUp(self):
+        self.server = MetadataServer(instance_data)
+        self.server.start()
+        with mock.patch('scalarizr.platform.bus'):
+            self.platform = Ec2Platform()
+        self.platform._meta_url = self.server.url
+
+    def tearDown(self):
+        self.server.stop()
 
     def test_metadata(self):
-        platform = Ec2Platform()
-        platform._meta_url = "http://localhost:9999/"
+        platform = self.platform
         self.assertEqual('i-12345678', platform.get_instance_id())
         self.assertEqual('ami-12345678', platform.get_ami_id())
         self.assertEqual("value", platform.get_user_data("key"))
         self.assertEqual("another_value", platform.get_user_data("another_key"))
         self.assertEqual("123.123.123.123", platform.get_private_ip())
         self.assertEqual("1.1.1.1", platform.get_public_ip())
-        self.assertTrue("1.1.1.1" in platform._metadata.values())
-
-class InstanceDataServer(threading.Thread):
-
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.server = HTTPServer(("localhost", 9999), HttpRequestHanler)
-
-    def run(self):
-        self.server.serve_forever()
-
-    def stop(self):
-        self.server.shutdown()
-        self.join()
-
-
-if __name__ == "__main__":
-
-    server = InstanceDataServer()
-    server.start()
-    try:
-        unittest.main()
-    finally:
-        server.stop()
+        self.assertEqual('', platform._get_property('undefined'))
+        # All requests are sent over one connection
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_cache(self):
+        self.platform.get_instance_id()
+        self.platform.get_instance_id()
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_prefetch(self):
+        self.platform.prefetch_metadata()
+        count = len(self.server.requests)
+
+        self.assertEqual('us-east-1', self.platform.get_region())
+        self.assertEqual({'ami': 'sda1', 'ephemeral0': 'sdb'},
+                        self.platform.get_block_device_mapping())
+        self.assertEqual('ssh-rsa AAA', self.platform.get_ssh_pub_key())
+        self.assertEqual(count, len(self.server.requests))
+
+    def test_invalidate_volatile(self):
+        self.assertEqual('1.1.1.1', self.platform.get_public_ip())
+        instance_data['latest']['meta-data']['public-ipv4'] = '2.2.2.2'
+        try:
+            self.assertEqual('1.1.1.1', self.platform.get_public_ip())
+            self.platform.invalidate_metadata('public-ipv4')
+            self.assertEqual('2.2.2.2', self.platform.get_public_ip())
+        finally:
+            instance_data['latest']['meta-data']['public-ipv4'] = '1.1.1.1'
+
+    def test_volatile_ttl(self):
+        self.platform.get_block_device_mapping()
+        self.platform.get_instance_id()
+        self.platform.metadata.volatile_ttl = 0
+        count = len(self.server.requests)
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.platform.get_block_device_mapping()
+            self.platform.get_instance_id()
+        # Block devices are fetched again, instance id is not
+        self.assertEqual(count + 3, len(self.server.requests))
@@ -0,0 +1,82 @@
+'''
+Local stand-in for EC2 instance metadata service.
+
+Usage:
+    server = MetadataServer({'latest': {'meta-data': {'instance-id': 'i-12345678'}}})
+    server.start()
+    platform._meta_url = server.url
+    ...
+    server.stop()
+'''
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server.owner
+        with server.lock:
+            server.requests.append(self.path)
+            server.connections.add(self.client_address)
+        node = server.tree
+        for name in self.path.strip('/').split('/'):
+            node = self._child(node, name)
+            if node is None:
+                break
+        if node is None:
+            body = ''
+            self.send_response(404)
+        elif isinstance(node, dict):
+            body = '\n'.join(name + ('/' if isinstance(value, dict) and '=' not in name else '')
+                            for name, value in sorted(node.items()))
+            self.send_response(200)
+        else:
+            body = str(node)
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _child(self, node, name):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                # 'public-keys' entries are listed as '0=keyname' and accessed as '0/'
+                if name in (key, key.split('=')[0]):
+                    return value
+
+    def log_message(self, *args):
+        pass
+
+
+class MetadataServer(object):
+    '''
+    Serves nested dict as metadata tree: dicts are directories,
+    other values are leaves. Directory named 'N=name' is listed as is
+    and accessed as 'N/', like public-keys entries. Tree can be changed while server is running.
+    Records requested paths and client connections.
+    '''
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _RequestHandler)
+        self._server.owner = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self.url = 'http://127.0.0.1:%d/' % self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,108 @@
+import time
+import threading
+import unittest
+
+import mock
+
+from scalarizr.platform import ConnectionPool
+from scalarizr.platform.ec2 import Ec2Platform
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+        self.factory = mock.Mock(side_effect=lambda: object())
+
+    def get_in_thread(self, key=('ec2', 'us-east-1')):
+        ret = []
+        def worker():
+            ret.append(self.pool.get(key, self.factory))
+            self.pool.release()
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        return ret[0]
+
+    def test_reuse_in_thread(self):
+        conn = self.pool.get(('ec2', 'us-east-1'), self.factory)
+        self.assertTrue(self.pool.get(('ec2', 'us-east-1'), self.factory) is conn)
+        self.assertFalse(self.pool.get(('ec2', 'us-west-1'), self.factory) is conn)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_reuse_after_release(self):
+        conn = self.get_in_thread()
+        self.assertTrue(self.get_in_thread() is conn)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_release_in_thread(self):
+        conn = self.pool.get(('ec2', 'us-east-1'), self.factory)
+        self.pool.release()
+        self.assertTrue(self.pool.get(('ec2', 'us-east-1'), self.factory) is conn)
+        self.assertTrue(self.get_in_thread() is not conn)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_concurrent_threads_dont_share(self):
+        conns = []
+        barrier = threading.Event()
+        def worker():
+            conns.append(self.pool.get(('ec2', 'us-east-1'), self.factory))
+            barrier.wait()
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        while len(conns) < 4:
+            time.sleep(0.01)
+        barrier.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(map(id, conns))), 4)
+
+    def test_invalidate(self):
+        conn = self.pool.get(('ec2', 'us-east-1'), self.factory)
+        self.get_in_thread()
+        self.pool.invalidate()
+        self.assertFalse(self.pool.get(('ec2', 'us-east-1'), self.factory) is conn)
+        self.get_in_thread()
+        self.assertEqual(self.factory.call_count, 4)
+
+    def test_max_age(self):
+        self.pool.max_age = 0
+        conn = self.pool.get(('ec2', 'us-east-1'), self.factory)
+        self.assertFalse(self.pool.get(('ec2', 'us-east-1'), self.factory) is conn)
+
+    def test_discard(self):
+        conn = self.pool.get(('ec2', 'us-east-1'), self.factory)
+        self.pool.discard(conn)
+        self.assertFalse(self.pool.get(('ec2', 'us-east-1'), self.factory) is conn)
+
+
+class TestPlatformConnections(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('scalarizr.platform.bus'):
+            self.platform = Ec2Platform()
+        self.platform.get_region = mock.Mock(return_value='us-east-1')
+        self.platform.set_access_data({'key_id': u'AKIA', 'key': u'secret'})
+
+    @mock.patch('scalarizr.platform.ec2.boto')
+    def test_new_ec2_conn_pooled(self, boto):
+        boto.ec2.connect_to_region.side_effect = lambda *args, **kwds: object()
+        conn = self.platform.new_ec2_conn()
+        self.assertTrue(self.platform.new_ec2_conn() is conn)
+        boto.ec2.connect_to_region.assert_called_once_with('us-east-1',
+                        aws_access_key_id='AKIA', aws_secret_access_key='secret')
+
+    @mock.patch('scalarizr.platform.ec2.boto')
+    def test_set_access_data_invalidates(self, boto):
+        boto.ec2.connect_to_region.side_effect = lambda *args, **kwds: object()
+        conn = self.platform.new_ec2_conn()
+        self.platform.set_access_data({'key_id': u'AKIA', 'key': u'secret'})
+        self.assertTrue(self.platform.new_ec2_conn() is conn)
+        self.platform.set_access_data({'key_id': u'AKIA2', 'key': u'secret2'})
+        self.assertFalse(self.platform.new_ec2_conn() is conn)
+        self.assertEqual(boto.ec2.connect_to_region.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,14 @@ Created on Sep 19, 2012
 '''
 import mock
 import os
+import sys
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 from Queue import Empty
 from os.path import basename
 from subprocess import call
@@ -12,6 +20,9 @@ from subprocess import call
 from nose.tools import assert_raises
 
 from scalarizr.storage2 import cloudfs
+from scalarizr.storage2.cloudfs import local
+from scalarizr.storage2.cloudfs import base
+from scalarizr.storage2.cloudfs.base import MemoryChunk, open_source, source_name
 
 
 class TestFileTransfer(object):
@@ -29,7 +40,11 @@ class TestFileTransfer(object):
         return generator
 
     def setup(self):
-        cloudfs.cloudfs = mock.MagicMock()
+        self.cloudfs = mock.patch.object(cloudfs, 'cloudfs')
+        self.cloudfs.start()
+
+    def teardown(self):
+        self.cloudfs.stop()
 
     def test_job_generator(self):
         # the simplest case (str str)
@@ -390,3 +405,452 @@ class TestFileTransfer(object):
         for job in completed:
             assert job in ret["completed"]
         assert ret["failed"] == []
+
+
+class TestConcurrencyController(object):
+
+    def setup(self):
+        self.stop = mock.Mock()
+        self.stop.isSet.return_value = False
+        self.ctl = cloudfs.ConcurrencyController(8, 2)
+
+    def run_window(self, success=True, rate=None):
+        for _ in range(self.ctl.limit):
+            assert self.ctl.acquire(self.stop)
+        for _ in range(self.ctl.limit):
+            self.ctl.release(success, rate=rate)
+
+    def test_throttling_halves_limit(self):
+        self.ctl.acquire(self.stop)
+        self.ctl.release(False, throttled=True)
+        assert self.ctl.limit == 4
+        for _ in range(3):
+            self.ctl.acquire(self.stop)
+            self.ctl.release(False, throttled=True)
+        assert self.ctl.limit == 2
+
+    def test_errors_halve_limit(self):
+        self.run_window(success=False)
+        assert self.ctl.limit == 4
+
+    def test_increase_while_throughput_grows(self):
+        self.ctl.limit = 4
+        self.run_window(rate=100)
+        assert self.ctl.limit == 5
+        self.run_window(rate=150)
+        assert self.ctl.limit == 6
+        # no gain from the 6th worker: back to 5 and stay there
+        self.run_window(rate=151)
+        assert self.ctl.limit == 5
+        self.run_window(rate=160)
+        self.run_window(rate=200)
+        assert self.ctl.limit == 5
+
+    def test_acquire_waits_for_slot(self):
+        self.ctl.limit = 1
+        assert self.ctl.acquire(self.stop)
+        self.stop.isSet.return_value = True
+        assert not self.ctl.acquire(self.stop)
+
+    def test_is_throttled(self):
+        assert cloudfs.is_throttled(mock.Mock(status=503, spec=['status']))
+        assert cloudfs.is_throttled(mock.Mock(http_status=429, spec=['http_status']))
+        assert cloudfs.is_throttled(mock.Mock(status=400, error_code='SlowDown'))
+        assert not cloudfs.is_throttled(Exception('Connection reset'))
+
+
+class SlowDownError(Exception):
+
+    status = 503
+    code = 'SlowDown'
+
+
+class ThrottledFileSystem(base.CloudFileSystem):
+
+    def put(self, src, dst, report_to=None):
+        raise SlowDownError('Please reduce your request rate')
+
+
+class TestFileTransferThrottling(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'data')
+        with open(self.src, 'wb') as fp:
+            fp.write('data')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_driver_error_unwrapped(self):
+        try:
+            ThrottledFileSystem().put(self.src, 'throttled://backups/')
+        except base.DriverError:
+            assert cloudfs.is_throttled(sys.exc_info()[1])
+        else:
+            assert False, 'DriverError expected'
+        assert not cloudfs.is_throttled(base.DriverError(Exception('Connection reset')))
+
+    def test_throttling_halves_limit(self):
+        with mock.patch.dict(cloudfs.cloudfs_types, throttled=ThrottledFileSystem):
+            trn = cloudfs.FileTransfer(src=self.src, dst='throttled://backups/',
+                            num_workers=4, retries=0)
+            res = trn.run()
+        assert len(res['failed']) == 1
+        assert trn._concurrency.limit == 2
+
+
+class TestFileTransferConnections(object):
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.workdir, 'data')
+        with open(self.src, 'wb') as fp:
+            fp.write('data')
+
+    def teardown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_workers_release_connections(self):
+        released = []
+        platform = mock.Mock()
+        platform.release_connections.side_effect = lambda: released.append(
+                        threading.currentThread().getName())
+        with mock.patch.object(cloudfs.bus, 'platform', platform):
+            cloudfs.FileTransfer(src=self.src, dst='file://%s/dst/' % self.workdir,
+                            num_workers=2).run()
+        assert sorted(released) == ['transfer-worker-0', 'transfer-worker-1']
+
+
+class TestFileTransferBackoff(object):
+
+    def test_backoff_is_capped(self):
+        obj = cloudfs.FileTransfer(src='/tmp/file', dst='s3://bucket/')
+        obj.backoff_base = 1
+        obj.backoff_max = 10
+        with mock.patch('random.uniform', side_effect=lambda low, high: high):
+            assert [obj._backoff(retry) for retry in range(1, 7)] == [1, 2, 4, 8, 10, 10]
+
+    def test_stats(self):
+        stats = cloudfs.TransferStats()
+        with mock.patch('time.time', side_effect=[0, 1, 2]):
+            stats.progress('a', 100)
+            stats.progress('b', 300)
+            stats.complete('a', 500)
+        assert stats.rate() == 350
+        assert stats.snapshot() == {'bytes': 800, 'rate': 350, 'errors': 0}
+
+
+class TestLargeTransferSplit(object):
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp()
+        self.data = os.urandom(2 * 1024 * 1024 + 12345)
+        self.trn = cloudfs.LargeTransfer(self.workdir, 's3://backups/', chunk_size=1)
+        self.trn.buf_size = 100000
+
+    def teardown(self):
+        shutil.rmtree(self.workdir)
+
+    def check_chunks(self, chunks):
+        assert [basename(c[0]) for c in chunks] == ['data.000', 'data.001', 'data.002'], chunks
+        assert [c[2] for c in chunks] == [1024 * 1024, 1024 * 1024, 12345]
+        pos = 0
+        for chunk_name, md5sum, size in chunks:
+            part = self.data[pos:pos + size]
+            assert open(chunk_name, 'rb').read() == part
+            assert md5sum == hashlib.md5(part).hexdigest()
+            pos += size
+
+    def test_split(self):
+        stream = tempfile.TemporaryFile()
+        stream.write(self.data)
+        stream.seek(0)
+
+        self.check_chunks(list(self.trn._split(stream, os.path.join(self.workdir, 'data.'))))
+
+    def test_split_without_readinto(self):
+        stream = StringIO(self.data)
+        assert not hasattr(stream, 'readinto')
+
+        self.check_chunks(list(self.trn._split(stream, os.path.join(self.workdir, 'data.'))))
+
+    def test_readinto_eintr(self):
+        stream = mock.Mock(spec=['readinto'])
+        stream.readinto.side_effect = [IOError(errno.EINTR, 'Interrupted'), 3]
+        view = memoryview(bytearray(10))
+
+        assert cloudfs.readinto(stream, view) == 3
+        assert stream.readinto.call_count == 2
+
+
+class LargeTransferTest(object):
+    # Transfers to file:// storage inside a temporary workdir
+
+    chunk = 1024 * 1024
+    transfer_kwds = {}
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp()
+        self.storage = 'file://%s/backups/' % self.workdir
+
+    def teardown(self):
+        shutil.rmtree(self.workdir)
+
+    def transfer(self, src, dst, **kwds):
+        kwds = dict(self.transfer_kwds, **kwds)
+        trn = cloudfs.LargeTransfer(src, dst, chunk_size=1, compressor=None, **kwds)
+        trn._tranzit_vol = mock.Mock(mpoint=tempfile.mkdtemp(dir=self.workdir))
+        return trn
+
+
+class TestLargeTransferDedup(LargeTransferTest):
+
+    def setup(self):
+        super(TestLargeTransferDedup, self).setup()
+        self.chunks_dir = os.path.join(self.workdir, 'backups', 'chunks')
+        self.blocks = [os.urandom(self.chunk) for _ in range(3)]
+
+    def upload(self, name, *blocks):
+        src = os.path.join(self.workdir, name)
+        with open(src, 'wb') as fp:
+            fp.write(''.join(self.blocks[i] for i in blocks))
+        return self.transfer(src, self.storage, dedup=True).run()
+
+    def download(self, manifest):
+        dst = tempfile.mkdtemp(dir=self.workdir)
+        self.transfer(manifest.cloudfs_path, dst).run()
+        return open(os.path.join(dst, manifest["files"][0]["name"]), 'rb').read()
+
+    def test_upload_skips_stored_chunks(self):
+        first = self.upload('first', 0, 1, 1)
+        assert len(os.listdir(self.chunks_dir)) == 2
+        assert first["chunk_store"] == os.path.join(self.storage, 'chunks', '')
+        assert len(first["files"][0]["chunks"]) == 3
+
+        with mock.patch.object(local.LocalFileSystem, 'put', side_effect=local.LocalFileSystem.put,
+                        autospec=True) as put:
+            self.upload('second', 1, 2)
+        uploaded = [basename(call[0][1]) for call in put.call_args_list
+                        if not call[0][2].endswith('.json')]
+        assert uploaded == [hashlib.md5(self.blocks[2]).hexdigest()], uploaded
+        assert len(os.listdir(self.chunks_dir)) == 3
+
+    def test_refs_saved_before_skipping(self):
+        self.upload('first', 0, 1)
+
+        with mock.patch.object(cloudfs.Manifest, 'save', side_effect=cloudfs.Manifest.save,
+                        autospec=True) as save:
+            self.upload('second', 0, 1, 2)
+        refs = [call[0][0] for call in save.call_args_list
+                        if '/refs/' in call[0][0].cloudfs_path]
+        # empty refs, before the first skip (next one is within chunk_refs_interval)
+        # and the final one
+        assert len(refs) == 3, refs
+        assert refs[-1]["pending"] is False
+        assert len(refs[-1]["chunks"]) == 3
+
+    def test_download(self):
+        self.upload('first', 0, 1)
+        second = self.upload('second', 1, 2, 1)
+
+        assert self.download(second) == self.blocks[1] + self.blocks[2] + self.blocks[1]
+
+    def test_delete_keeps_referenced_chunks(self):
+        first = self.upload('first', 0, 1)
+        second = self.upload('second', 1, 2)
+
+        first.delete()
+        stored = set(os.listdir(self.chunks_dir))
+        assert stored == set(hashlib.md5(self.blocks[i]).hexdigest() for i in (1, 2)), stored
+        assert not os.path.exists(first.cloudfs_path[len('file://'):])
+        assert self.download(second) == self.blocks[1] + self.blocks[2]
+
+        second.delete()
+        assert os.listdir(self.chunks_dir) == []
+        assert os.listdir(os.path.join(self.workdir, 'backups', 'refs')) == []
+
+    def test_delete_keeps_chunks_of_upload_in_progress(self):
+        first = self.upload('first', 0, 1)
+        # upload that has skipped block 1 as stored, but hasn't saved manifest yet
+        refs = cloudfs.Manifest()
+        refs.cloudfs_path = os.path.join(self.storage, 'refs', 'in-progress.json')
+        refs.data = {"chunk_store": first["chunk_store"], "pending": True,
+                        "updated_at": time.time(),
+                        "chunks": [hashlib.md5(self.blocks[1]).hexdigest()]}
+        refs.save()
+
+        with mock.patch.object(local.LocalFileSystem, 'ls', side_effect=local.LocalFileSystem.ls,
+                        autospec=True) as ls:
+            first.delete()
+        assert os.listdir(self.chunks_dir) == [hashlib.md5(self.blocks[1]).hexdigest()]
+        # only refs are listed, not the chunks
+        assert [call[0][1] for call in ls.call_args_list] == [
+                        os.path.join(self.storage, 'refs', '')]
+
+    def test_delete_ignores_abandoned_upload_refs(self):
+        first = self.upload('first', 0, 1)
+        refs = cloudfs.Manifest()
+        refs.cloudfs_path = os.path.join(self.storage, 'refs', 'abandoned.json')
+        refs.data = {"chunk_store": first["chunk_store"], "pending": True,
+                        "updated_at": time.time() - cloudfs.Manifest.pending_refs_ttl - 1,
+                        "chunks": [hashlib.md5(self.blocks[1]).hexdigest()]}
+        refs.save()
+
+        first.delete()
+        assert os.listdir(self.chunks_dir) == []
+
+    def test_delete_keeps_chunks_when_refs_unreadable(self):
+        first = self.upload('first', 0, 1)
+
+        with mock.patch.object(cloudfs.Manifest, '_referenced_chunks',
+                        side_effect=IOError('Connection reset')):
+            first.delete()
+        assert len(os.listdir(self.chunks_dir)) == 2
+        assert not os.path.exists(first.cloudfs_path[len('file://'):])
+
+    def test_upload_fails_when_skipped_chunk_deleted(self):
+        self.upload('first', 0)
+        stored = os.path.join(self.chunks_dir, hashlib.md5(self.blocks[0]).hexdigest())
+        stored_chunks = cloudfs.LargeTransfer._stored_chunks
+        def delete_after_listing(trn, strict=False):
+            ret = stored_chunks(trn, strict)
+            if not strict:
+                os.remove(stored)
+            return ret
+
+        with mock.patch.object(cloudfs.LargeTransfer, '_stored_chunks', delete_after_listing):
+            assert self.upload('second', 0, 1) is None
+        # only the first upload's refs remain
+        assert len(os.listdir(os.path.join(self.workdir, 'backups', 'refs'))) == 1
+
+
+class TestLargeTransferResume(LargeTransferTest):
+
+    transfer_kwds = {'num_workers': 1, 'retries': 0}
+
+    def setup(self):
+        super(TestLargeTransferResume, self).setup()
+        self.src = os.path.join(self.workdir, 'data')
+        self.blocks = [os.urandom(self.chunk) for _ in range(4)]
+        with open(self.src, 'wb') as fp:
+            fp.write(''.join(self.blocks))
+        self.journal_dir = mock.patch.object(cloudfs.LargeTransfer, 'journal_dir',
+                        os.path.join(self.workdir, 'journals'))
+        self.journal_dir.start()
+
+    def teardown(self):
+        self.journal_dir.stop()
+        super(TestLargeTransferResume, self).teardown()
+
+    def test_upload(self):
+        put = local.LocalFileSystem.put
+        def fail_third_chunk(self, src, url, report_to=None):
+            if src.endswith('.002'):
+                raise IOError('Connection reset')
+            return put(self, src, url, report_to)
+
+        with mock.patch.object(local.LocalFileSystem, 'put', fail_third_chunk):
+            trn = self.transfer(self.src, self.storage, resumable=True)
+            assert trn.run() is None
+        journal = cloudfs.TransferJournal(os.path.join(cloudfs.LargeTransfer.journal_dir,
+                        '%s.journal' % trn.transfer_id))
+        journaled = [entry["chunk"] for entry in journal.read()]
+        assert journaled == ['data.000', 'data.001', 'data.003'], journaled
+
+        with mock.patch.object(local.LocalFileSystem, 'put', side_effect=put,
+                        autospec=True) as put_mock:
+            manifest = self.transfer(self.src, self.storage).resume(trn.transfer_id)
+        uploaded = [basename(call[0][1]) for call in put_mock.call_args_list]
+        assert uploaded == ['data.002', 'manifest.json'], uploaded
+        assert not os.path.exists(journal.path)
+
+        dst = tempfile.mkdtemp(dir=self.workdir)
+        self.transfer(manifest.cloudfs_path, dst).run()
+        assert open(os.path.join(dst, 'data'), 'rb').read() == ''.join(self.blocks)
+
+    def test_download(self):
+        manifest = self.transfer(self.src, self.storage).run()
+        dst = tempfile.mkdtemp(dir=self.workdir)
+        with open(os.path.join(dst, 'data'), 'wb') as fp:
+            fp.write(self.blocks[0] + self.blocks[1] + 'partially written')
+        journal = cloudfs.TransferJournal(os.path.join(cloudfs.LargeTransfer.journal_dir,
+                        'restore.journal'))
+        journal.open()
+        for name, md5sum, size in manifest["files"][0]["chunks"][:2]:
+            journal.record(file='data', chunk=name, md5sum=md5sum)
+        journal.close()
+
+        get = local.LocalFileSystem.get
+        with mock.patch.object(local.LocalFileSystem, 'get', side_effect=get,
+                        autospec=True) as get_mock:
+            self.transfer(manifest.cloudfs_path, dst).resume('restore')
+        downloaded = [basename(call[0][1]) for call in get_mock.call_args_list]
+        assert downloaded == ['manifest.json', 'data.002', 'data.003'], downloaded
+        assert open(os.path.join(dst, 'data'), 'rb').read() == ''.join(self.blocks)
+        assert not os.path.exists(journal.path)
+
+    def test_journal_ignores_torn_entry(self):
+        journal = cloudfs.TransferJournal(os.path.join(self.workdir, 'journal'))
+        journal.open(truncate=True)
+        journal.record(chunk='data.000', md5sum='abc')
+        journal.close()
+        with open(journal.path, 'a') as fp:
+            fp.write('{"chunk": "data.0')
+
+        assert journal.read() == [{"chunk": "data.000", "md5sum": "abc"}]
+
+
+class TestLargeTransferInMemory(LargeTransferTest):
+
+    def setup(self):
+        super(TestLargeTransferInMemory, self).setup()
+        self.src = os.path.join(self.workdir, 'data')
+        self.data = os.urandom(3 * self.chunk + 12345)
+        with open(self.src, 'wb') as fp:
+            fp.write(self.data)
+
+    def test_split_falls_back_to_disk(self):
+        trn = self.transfer(self.src, self.storage, in_memory=True, memory_limit=2)
+
+        with open(self.src, 'rb') as stream:
+            chunks = list(trn._split(stream, os.path.join(self.workdir, 'data.')))
+
+        # buffers aren't released, so chunks after the second one go to disk
+        assert [type(c[0]) for c in chunks] == [MemoryChunk, MemoryChunk, str, str]
+        assert [basename(source_name(c[0])) for c in chunks] == [
+                        'data.000', 'data.001', 'data.002', 'data.003']
+        pos = 0
+        for chunk, md5sum, size in chunks:
+            fp = open_source(chunk)
+            assert fp.read() == self.data[pos:pos + size]
+            fp.close()
+            assert md5sum == hashlib.md5(self.data[pos:pos + size]).hexdigest()
+            pos += size
+        assert pos == len(self.data)
+
+    def test_upload(self):
+        sources = []
+        put = local.LocalFileSystem.put
+        def record_put(self, src, url, report_to=None):
+            sources.append(src)
+            return put(self, src, url, report_to)
+
+        trn = self.transfer(self.src, self.storage, in_memory=True, memory_limit=2,
+                        num_workers=2)
+        with mock.patch.object(local.LocalFileSystem, 'put', record_put):
+            manifest = trn.run()
+
+        assert not trn._tranzit_vol.ensure.called
+        chunks = [src for src in sources if isinstance(src, MemoryChunk)]
+        assert chunks
+        assert trn._buffers._allocated <= 2
+        assert len(trn._buffers._free) == trn._buffers._allocated
+
+        dst = tempfile.mkdtemp(dir=self.workdir)
+        self.transfer(manifest.cloudfs_path, dst).run()
+        assert open(os.path.join(dst, 'data'), 'rb').read() == self.data
+
+    def test_multipart_rejected(self):
+        assert_raises(ValueError, cloudfs.LargeTransfer, self.src, self.storage,
+                        in_memory=True, multipart=True)
@@ -0,0 +1,184 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+from nose.tools import assert_raises
+
+from scalarizr.storage2.cloudfs import s3
+from scalarizr.storage2.cloudfs.base import DriverError
+
+
+class FakeMultiPartUpload(object):
+    # Keeps parts in memory like S3 does until upload is completed
+
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.bucket_name = bucket.name
+        self.key_name = key_name
+        self.id = 'upload-%s' % key_name
+        self.parts = {}
+        self.completed = self.cancelled = False
+        self.fail_parts = {}
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        if self.fail_parts.get(part_num):
+            self.fail_parts[part_num] -= 1
+            raise IOError('Connection reset')
+        self.parts[part_num] = fp.read() if size is None else fp.read(size)
+
+    def complete_upload(self):
+        self.completed = True
+        self.bucket.keys[self.key_name] = ''.join(
+                        self.parts[num] for num in sorted(self.parts))
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeKey(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def size(self):
+        return len(self.bucket.keys[self.name])
+
+    def get_contents_to_file(self, fp, headers=None):
+        data = self.bucket.keys[self.name]
+        start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+        with self.bucket.lock:
+            self.bucket.ranges.append((start, end))
+        fp.write(data[start:end + 1])
+
+    def get_contents_to_filename(self, path, cb=None, num_cb=None):
+        with open(path, 'wb') as fp:
+            fp.write(self.bucket.keys[self.name])
+
+
+class FakeBucket(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.keys = {}
+        self.uploads = []
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def initiate_multipart_upload(self, key_name, policy=None):
+        mp = FakeMultiPartUpload(self, key_name)
+        self.uploads.append(mp)
+        return mp
+
+    def get_key(self, name):
+        return FakeKey(self, name) if name in self.keys else None
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+
+class TestS3Parts(object):
+
+    def setup(self):
+        self.bucket = FakeBucket('backups')
+        conn = mock.Mock()
+        conn.get_bucket.return_value = self.bucket
+        self.patcher = mock.patch.object(s3.S3FileSystem, '_get_connection',
+                        return_value=conn)
+        self.patcher.start()
+
+        self.driver = s3.S3FileSystem()
+        self.driver.multipart_threshold = 0
+        self.driver.min_part_size = 0
+        self.driver.part_size = 1000
+        self.driver.part_concurrency = 3
+
+        self.tmp = tempfile.mkdtemp()
+        self.data = os.urandom(4500)
+        self.src = os.path.join(self.tmp, 'data')
+        with open(self.src, 'wb') as fp:
+            fp.write(self.data)
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmp)
+
+    @mock.patch('scalarizr.storage2.cloudfs.base.time.sleep')
+    def test_put_in_parts(self, sleep):
+        reports = []
+        url = self.driver.put(self.src, 's3://backups/dir/',
+                        report_to=lambda done, total: reports.append((done, total)))
+
+        assert url == 's3://backups/dir/data'
+        mp = self.bucket.uploads[0]
+        assert mp.completed
+        assert sorted(mp.parts) == [1, 2, 3, 4, 5]
+        assert self.bucket.keys['dir/data'] == self.data
+        assert reports[-1] == (4500, 4500)
+
+    @mock.patch('scalarizr.storage2.cloudfs.base.time.sleep')
+    def test_put_part_retried(self, sleep):
+        self.driver.part_retries = 2
+        self.bucket.initiate_multipart_upload = mock.Mock(
+                        side_effect=self._failing_upload({3: 2}))
+
+        self.driver.put(self.src, 's3://backups/data')
+
+        assert self.bucket.keys['data'] == self.data
+        assert sleep.call_count == 2
+
+    @mock.patch('scalarizr.storage2.cloudfs.base.time.sleep')
+    def test_put_part_failed(self, sleep):
+        self.driver.part_retries = 1
+        self.bucket.initiate_multipart_upload = mock.Mock(
+                        side_effect=self._failing_upload({2: 5}))
+
+        assert_raises(DriverError, self.driver.put, self.src, 's3://backups/data')
+        mp = self.bucket.uploads[0]
+        assert mp.cancelled and not mp.completed
+        assert 'data' not in self.bucket.keys
+
+    def test_small_file_not_split(self):
+        self.driver.multipart_threshold = 10000
+        with mock.patch.object(s3, 'Key') as key:
+            self.driver.put(self.src, 's3://backups/data')
+        assert key.return_value.set_contents_from_file.called
+        assert not self.bucket.uploads
+
+    def test_get_ranges(self):
+        self.bucket.keys['dir/data'] = self.data
+
+        path = self.driver.get('s3://backups/dir/data', self.tmp + '/')
+
+        assert path == os.path.join(self.tmp, 'data')
+        with open(path, 'rb') as fp:
+            assert fp.read() == self.data
+        assert sorted(self.bucket.ranges) == [
+                        (0, 999), (1000, 1999), (2000, 2999), (3000, 3999), (4000, 4499)]
+
+    def test_multipart_api(self):
+        driver = s3.S3FileSystem()
+        upload_id = driver.multipart_init('s3://backups/data', 1000)
+        for num, offset in enumerate(range(0, 4500, 2000)):
+            part = os.path.join(self.tmp, 'part%d' % num)
+            with open(part, 'wb') as fp:
+                fp.write(self.data[offset:offset + 2000])
+            # every FileTransfer worker has its own driver
+            s3.S3FileSystem().multipart_put(upload_id, num, part)
+
+        assert driver.multipart_complete(upload_id) == 's3://backups/data'
+        assert self.bucket.keys['data'] == self.data
+        assert upload_id not in s3.S3FileSystem._uploads
+
+    def _failing_upload(self, fail_parts):
+        def initiate(key_name, policy=None):
+            mp = FakeMultiPartUpload(self.bucket, key_name)
+            mp.fail_parts = fail_parts
+            self.bucket.uploads.append(mp)
+            return mp
+        return initiate
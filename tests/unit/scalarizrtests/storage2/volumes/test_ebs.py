@@ -4,6 +4,10 @@ Created on Sep 4, 2012
 @author: marat
 '''
 
+import threading
+
+import boto.ec2.volume
+import boto.exception
 import mock
 from nose.tools import raises
 
@@ -78,6 +82,90 @@ class TestFreeDeviceLetterMgr(object):
         assert letter not in ('g', 'f')
 
 
+class TestStatePoller(object):
+    def setup(self):
+        self.conn = mock.Mock()
+        self.poller = ebs.StatePoller(connect=lambda: self.conn)
+        self.poller.min_interval = self.poller.interval = 0.05
+        self.poller.batch_delay = 0.05
+        self.states = {}
+        def get_all_volumes(volume_ids):
+            ret = []
+            for id in volume_ids:
+                vol = boto.ec2.volume.Volume()
+                vol.id = id
+                vol.status = self.states[id].pop(0) if len(self.states[id]) > 1 else self.states[id][0]
+                ret.append(vol)
+            return ret
+        self.conn.get_all_volumes.side_effect = get_all_volumes
+
+    def volume(self, id, *states):
+        self.states[id] = list(states)
+        vol = boto.ec2.volume.Volume(connection='own')
+        vol.id = id
+        return vol
+
+    def test_batch(self):
+        self.poller.batch_delay = 0.2
+        vols = [self.volume('vol-%d' % i, 'creating', 'creating', 'available') for i in range(4)]
+        threads = [threading.Thread(target=self.poller.wait,
+                        args=(vol, lambda vol: vol.volume_state() == 'available'))
+                        for vol in vols]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert all(vol.status == 'available' for vol in vols)
+        assert all(vol.connection == 'own' for vol in vols)
+        assert self.conn.get_all_volumes.call_count == 3
+        for call in self.conn.get_all_volumes.call_args_list:
+            assert sorted(call[1]['volume_ids']) == ['vol-0', 'vol-1', 'vol-2', 'vol-3']
+
+    def test_throttling(self):
+        vol = self.volume('vol-1', 'available')
+        throttle = boto.exception.EC2ResponseError(503, 'Service Unavailable')
+        throttle.error_code = 'RequestLimitExceeded'
+        self.conn.get_all_volumes.side_effect = [throttle, throttle, [vol]]
+
+        self.poller.wait(vol, lambda vol: True)
+        assert self.poller.interval == 0.1
+
+    def test_not_found(self):
+        vol1 = self.volume('vol-1', 'available')
+        vol2 = self.volume('vol-2', 'available')
+        not_found = boto.exception.EC2ResponseError(400, 'Bad Request')
+        not_found.error_code = 'InvalidVolume.NotFound'
+        get_all_volumes = self.conn.get_all_volumes.side_effect
+        def get_missing(volume_ids):
+            if 'vol-2' in volume_ids:
+                raise not_found
+            return get_all_volumes(volume_ids)
+        self.conn.get_all_volumes.side_effect = get_missing
+
+        t = threading.Thread(target=self.poller.wait, args=(vol1, lambda vol: True))
+        t.start()
+        try:
+            self.poller.wait(vol2, lambda vol: True)
+            assert False, 'EC2ResponseError expected'
+        except boto.exception.EC2ResponseError:
+            pass
+        t.join()
+        assert vol1.status == 'available'
+
+    @raises(boto.exception.NoAuthHandlerFound)
+    def test_connect_failed(self):
+        def connect():
+            raise boto.exception.NoAuthHandlerFound('No credentials')
+        self.poller._connect = connect
+        self.poller.wait(self.volume('vol-1', 'available'), lambda vol: True)
+
+    @raises(BaseException)
+    def test_timeout(self):
+        vol = self.volume('vol-1', 'creating')
+        self.poller.wait(vol, lambda vol: vol.volume_state() == 'available', timeout=0.2)
+
+
 Ebs = ebs.EbsVolume
 @mock.patch.object(ebs, '__node__', new={'ec2': {
                                 'instance_id': 'i-12345678',
@@ -1,8 +1,10 @@
 __author__ = 'Nick Demyanchuk'
 
 import sys
+import time
 import mock
 import unittest
+import threading
 
 from scalarizr.storage2.volumes import raid
 from scalarizr.linux import mount
@@ -396,3 +398,52 @@ class RaidVolumeTest2(unittest.TestCase):
                     disks=[dict(type='loop', size=0.01)]*2)
             self.assertRaises(Exception, raid_vol.replace_disk, 0, {'device':'/dev/loop0'})
 
+
+
+@mock.patch('scalarizr.storage2.volumes.raid.storage2.volume', lambda disk: disk)
+class RaidEnsureDisksTest(unittest.TestCase):
+
+    def _disks(self, count, delay=0.05, fail=None):
+        self.running = self.max_running = 0
+        lock = threading.Lock()
+
+        def ensure(disk):
+            with lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(delay)
+            with lock:
+                self.running -= 1
+            if disk is fail:
+                raise Exception('attach failed')
+            disk.id = 'vol-%d' % disks.index(disk)
+
+        disks = []
+        for i in range(count):
+            disk = mock.Mock(id=None, type='ebs')
+            disk.ensure.side_effect = lambda disk=disk: ensure(disk)
+            disks.append(disk)
+        return disks
+
+    def test_concurrent(self):
+        raid_vol = raid.RaidVolume(type='raid', vg='test', level=10)
+        disks = self._disks(8)
+
+        start = time.time()
+        self.assertEqual(raid_vol._ensure_disks(disks), disks)
+        self.assertTrue(time.time() - start < 8 * 0.05)
+        self.assertEqual(self.max_running, raid_vol._ensure_concurrency)
+        self.assertEqual([d.id for d in disks], ['vol-%d' % i for i in range(8)])
+
+    def test_rollback(self):
+        raid_vol = raid.RaidVolume(type='raid', vg='test', level=10)
+        disks = self._disks(4)
+        disks[0].ensure.side_effect = None
+        disks[0].id = 'vol-existed'
+        disks[3].ensure.side_effect = Exception('attach failed')
+
+        self.assertRaises(Exception, raid_vol._ensure_disks, disks)
+        self.assertFalse(disks[0].destroy.called)
+        for disk in disks[1:3]:
+            disk.destroy.assert_called_once_with(force=True)
+        self.assertFalse(disks[3].destroy.called)
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+
+from scalarizr import config
+from scalarizr.bus import bus
+from scalarizr.util import sqlite_server
+
+
+DATABASE = '/tmp/state_test.db'
+
+
+class TestState(object):
+
+    def setup(self):
+        self._db = bus.db
+        bus.db = sqlite_server.ConnectionPool(lambda: sqlite3.connect(DATABASE))
+        bus.db.executescript('''
+DROP TABLE IF EXISTS state;
+CREATE TABLE state (
+	"name" TEXT PRIMARY KEY ON CONFLICT REPLACE,
+	"value" TEXT
+);
+INSERT INTO state VALUES ('global.msg_port', '8013');
+INSERT INTO state VALUES ('global.api_port', '8010');
+INSERT INTO state VALUES ('lifecycle.initialization_id', '"abc"');
+''')
+        self.state = config.State()
+
+    def teardown(self):
+        bus.db.close()
+        bus.db = self._db
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
+
+    def _select(self, name):
+        cur = bus.db.cursor()
+        cur.execute('SELECT value FROM state WHERE name = ?', [name])
+        return cur.fetchone()[0]
+
+    def test_get(self):
+        assert self.state['global.msg_port'] == 8013
+        assert self.state['lifecycle.initialization_id'] == 'abc'
+        assert self.state['undefined'] is None
+
+    def test_set(self):
+        self.state['global.msg_port'] = 8020
+        assert self.state['global.msg_port'] == 8020
+        assert self._select('global.msg_port') == '8020'
+
+    def test_update(self):
+        self.state.update({'operation.step': 'Mount', 'operation.in_progress': 1})
+        assert self.state['operation.step'] == 'Mount'
+        assert self._select('operation.in_progress') == '1'
+
+    def test_cached_value_is_copied(self):
+        self.state['script_executor.in_progress'] = [{'pid': 1}]
+        self.state['script_executor.in_progress'][0]['pid'] = 2
+        assert self.state['script_executor.in_progress'] == [{'pid': 1}]
+
+    def test_cached_value_matches_database(self):
+        value = {1: ('a', 'b')}
+        self.state['storage.volumes'] = value
+        value[1] = ()
+        assert self.state['storage.volumes'] == {'1': ['a', 'b']}
+        self.state.invalidate()
+        assert self.state['storage.volumes'] == {'1': ['a', 'b']}
+
+    def test_get_all(self):
+        self.state['globalx'] = 1
+        assert self.state.get_all('global.') == {
+                'global.msg_port': 8013,
+                'global.api_port': 8010
+        }
+
+    def test_invalidate(self):
+        assert self.state['global.msg_port'] == 8013
+        cur = bus.db.cursor()
+        cur.execute("INSERT INTO state VALUES ('global.msg_port', '8015')")
+        cur.execute("DELETE FROM state WHERE name = 'global.api_port'")
+        assert self.state['global.msg_port'] == 8013
+
+        self.state.invalidate('global.msg_port')
+        self.state.invalidate('global.api_port')
+        assert self.state['global.msg_port'] == 8015
+        assert self.state['global.api_port'] is None
+        assert self.state.get_all('global.') == {'global.msg_port': 8015}
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import mock
 
@@ -150,3 +151,62 @@ class TestIni(object):
         finally:
             if os.path.exists(filename):
                 os.remove(filename)
+
+
+class TestFileCache(object):
+    def setup(self):
+        self.filename = tempfile.mktemp(suffix='.ini')
+        with open(self.filename, 'w') as fp:
+            fp.write('[general]\nserver_id = 1\n')
+
+
+    def teardown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+    def test_ini_parsed_once(self):
+        store = node.Ini(self.filename, 'general')
+        with mock.patch.object(node, '_read_ini', wraps=node._read_ini) as read:
+            assert store['server_id'] == '1'
+            assert node.Ini(self.filename, 'general')['server_id'] == '1'
+            assert read.call_count == 1
+
+
+    def test_ini_modified(self):
+        store = node.Ini(self.filename, 'general')
+        assert store['server_id'] == '1'
+        with open(self.filename, 'w') as fp:
+            fp.write('[general]\nserver_id = 22\n')
+        assert store['server_id'] == '22'
+
+
+    def test_ini_own_write(self):
+        store = node.Ini(self.filename, 'general')
+        assert store['server_id'] == '1'
+        store['server_id'] = '2'
+        assert store['server_id'] == '2'
+
+
+    def test_file(self):
+        store = node.File(self.filename)
+        store['state'] = 'running'
+        assert store['state'] == 'running'
+        store['state'] = 'stopped'
+        assert store['state'] == 'stopped'
+        os.remove(self.filename)
+        try:
+            store['state']
+            assert 0, 'Expected KeyError'
+        except KeyError:
+            pass
+
+
+    def test_compound_re_key_cached(self):
+        store = {'root_password': 'qqq'}
+        master = node.Compound({'*_password': store})
+        pattern = master._Compound__re_map.keys()[0]
+        master._Compound__re_map = {mock.Mock(wraps=pattern): store}
+        master['root_password']
+        master['root_password']
+        assert master._Compound__re_map.keys()[0].match.call_count == 1
@@ -67,6 +67,21 @@ INSERT INTO test_execute_script VALUES (1, '/usr/bin/python', -9);
         assert type(cur) == sqlite_server.CursorProxy
 
 
+    def test_executemany(self):
+        CONN.executescript('''
+DROP TABLE IF EXISTS test_executemany;
+CREATE TABLE test_executemany ("id" INTEGER PRIMARY KEY, "name" TEXT);
+''')
+        sql = 'INSERT INTO test_executemany VALUES (?, ?)'
+        CONN.executemany(sql, [(1, 'one'), (2, 'two')])
+        # Duplicate id fails the whole batch
+        assert_raises(sqlite3.IntegrityError, CONN.executemany, sql, [(3, 'three'), (1, 'one')])
+
+        cur = CONN.cursor()
+        cur.execute('SELECT id FROM test_executemany ORDER BY id')
+        assert cur.fetchall() == [(1, ), (2, )]
+
+
 class TestCursorProxy(object):
     @classmethod
     def setup_class(cls):
@@ -111,6 +126,33 @@ INSERT INTO test_clients_update VALUES (1, 'Mr. First', 36);
         assert cur.fetchall() is None
 
 
+    def test_fetch_paging(self):
+        cur = CONN.cursor()
+        cur.execute('DROP TABLE IF EXISTS test_paging')
+        cur.execute('CREATE TABLE test_paging ("id" INTEGER PRIMARY KEY)')
+        for i in range(sqlite_server.FETCH_SIZE * 2 + 5):
+            cur.execute('INSERT INTO test_paging VALUES (?)', (i, ))
+
+        cur.execute('SELECT id FROM test_paging ORDER BY id')
+        assert len(cur._rows) == sqlite_server.PREFETCH_SIZE
+        assert cur.fetchone() == (0, )
+        assert cur.fetchmany(3) == [(1, ), (2, ), (3, )]
+        rows = cur.fetchall()
+        assert rows[0] == (4, )
+        assert len(rows) == sqlite_server.FETCH_SIZE * 2 + 1
+        assert not cur._more
+
+    def test_fetchone_closes_exhausted_cursor(self):
+        cur = CONN.cursor()
+        cur.execute('SELECT * FROM test_clients WHERE id = ?', (1, ))
+        assert not cur._more
+        assert cur.fetchone() == (1, 'Mr. First', 36)
+
+    def test_iter(self):
+        cur = CONN.cursor()
+        cur.execute('SELECT id FROM test_clients ORDER BY id')
+        assert list(cur) == [(1, ), (2, )]
+
     def test_rowcount(self):
         pass
 
@@ -178,3 +220,80 @@ class TestSQLiteServer(object):
         cur = CONN.cursor()
         cur.execute('select 1')
         assert cur.fetchone() == (1, )
+
+
+class TestConnectionPool(object):
+
+    def setup(self):
+        self.database = '/tmp/sqlite_pool_test.db'
+        self.pool = sqlite_server.ConnectionPool(
+                        lambda: sqlite3.Connection(database=self.database))
+        self.pool.executescript('''
+DROP TABLE IF EXISTS test_pool;
+CREATE TABLE test_pool (
+"id" INTEGER PRIMARY KEY,
+"name" TEXT
+);
+''')
+
+    def teardown(self):
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.database + suffix):
+                os.remove(self.database + suffix)
+
+    def test_wal(self):
+        cur = self.pool.cursor()
+        cur.execute('PRAGMA journal_mode')
+        assert cur.fetchone()[0].lower() == 'wal'
+
+    def test_connection_per_thread(self):
+        num_threads = 5
+        errors = []
+        conns = []
+
+        def work(i):
+            try:
+                conns.append(self.pool._connection())
+                cur = self.pool.cursor()
+                for _ in range(20):
+                    cur.execute('INSERT INTO test_pool VALUES (NULL, ?)', ['thread%d' % i])
+                self.pool.commit()
+            except:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work, args=(i, )) for i in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        assert len(set(map(id, conns))) == num_threads
+        cur = self.pool.cursor()
+        cur.execute('SELECT count(*) FROM test_pool')
+        assert cur.fetchone() == (100, )
+
+    def test_executemany(self):
+        sql = 'INSERT INTO test_pool VALUES (?, ?)'
+        self.pool.executemany(sql, [(1, 'one'), (2, 'two')])
+        assert_raises(sqlite3.IntegrityError, self.pool.executemany, sql, [(3, 'three'), (1, 'one')])
+
+        cur = self.pool.cursor()
+        cur.execute('SELECT id FROM test_pool ORDER BY id')
+        assert cur.fetchall() == [(1, ), (2, )]
+
+    def test_row_factory(self):
+        self.pool.row_factory = sqlite3.Row
+        result = []
+
+        def work():
+            cur = self.pool.cursor()
+            cur.execute('SELECT 1 AS one')
+            result.append(cur.fetchone()['one'])
+
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+        assert result == [1]